@@ -49,6 +49,9 @@ module ReadsUtils {
     /* Validate a FASTQ file. The file extensions .fq, .fnq, and .fastq
         are accepted. Note that prior to validation the file will be altered in
         place to remove blank lines and CRLF characters if any exist.
+        gzip and bzip2 compressed files, which may also have a compression
+        extension such as .fastq.gz, are validated as they are decompressed
+        and are not altered.
     */
     funcdef validateFASTQ(list<ValidateFASTQParams> params)
         returns(list<ValidateFASTQOutput> out) authentication required;
@@ -182,16 +185,43 @@ module ReadsUtils {
     funcdef upload_reads(UploadReadsParams params) returns(UploadReadsOutput)
         authentication required;
 
+    /* The output of the upload_reads_mass function for one set of reads, in
+        the same order as the input.
+
+        obj_ref - a reference to the new Workspace object in the form X/Y/Z,
+            where X is the workspace ID, Y is the object ID, and Z is the
+            version, or null if the upload failed.
+        error - the reason the upload failed, or null if it succeeded.
+    */
+    typedef structure {
+        string obj_ref;
+        string error;
+    } UploadReadsMassOutput;
+
+    /* Loads many sets of reads to KBase data stores. The reads are
+        processed concurrently, each workspace name is looked up once, and the
+        objects are saved in batches. A failure to upload one set of reads
+        does not stop the others.
+    */
+    funcdef upload_reads_mass(list<UploadReadsParams> params)
+        returns(list<UploadReadsMassOutput> out) authentication required;
+
    /* Input parameters for downloading reads objects.
         list<read_lib> read_libraries - the the workspace read library objects
             to download.
         tern interleaved - if true, provide the files in interleaved format if
             they are not already. If false, provide forward and reverse reads
             files. If null or missing, leave files as is.
+        boolean write_index - if true, write a sidecar record index next to
+            each reads file, at the file path with .fqi appended. The index
+            holds the byte offset of every 4096th record, the record count
+            and the total number of bases, so the file can be split into
+            record aligned chunks without scanning it. Defaults to false.
     */
     typedef structure {
         list<read_lib> read_libraries;
         tern interleaved;
+        boolean write_index;
     } DownloadReadsParams;
 
     /* Reads file information.
@@ -1,21 +1,30 @@
 # -*- coding: utf-8 -*-
 #BEGIN_HEADER
+import contextlib
+import functools
 import os
+import re
 import shutil
 import subprocess
 import tempfile
 import time
+import urllib.parse
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from numbers import Number
 from pprint import pformat
 
+import requests
 import six
 
 from installed_clients.DataFileUtilClient import DataFileUtil
 from installed_clients.WorkspaceClient import Workspace
+from installed_clients.kb_ea_utilsClient import kb_ea_utils
 from installed_clients.baseclient import ServerError as DFUError
 from installed_clients.baseclient import ServerError as WorkspaceError
-from installed_clients.kb_ea_utilsClient import kb_ea_utils
+from ReadsUtils import (bgzf, checkpoint, duplicate_counter, fasta_validator, fastq_index,
+                        fastq_io, fastq_stats, fastq_tee, fastq_validator, stages,
+                        validation_cache, web_stream)
 
 
 #END_HEADER
@@ -36,7 +45,7 @@ class ReadsUtils:
     # state. A method could easily clobber the state set by another while
     # the latter method is running.
     ######################################### noqa
-    VERSION = "1.0.1"
+    VERSION = "1.1.0"
     GIT_URL = "git@github.com:kbaseapps/ReadsUtils.git"
     GIT_COMMIT_HASH = "995829e6033ac8714c3a817c07f25c0336bd44ab"
 
@@ -46,7 +55,22 @@ class ReadsUtils:
     FALSE = 'false'
 
     FASTA_JAR = '/opt/lib/FastaValidator-1.0.jar'
+    # the fasta-validator config value selects the FASTA validator. It is either the
+    # FastaValidator jar, FASTA_JAR by default, or this to validate files in process.
+    NATIVE_FASTA_VALIDATOR = 'native'
     FASTQ_EXE = 'fastQValidator'
+    # the fastq-validator config value selects the FASTQ validator. It is either the validator
+    # executable, FASTQ_EXE by default, or this to validate files in process.
+    NATIVE_FASTQ_VALIDATOR = 'native'
+    # how the validator executable reports the line an error was found on
+    FASTQ_EXE_ERROR = re.compile(r'ERROR on Line (\d+): (.*)')
+    # the stats-engine config value selects how the reads statistics are calculated. By default
+    # they're calculated in process as the file is uploaded, or with this by the kb_ea_utils
+    # calculate_fastq_stats method.
+    EA_UTILS_STATS_ENGINE = 'kb_ea_utils'
+    # the duplicate-counting config value selects how number_of_duplicates is calculated. Reads
+    # are counted exactly by default, or with this estimated in a fixed amount of memory.
+    APPROXIMATE_DUPLICATES = 'approximate'
 
     FASTA_EXT = ['.fa', '.fas', '.fasta', '.fna']
     FASTQ_EXT = ['.fq', '.fastq', '.fnq']
@@ -55,6 +79,7 @@ class ReadsUtils:
 
     PARAM_IN_LIB = 'read_libraries'
     PARAM_IN_INTERLEAVED = 'interleaved'
+    PARAM_IN_INDEX = 'write_index'
 
     SINGLE_END_TYPE = 'SingleEndLibrary'
     PAIRED_END_TYPE = 'PairedEndLibrary'
@@ -66,6 +91,29 @@ class ReadsUtils:
 
     MIN_READS_LENGTH = 1  # Default fastQValidator minimum read length value (--minReadLen) is 10
 
+    # below this size starting a process pool costs more than it saves
+    PARALLEL_DEINTERLEAVE_MIN_SIZE = 256 * 1024 * 1024
+
+    # the compression level DataFileUtil used to gzip files on upload
+    GZIP_LEVEL = 3
+
+    # the memory to allow for each FASTQ file validated at once. Set the validation-workers
+    # config value to override the number of files validated at once
+    VALIDATION_MEMORY = 512 * 1024 * 1024
+    # the default number of reads libraries upload_reads_mass processes at once, which can be
+    # changed with the upload-workers config value
+    UPLOAD_WORKERS = 4
+    SAVE_BATCH_SIZE = 500  # the most objects upload_reads_mass saves in one call
+    # failed uploads to Shock are retried this many times by default, or as set by the
+    # upload-retries config value, waiting twice as long before each retry
+    UPLOAD_RETRIES = 2
+    UPLOAD_RETRY_DELAY = 5  # seconds
+    SHOCK_TIMEOUT = 60  # seconds
+
+    # validation results are cached in the validation-cache-dir config directory, by default
+    # in scratch. Setting it to this disables the cache
+    NO_VALIDATION_CACHE = 'none'
+
     def log(self, message, prefix_newline=False):
         print(('\n' if prefix_newline else '') +
               str(time.time()) + ': ' + message)
@@ -85,7 +133,7 @@ class ReadsUtils:
             if num <= 0:
                 raise ValueError(name + ' must be > 0')
 
-    def _proc_upload_reads_params(self, params):
+    def _proc_upload_reads_params(self, params, dfu, ws_ids=None):
 
         fwdsource, reads_source = (self._process_fwd_params(
             params.get('fwd_id'), params.get('fwd_file'), params.get('fwd_file_url'),
@@ -96,13 +144,15 @@ class ReadsUtils:
         if not self.xor(wsid, wsname):
             raise ValueError(
                 'Exactly one of the workspace ID or name must be provided')
-        dfu = DataFileUtil(self.callback_url)
         if wsname:
-            self.log('Translating workspace name to id')
             if not isinstance(wsname, str):
                 raise ValueError('wsname must be a string')
-            wsid = dfu.ws_name_to_id(wsname)
-            self.log('translation done')
+            if ws_ids and wsname in ws_ids:
+                wsid = ws_ids[wsname]
+            else:
+                self.log('Translating workspace name to id')
+                wsid = dfu.ws_name_to_id(wsname)
+                self.log('translation done')
         del wsname
         objid = params.get('objid')
         name = params.get('name')
@@ -367,11 +417,14 @@ class ReadsUtils:
             return True
         return False
 
-    def _download_reads_from_shock(self, ref, obj_name, handle, file_type):
+    # uncompress should be False only when the file will be read via fastq_io.open_reads, which
+    # decompresses on the fly and saves writing an uncompressed copy to scratch.
+    def _download_reads_from_shock(self, ref, obj_name, handle, file_type, uncompress=True):
         params = {'shock_id': handle['id'],
-                  'unpack': 'uncompress',
                   'file_path': os.path.join(self.scratch, handle['id'])
                   }
+        if uncompress:
+            params['unpack'] = 'uncompress'
         # TODO LATER may want to do dl en masse, but that means if there's a bad file it won't be caught until everythings dl'd @IgnorePep8 # noqa
         # TODO LATER add method to DFU to get shock attribs and check filename prior to download @IgnorePep8 # noqa
         # TODO LATER at least check handle filename & file type are ok before
@@ -424,109 +477,125 @@ class ReadsUtils:
     # should probably make an InterleaveProcessor class to avoid these
     # insane method sigs
 
-    def _read_fq_record(self, source_obj_ref, source_obj_name,
-                        shock_filename, shock_node, f,
-                        reads_source, filesource):
-        r = ''
-        for i in range(4):
-            l = f.readline()
-            while l == '\n':  # skip blank lines
-                l = f.readline()
-            if not l:  # EOF
-                if i != 0:
-                    error_message_bindings = [shock_node, shock_filename]
-                    error_message = 'Reading FASTQ record failed - non-blank lines are ' \
-                                    'not a multiple of four. '
-                    if source_obj_ref is not None and source_obj_name is not None:
-                        error_message += 'Workspace reads object {} ({}), '
-                        error_message_bindings.insert(0, source_obj_ref)
-                        error_message_bindings.insert(0, source_obj_name)
-
-                    if reads_source == 'web':
-                        error_message += 'File URL {}, '
-                        error_message_bindings.insert(0, filesource)
-
-                    if reads_source == 'staging':
-                        error_message += 'Staging file name {}, '
-                        error_message_bindings.insert(0, filesource)
-
-                    error_message += 'Shock node {}, Shock filename {}'
-                    raise ValueError(error_message.format(
-                        *error_message_bindings))
-                else:
-                    return ''
-            r = r + l
-        return r
+    def _truncated_record_error(self, source_obj_ref, source_obj_name,
+                                shock_filename, shock_node, reads_source, filesource):
+        error_message_bindings = [shock_node, shock_filename]
+        error_message = 'Reading FASTQ record failed - non-blank lines are ' \
+                        'not a multiple of four. '
+        if source_obj_ref is not None and source_obj_name is not None:
+            error_message += 'Workspace reads object {} ({}), '
+            error_message_bindings.insert(0, source_obj_ref)
+            error_message_bindings.insert(0, source_obj_name)
+
+        if reads_source == 'web':
+            error_message += 'File URL {}, '
+            error_message_bindings.insert(0, filesource)
+
+        if reads_source == 'staging':
+            error_message += 'Staging file name {}, '
+            error_message_bindings.insert(0, filesource)
+
+        error_message += 'Shock node {}, Shock filename {}'
+        return ValueError(error_message.format(*error_message_bindings))
+
+    def _record_count_mismatch_error(self, source_obj_ref, source_obj_name, fwd_shock_filename,
+                                     fwd_shock_node, rev_shock_filename, rev_shock_node,
+                                     fwdpath, revpath, reads_source, fwdsource, revsource):
+        error_message_bindings = list()
+        error_message = 'Interleave failed - reads files do not have '\
+                        'an equal number of records. '
+        if source_obj_name is not None and source_obj_ref is not None:
+            error_message += 'Workspace reads object {} ({}). '
+            error_message_bindings.insert(0, source_obj_ref)
+            error_message_bindings.insert(0, source_obj_name)
+        if fwd_shock_node is not None and rev_shock_node is not None:
+            error_message += 'forward Shock node {}, filename {}, ' \
+                             'reverse Shock node {}, filename {}. '
+            error_message_bindings.extend([fwd_shock_node, fwd_shock_filename,
+                                           rev_shock_node, rev_shock_filename])
+        error_message += 'Forward Path {}, Reverse Path {}.'
+        error_message_bindings.extend([fwdpath, revpath])
+
+        if reads_source == 'web':
+            error_message += 'Forward File URL {}, Reverse File URL {}.'
+            error_message_bindings.extend([fwdsource, revsource])
+
+        if reads_source == 'staging':
+            error_message += 'Forward Staging file name {}, '
+            error_message += 'Reverse Staging file name {}.'
+            error_message_bindings.extend([fwdsource, revsource])
+
+        return ValueError(error_message.format(*error_message_bindings))
 
     # this assumes that the FASTQ files are properly formatted and matched,
     # which they should be if they're in KBase.
     # source_obj_ref and source_obj_name will be None if done from upload.
     # reads_source, fwdsource, revsource will be None if done from process_paired.
+    # stats is an optional FASTQStats the interleaved reads are added to.
+    # Returns the number of lines written to targetpath.
     def interleave(self, source_obj_ref, source_obj_name, fwd_shock_filename,
                    fwd_shock_node, rev_shock_filename, rev_shock_node,
-                   fwdpath, revpath, targetpath, reads_source, fwdsource, revsource):
+                   fwdpath, revpath, targetpath, reads_source, fwdsource, revsource,
+                   stats=None):
         self.log('Interleaving files {} and {} to {}'.format(
             fwdpath, revpath, targetpath))
-        with open(targetpath, 'w') as t:
-            with open(fwdpath, 'r') as f, open(revpath, 'r') as r:
-                while True:
-                    frec = self._read_fq_record(
-                        source_obj_ref, source_obj_name,
-                        fwd_shock_filename, fwd_shock_node, f,
-                        reads_source, fwdsource)
-                    rrec = self._read_fq_record(
-                        source_obj_ref, source_obj_name,
-                        rev_shock_filename, rev_shock_node, r,
-                        reads_source, revsource)
-                    error_message_bindings = list()
-                    if (not frec and rrec) or (frec and not rrec):
-                        error_message = 'Interleave failed - reads files do not have '\
-                                        'an equal number of records. '
-                        if source_obj_name is not None and source_obj_ref is not None:
-                            error_message += 'Workspace reads object {} ({}). '
-                            error_message_bindings.insert(0, source_obj_ref)
-                            error_message_bindings.insert(0, source_obj_name)
-                        if fwd_shock_node is not None and rev_shock_node is not None:
-                            error_message += 'forward Shock node {}, filename {}, ' \
-                                             'reverse Shock node {}, filename {}. '
-                            error_message_bindings.extend([fwd_shock_node, fwd_shock_filename,
-                                                           rev_shock_node, rev_shock_filename])
-                        error_message += 'Forward Path {}, Reverse Path {}.'
-                        error_message_bindings.extend([fwdpath, revpath])
-
-                        if reads_source == 'web':
-                            error_message += 'Forward File URL {}, Reverse File URL {}.'
-                            error_message_bindings.extend([fwdsource, revsource])
-
-                        if reads_source == 'staging':
-                            error_message += 'Forward Staging file name {}, '
-                            error_message += 'Reverse Staging file name {}.'
-                            error_message_bindings.extend([fwdsource, revsource])
-
-                        raise ValueError(error_message.format(
-                            *error_message_bindings))
-                    if not frec:  # not rrec is implied at this point
-                        break
-                    t.write(frec)
-                    t.write(rrec)
+        with open(targetpath, 'wb') as t:
+            with fastq_io.open_reads(fwdpath) as f, fastq_io.open_reads(revpath) as r:
+                try:
+                    return fastq_io.interleave(f, r, t, consumers=[stats.add] if stats else ())
+                except (fastq_io.TruncatedRecordError, fastq_io.RecordCountMismatchError) as e:
+                    raise self._interleave_error(
+                        e, source_obj_ref, source_obj_name, fwd_shock_filename,
+                        fwd_shock_node, rev_shock_filename, rev_shock_node,
+                        fwdpath, revpath, reads_source, fwdsource, revsource) from e
+
+    # translates an error from fastq_io interleaving into one that describes the files
+    def _interleave_error(self, e, source_obj_ref, source_obj_name, fwd_shock_filename,
+                          fwd_shock_node, rev_shock_filename, rev_shock_node,
+                          fwdpath, revpath, reads_source, fwdsource, revsource):
+        if isinstance(e, fastq_io.TruncatedRecordError):
+            if e.stream_name == 'forward':
+                return self._truncated_record_error(
+                    source_obj_ref, source_obj_name, fwd_shock_filename,
+                    fwd_shock_node, reads_source, fwdsource)
+            return self._truncated_record_error(
+                source_obj_ref, source_obj_name, rev_shock_filename,
+                rev_shock_node, reads_source, revsource)
+        return self._record_count_mismatch_error(
+            source_obj_ref, source_obj_name, fwd_shock_filename,
+            fwd_shock_node, rev_shock_filename, rev_shock_node,
+            fwdpath, revpath, reads_source, fwdsource, revsource)
+
+    def _interleaved_blocks(self, fwdpath, revpath):
+        # interleaves the files on the fly rather than writing the result to disk
+        self.log(f'Interleaving files {fwdpath} and {revpath}')
+        with fastq_io.open_reads(fwdpath) as f, fastq_io.open_reads(revpath) as r:
+            yield from fastq_io.interleaved_blocks(f, r)
 
     # this assumes that the FASTQ file is properly formatted, which it should
-    # be if it's in KBase. Credit:
-    # https://www.biostars.org/p/19446/#117160
+    # be if it's in KBase. stats is an optional FASTQStats the reads are added to.
     def deinterleave(self, source_obj_ref, source_obj_name, shock_filename,
-                     shock_node, filepath, fwdpath, revpath):
+                     shock_node, filepath, fwdpath, revpath, stats=None):
         self.log(f'Deinterleaving file {filepath} to files {fwdpath} and {revpath}')
-        with open(filepath, 'r') as s:
-            with open(fwdpath, 'w') as f, open(revpath, 'w') as r:
-                count = 0
-                for line in s:
-                    if not line.strip():
-                        continue
-                    if count % 8 < 4:
-                        f.write(line)
-                    else:
-                        r.write(line)
-                    count += 1
+        workers = 1
+        # downloads are left compressed. Uncompressed files and BGZF files, which the reads
+        # files uploaded to Shock are, are split between processes. Other compressed files are
+        # deinterleaved in a single stream
+        compression = fastq_io.compression_type(filepath)
+        if ((not compression or compression == fastq_io.GZIP and bgzf.is_bgzf(filepath)) and
+                os.path.getsize(filepath) >= self.PARALLEL_DEINTERLEAVE_MIN_SIZE):
+            workers = os.cpu_count() or 1
+        summarize = None
+        if stats:
+            # the processes share the memory for counting duplicates
+            options = self._stats_options()
+            options['duplicate_memory'] = (
+                self.duplicate_memory or duplicate_counter.MEMORY_LIMIT) // workers
+            summarize = functools.partial(fastq_stats.FASTQStats, **options)
+        count, parts = fastq_io.deinterleave_file(filepath, fwdpath, revpath, workers, summarize)
+        for part in parts:
+            stats.merge(part)
+            part.close()
         if count % 8 != 0:
             raise ValueError(f'Deinterleave failed - line count is not divisible by 8. '
                              f'Workspace reads object {source_obj_name} ({source_obj_ref}), '
@@ -535,10 +604,12 @@ class ReadsUtils:
     # there's got to be better way to do this than these processing methods.
     # make some input classes for starters to fix these gross method sigs
 
+    # stats is an optional FASTQStats the reads are added to if they're deinterleaved
     def process_interleaved(self, source_obj_ref, source_obj_name,
-                            handle, interleave, file_type=None):
+                            handle, interleave, file_type=None, stats=None):
+        # deinterleaving reads compressed files directly
         path, name = self._download_reads_from_shock(
-            source_obj_ref, source_obj_name, handle, file_type)
+            source_obj_ref, source_obj_name, handle, file_type, interleave is not False)
 
         ret = {}
         if interleave is not False:  # e.g. True or None
@@ -556,7 +627,7 @@ class ReadsUtils:
             revpath = os.path.join(self.scratch, self.get_file_prefix() +
                                    '.rev.fastq')
             self.deinterleave(source_obj_ref, source_obj_name, name,
-                              handle['id'], path, fwdpath, revpath)
+                              handle['id'], path, fwdpath, revpath, stats)
             ret = {'fwd': fwdpath,
                    'fwd_name': name,
                    'rev': revpath,
@@ -566,14 +637,16 @@ class ReadsUtils:
                    }
         return ret
 
+    # stats is an optional FASTQStats the reads are added to if they're interleaved
     def process_paired(self, source_obj_ref, source_obj_name,
                        fwdhandle, revhandle, interleave,
-                       fwd_file_type=None, rev_file_type=None):
+                       fwd_file_type=None, rev_file_type=None, stats=None):
 
+        # interleaving reads compressed files directly
         fwdpath, fwdname = self._download_reads_from_shock(
-            source_obj_ref, source_obj_name, fwdhandle, fwd_file_type)
+            source_obj_ref, source_obj_name, fwdhandle, fwd_file_type, not interleave)
         revpath, revname = self._download_reads_from_shock(
-            source_obj_ref, source_obj_name, revhandle, rev_file_type)
+            source_obj_ref, source_obj_name, revhandle, rev_file_type, not interleave)
 
         ret = {}
         if interleave:
@@ -581,7 +654,8 @@ class ReadsUtils:
             intpath = os.path.join(self.scratch, self.get_file_prefix() +
                                    '.inter.fastq')
             self.interleave(source_obj_ref, source_obj_name, fwdname, fwdhandle['id'],
-                            revname, revhandle['id'], fwdpath, revpath, intpath, None, None, None)
+                            revname, revhandle['id'], fwdpath, revpath, intpath,
+                            None, None, None, stats)
             ret = {'fwd': intpath,
                    'fwd_name': fwdname,
                    'rev': None,
@@ -603,7 +677,22 @@ class ReadsUtils:
                    }
         return ret
 
-    def process_reads(self, reads, interleave):
+    # fills in the statistics missing from reads objects saved without them, such as
+    # KBaseAssembly objects. Reads that were interleaved or deinterleaved were added to stats as
+    # they were written. Otherwise the downloaded files haven't been read, so are read now.
+    def _add_missing_stats(self, ret, stats):
+        files = ret['files']
+        if files['type'] == files['otype']:
+            self.log('Calculating missing reads statistics')
+            for path in [p for p in [files['fwd'], files['rev']] if p]:
+                part = fastq_stats.file_stats(path, os.cpu_count() or 1, **self._stats_options())
+                stats.merge(part)
+                part.close()
+        for key, value in stats.result().items():
+            if ret.get(key) is None:
+                ret[key] = value
+
+    def process_reads(self, reads, interleave, index=False):
         data = reads['data']
         info = reads['info']
         # Object Info Contents
@@ -625,39 +714,54 @@ class ReadsUtils:
         ref = ret['ref']
         self.log('Type: ' + info[2])
 
-        # lib1 = KBaseFile, handle_1 = KBaseAssembly
-        if kbasefile:
-
-            if single:
-                sreads = data['lib']['file']
-                type_ = data['lib']['type']
-                ret['files'] = self.process_single_end(
-                    ref, obj_name, sreads, type_)
-            else:
-                fwd_reads = data['lib1']['file']
-                fwd_type = data['lib1']['type']
-                if 'lib2' in data:  # not interleaved
-                    rev_reads = data['lib2']['file']
-                    rev_type = data['lib2']['type']
-                    ret['files'] = self.process_paired(
-                        ref, obj_name, fwd_reads, rev_reads,
-                        interleave, fwd_type, rev_type)
+        # the statistics missing from the object are calculated as the files are processed
+        stats = None
+        if self.download_stats and ret['read_count'] is None:
+            stats = fastq_stats.FASTQStats(**self._stats_options())
+        try:
+            # lib1 = KBaseFile, handle_1 = KBaseAssembly
+            if kbasefile:
+
+                if single:
+                    sreads = data['lib']['file']
+                    type_ = data['lib']['type']
+                    ret['files'] = self.process_single_end(
+                        ref, obj_name, sreads, type_)
                 else:
-                    ret['files'] = self.process_interleaved(
-                        ref, obj_name, fwd_reads, interleave, fwd_type)
-        else:  # KBaseAssembly
-            if single:
-                ret['files'] = self.process_single_end(
-                    ref, obj_name, data['handle'])
-            else:
-                if 'handle_2' in data:  # not interleaved
-                    ret['files'] = self.process_paired(
-                        ref, obj_name, data['handle_1'],
-                        data['handle_2'], interleave)
+                    fwd_reads = data['lib1']['file']
+                    fwd_type = data['lib1']['type']
+                    if 'lib2' in data:  # not interleaved
+                        rev_reads = data['lib2']['file']
+                        rev_type = data['lib2']['type']
+                        ret['files'] = self.process_paired(
+                            ref, obj_name, fwd_reads, rev_reads,
+                            interleave, fwd_type, rev_type, stats)
+                    else:
+                        ret['files'] = self.process_interleaved(
+                            ref, obj_name, fwd_reads, interleave, fwd_type, stats)
+            else:  # KBaseAssembly
+                if single:
+                    ret['files'] = self.process_single_end(
+                        ref, obj_name, data['handle'])
                 else:
-                    ret['files'] = self.process_interleaved(
-                        ref, obj_name, data['handle_1'], interleave)
-
+                    if 'handle_2' in data:  # not interleaved
+                        ret['files'] = self.process_paired(
+                            ref, obj_name, data['handle_1'],
+                            data['handle_2'], interleave, stats=stats)
+                    else:
+                        ret['files'] = self.process_interleaved(
+                            ref, obj_name, data['handle_1'], interleave, stats=stats)
+
+            if stats:
+                self._add_missing_stats(ret, stats)
+        finally:
+            if stats:
+                stats.close()
+        if index:
+            for path in [ret['files']['fwd'], ret['files']['rev']]:
+                if path:
+                    self.log('Writing record index for ' + path)
+                    fastq_index.write_index(path)
         return ret
 
     def validateFASTA(self, ctx, params):
@@ -673,25 +777,8 @@ class ReadsUtils:
         # OLD BEGIN validateFASTA
         del ctx
         file_path = params.get('file_path')
-        if not file_path or not os.path.isfile(file_path):
-            raise ValueError('No such file: ' + str(file_path))
-        if os.path.splitext(file_path)[1].lower() not in self.FASTA_EXT:
-            raise ValueError('File {} is not a FASTA file'.format(file_path))
-        self.log('Validating FASTA file ' + file_path)
-        # TODO per transform service notes, we need a better fasta validator
-        # a good start would be not calling FVTester but writing our own
-        # wrapper (Py4J?) that takes options for types etc.
-        # see https://github.com/jwaldman/FastaValidator/blob/master/src/demo/FVTester.java
-        # note the version in jars returns non-zero error codes:
-        # https://github.com/srividya22/FastaValidator/commit/67e2d860f1869b9a76033e71fb2aaff910b7c2e3
-        # Better yet, move this to a Java SDK module, don't make a system
-        # call and expose useful options.
-        retcode = subprocess.call(
-            ['java', '-classpath', self.FASTA_JAR, 'FVTester', file_path])
-        self.log('Validation return code: ' + str(retcode))
-        validated = 1 if retcode == 0 else 0
-        self.log('Validation ' + ('succeeded' if validated else 'failed'))
-        out = {'valid': validated}
+        self._check_fasta_file(file_path)
+        out = {'valid': self._validate_fasta(file_path)}
         # OLD END validateFASTA
 
         # At some point might do deeper type checking...
@@ -701,14 +788,857 @@ class ReadsUtils:
         # return the results
         return [out]
 
+    def validateFASTA_batch(self, ctx, params):
+        """
+        Validate a list of FASTA files concurrently.
+        :param params: a list of structures with a file_path parameter, as for validateFASTA
+        :returns: a list of structures with a valid parameter, in the same order as the input
+        """
+        del ctx
+        for p in params:
+            self._check_fasta_file(p.get('file_path'))
+        workers = self._validation_workers(len(params))
+        if workers > 1:
+            self.log(f'Validating {len(params)} FASTA files, {workers} at a time')
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            out = [{'valid': v} for v in pool.map(
+                self._validate_fasta, [p['file_path'] for p in params])]
+        return [out]
+
+    def _check_fasta_file(self, file_path):
+        if not file_path or not os.path.isfile(file_path):
+            raise ValueError('No such file: ' + str(file_path))
+        if os.path.splitext(file_path)[1].lower() not in self.FASTA_EXT:
+            raise ValueError('File {} is not a FASTA file'.format(file_path))
+
+    def _validate_fasta(self, file_path):
+        self.log('Validating FASTA file ' + file_path)
+        if self.fasta_validator == self.NATIVE_FASTA_VALIDATOR:
+            error_count, errors = fasta_validator.validate_file(file_path)
+            for offset, message in errors:
+                self.log(f'Validation error at byte {offset} of {file_path}: {message}')
+            validated = 0 if error_count else 1
+        else:
+            # note the version in jars returns non-zero error codes:
+            # https://github.com/srividya22/FastaValidator/commit/67e2d860f1869b9a76033e71fb2aaff910b7c2e3
+            retcode = subprocess.call(
+                ['java', '-classpath', self.fasta_validator, 'FVTester', file_path])
+            self.log('Validation return code: ' + str(retcode))
+            validated = 1 if retcode == 0 else 0
+        self.log('Validation ' + ('succeeded' if validated else 'failed'))
+        return validated
+
+    def _normalize_fastq(self, file_path):
+        # removes blank lines and CRLF characters in place and returns the line count. Files
+        # that are already clean, as most are, aren't rewritten
+        c = fastq_io.clean_line_count(file_path)
+        if c is not None:
+            return c
+        return self._clean_fastq(file_path)
+
+    def _clean_fastq(self, file_path):
+        # rewrites the file without blank lines and CRLF characters and returns the line count
+        c = 0
+        self.log('Removing blank lines and CRLF characters')
+        # the new file is written next to the old one so it can be moved over it with an
+        # atomic rename
+        t = tempfile.NamedTemporaryFile(
+            mode='wb', dir=os.path.dirname(os.path.abspath(file_path)), delete=False)
+        try:
+            with open(file_path, 'rb') as s, t:
+                for block in fastq_io.record_blocks(s):
+                    t.write(block)
+                    c += block.count(b'\n')
+            shutil.copymode(file_path, t.name)
+            os.replace(t.name, file_path)
+        except BaseException:
+            os.remove(t.name)
+            raise
+        return c
+
+    def _check_fastq_file(self, file_path):
+        if not file_path or not os.path.isfile(file_path):
+            raise ValueError('No such file: ' + str(file_path))
+        self._check_fastq_ext(file_path)
+
+    def _check_fastq_ext(self, file_path):
+        name, ext = os.path.splitext(file_path)
+        if ext.lower() in self.COMPRESS_EXT:
+            ext = os.path.splitext(name)[1]
+        if ext.lower() not in self.FASTQ_EXT:
+            raise ValueError(f'File {file_path} is not a FASTQ file')
+
+    def _available_memory(self):
+        # the memory available for new work, or None if it can't be determined
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def _validation_workers(self, file_count):
+        # the number of files to validate at once - one per core, as long as they fit in memory
+        workers = self.validation_workers or os.cpu_count() or 1
+        memory = self._available_memory()
+        if memory is not None:
+            workers = min(workers, memory // self.VALIDATION_MEMORY)
+        return max(1, min(workers, file_count))
+
+    def _line_count_error(self, c, interleaved):
+        # returns the error if the line count isn't a whole number of records, or None
+        if interleaved and c % 8 != 0:
+            err = f'an interleaved FASTQ file is expected multiple of 8 lines, got {c}'
+            self.log('Invalid FASTQ file, ' + err)
+            return err
+        elif c % 4 != 0:
+            err = f'expected multiple of 4 lines, got {c}'
+            self.log('Invalid FASTQ file, ' + err)
+            return err
+        self.log(str(c) + ' lines in file')
+        return None
+
+    def _fastq_validator_args(self, file_path, interleaved, min_read_length):
+        arguments = [self.fastq_validator, '--file', file_path,
+                     '--maxErrors', str(self._max_validation_errors()),
+                     '--minReadLen', str((min_read_length or self.MIN_READS_LENGTH))]
+        if interleaved:
+            arguments.append('--disableSeqIDCheck')
+        return arguments
+
+    def _error_location(self, record, message):
+        # the location of an error in a record of the cleaned up data, for error messages
+        return f'record {record}, line {4 * (record - 1) + 1}: {message.rstrip(".")}'
+
+    def _log_validation_result(self, retcode, output):
+        # output is the file fastQValidator wrote its report to. Returns whether the file is
+        # valid and a description of the first error
+        output.seek(0)
+        report = output.read()
+        output.close()
+        if report:
+            self.log(report.rstrip())
+        self.log('Validation return code: ' + str(retcode))
+        validated = 1 if retcode == 0 else 0
+        self.log('Validation ' +
+                 ('succeeded' if validated else 'failed'))
+        if validated:
+            return 1, None
+        match = self.FASTQ_EXE_ERROR.search(report)
+        if not match:
+            return 0, None
+        return 0, self._error_location((int(match.group(1)) - 1) // 4 + 1, match.group(2))
+
+    def _id_check_options(self):
+        # the memory arguments for the native validator's duplicate sequence ID check, which
+        # shares the duplicate-memory config value with duplicate read counting. Hashes that
+        # don't fit in memory are spilled to scratch
+        return {'id_memory': self.duplicate_memory, 'spill_dir': self.scratch}
+
+    def _max_validation_errors(self):
+        # in fail fast mode the validators stop at the first error
+        return 1 if self.validation_fail_fast else fastq_validator.MAX_ERRORS
+
+    def _log_native_validation_result(self, result, first_record=None):
+        # first_record is the number of the record with the first error, if known. Returns
+        # whether the file is valid and a description of the first error
+        error_count, errors = result
+        for offset, message in errors:
+            self.log(f'Validation error at byte {offset}: {message}' if offset is not None
+                     else 'Validation error: ' + message)
+        if error_count and self.validation_fail_fast:
+            self.log('Validation stopped at the first error')
+        else:
+            self.log(f'Validation found {error_count} errors')
+        self.log('Validation ' + ('failed' if error_count else 'succeeded'))
+        if not error_count:
+            return 1, None
+        offset, message = errors[0]
+        if first_record:
+            return 0, self._error_location(first_record, message)
+        return 0, f'byte {offset}: {message}' if offset is not None else message
+
+    def _validation_options(self, interleaved, min_read_length):
+        # everything other than the file contents that the validation result depends on
+        return {'validator': self.fastq_validator,
+                'interleaved': 1 if interleaved else 0,
+                'min_read_length': min_read_length or self.MIN_READS_LENGTH}
+
+    def _cached_validation(self, file_path, options):
+        # returns the cached validation result for the file, or None
+        if not self.validation_cache:
+            return None
+        validated = self.validation_cache.get(file_path, options)
+        if validated is not None:
+            self.log(f'Using the cached validation result for {file_path}: {validated}')
+        return validated
+
+    def _cache_validation(self, file_path, options, validated):
+        if self.validation_cache:
+            self.validation_cache.put(file_path, options, validated)
+
+    def _validate_fastq(self, file_path, interleaved, min_read_length, workers=None):
+        # workers is the number of processes the native validator may use for the file
+        self._check_fastq_file(file_path)
+        self.log('Validating FASTQ file ' + file_path)
+        options = self._validation_options(interleaved, min_read_length)
+        validated = self._cached_validation(file_path, options)
+        if validated is None:
+            validated, _ = self._run_fastq_validation(file_path, interleaved, min_read_length,
+                                                      workers)
+            # the file may have been cleaned up, so the result is cached for the new contents
+            self._cache_validation(file_path, options, validated)
+        return validated
+
+    def _run_fastq_validation(self, file_path, interleaved, min_read_length, workers):
+        # returns whether the file is valid and a description of the first error
+        if fastq_io.compression_type(file_path):
+            # rather than writing a decompressed copy, the data is validated as it's decompressed
+            self.log('Validating compressed file as it is decompressed')
+            return self._validate_stream(file_path, interleaved, min_read_length)
+        if self.validation_fail_fast:
+            return self._validate_fail_fast(file_path, interleaved, min_read_length)
+        self.log('Checking line count')
+        error = self._line_count_error(self._normalize_fastq(file_path), interleaved)
+        if error:
+            return 0, error
+        if self.fastq_validator == self.NATIVE_FASTQ_VALIDATOR:
+            return self._log_native_validation_result(fastq_validator.validate_file(
+                file_path, min_read_length or self.MIN_READS_LENGTH, not interleaved,
+                workers or os.cpu_count() or 1, self._max_validation_errors(),
+                **self._id_check_options()))
+        output = tempfile.TemporaryFile(mode='w+')
+        retcode = subprocess.call(
+            self._fastq_validator_args(file_path, interleaved, min_read_length), stdout=output)
+        return self._log_validation_result(retcode, output)
+
+    def _validate_fail_fast(self, file_path, interleaved, min_read_length):
+        # validates an uncompressed file as it's cleaned up and its lines are counted, rather
+        # than counting the lines first, so reading stops at the first error. Files that need
+        # cleaning up are only rewritten once they're known to be valid
+        self.log('Validating the file as it is cleaned up, stopping at the first error')
+        size = 0
+
+        def count_bytes(block):
+            nonlocal size
+            size += len(block)
+
+        validated, error = self._validate_stream(file_path, interleaved, min_read_length,
+                                                 [count_bytes])
+        # cleaning up only removes characters, so a file is clean if nothing was removed
+        if validated and size != os.path.getsize(file_path):
+            self._clean_fastq(file_path)
+        return validated, error
+
+    # returns a function that takes blocks of cleaned up FASTQ data and a function that
+    # returns whether the data is valid, and a description of the first error, once all the
+    # blocks have been passed in. In fail fast mode the first function throws
+    # fastq_validator.ValidationStopped once the data is known to be invalid. The second
+    # function takes an optional function that returns the blocks again, which the native
+    # validator reads if sequence ID hashes collide, to compare the IDs.
+    def _start_stream_validator(self, interleaved, min_read_length):
+        if self.fastq_validator == self.NATIVE_FASTQ_VALIDATOR:
+            validator = fastq_validator.FASTQValidator(
+                min_read_length or self.MIN_READS_LENGTH, not interleaved,
+                self._max_validation_errors(), **self._id_check_options())
+
+            def validate_native(block):
+                validator.add(block)
+                if validator.done and self.validation_fail_fast:
+                    raise fastq_validator.ValidationStopped()
+
+            def finish_native(rescan=None):
+                try:
+                    if rescan:
+                        validator.confirm_duplicates(rescan)
+                    return self._log_native_validation_result(
+                        validator.result(), validator.first_error_record)
+                finally:
+                    validator.close()
+
+            return validate_native, finish_native
+
+        # the validator reads the cleaned up data from stdin. Its report is written to a file
+        # rather than a pipe, so it can't block on a full pipe while it's being written to
+        output = tempfile.TemporaryFile(mode='w+')
+        proc = subprocess.Popen(
+            self._fastq_validator_args('-', interleaved, min_read_length),
+            stdin=subprocess.PIPE, stdout=output)
+
+        def validate(block):
+            try:
+                proc.stdin.write(block)
+            except BrokenPipeError:
+                # the validator stopped early, its return code says why
+                if self.validation_fail_fast:
+                    raise fastq_validator.ValidationStopped()
+
+        def finish(rescan=None):
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            return self._log_validation_result(proc.wait(), output)
+        return validate, finish
+
+    def _validate_stream(self, file_path, interleaved, min_read_length, consumers=(),
+                         known_valid=False, blocks=None, rescan=None):
+        """
+        Reads a FASTQ file, which may be compressed, once, cleaning up the lines as
+        validateFASTQ does, and feeds the cleaned up data to the FASTQ validator and any other
+        consumers, which take blocks of data, at the same time. The file is not altered.
+        If blocks, an iterable of blocks of cleaned up records, is given the data is taken from
+        it instead of the file, and rescan, if given, is a function that returns the blocks
+        again for checking duplicate sequence IDs. Otherwise the file is read again if needed.
+
+        If known_valid is true the data isn't passed to the validator, and only the line count is
+        checked. Returns whether the file is valid and a description of the first error, which
+        is None if the file is valid or the error's location isn't known.
+        """
+        line_count = 0
+
+        def count_lines(block):
+            nonlocal line_count
+            line_count += block.count(b'\n')
+
+        if known_valid:
+            validate, finish_validation = lambda block: None, lambda: (1, None)
+        else:
+            validate, finish_validation = self._start_stream_validator(
+                interleaved, min_read_length)
+        consumers = [count_lines, validate] + list(consumers)
+        try:
+            if blocks is None:
+                rescan = functools.partial(fastq_io.file_record_blocks, file_path)
+                with fastq_io.open_reads(file_path) as s:
+                    fastq_tee.tee(fastq_io.record_blocks(s), consumers)
+            else:
+                fastq_tee.tee(blocks, consumers)
+        except fastq_validator.ValidationStopped:
+            self.log(f'Stopped reading {file_path} at the first validation error')
+            return finish_validation()
+        except BaseException:
+            finish_validation()
+            raise
+        data_valid, error = finish_validation(rescan)
+        line_error = self._line_count_error(line_count, interleaved)
+        if not data_valid:
+            return 0, error
+        return (0, line_error) if line_error else (1, None)
+
+    def _validate_paired(self, fwdpath, revpath, min_read_length):
+        """
+        Validates paired forward and reverse FASTQ files, which may be compressed, before they
+        are interleaved. The files are validated at the same time, each with sequence ID checks,
+        and the mates in each pair are checked to have the same ID, ignoring /1 and /2 suffixes.
+
+        Returns the path of the file to report and a description of its first error, which are
+        both None if the files are valid. Throws fastq_io.TruncatedRecordError or
+        fastq_io.RecordCountMismatchError if the files can't be paired.
+        """
+        self.log(f'Validating paired FASTQ files {fwdpath} and {revpath}')
+        fwd_validate, fwd_finish = self._start_stream_validator(False, min_read_length)
+        rev_validate, rev_finish = self._start_stream_validator(False, min_read_length)
+        mismatches = 0
+        mismatch_error = None
+        offset = 0
+        records = 0
+
+        def check_mates(pair):
+            nonlocal mismatches, mismatch_error, offset, records
+            bad = fastq_validator.mate_mismatches(*pair)
+            if len(bad) and not mismatches:
+                self.log(f'The mate of the record at byte {offset + int(bad[0])} of the '
+                         'cleaned up forward file has a different sequence ID')
+                mismatch_error = self._error_location(
+                    records + pair[0][:int(bad[0])].count(b'\n') // 4 + 1,
+                    'The mate has a different sequence ID')
+            mismatches += len(bad)
+            offset += len(pair[0])
+            records += pair[0].count(b'\n') // 4
+            if mismatches and self.validation_fail_fast:
+                raise fastq_validator.ValidationStopped()
+
+        stopped = False
+        completed = False
+        try:
+            with fastq_io.open_reads(fwdpath) as f, fastq_io.open_reads(revpath) as r:
+                fastq_tee.tee(fastq_io.paired_blocks(f, r),
+                              [lambda pair: fwd_validate(pair[0]),
+                               lambda pair: rev_validate(pair[1]),
+                               check_mates])
+            completed = True
+        except fastq_validator.ValidationStopped:
+            self.log('Stopped reading the paired files at the first validation error')
+            stopped = True
+        finally:
+            # the files are only read again to check duplicate IDs once they've been read
+            # to the end
+            fwd_valid, fwd_error = fwd_finish(
+                functools.partial(fastq_io.file_record_blocks, fwdpath) if completed else None)
+            rev_valid, rev_error = rev_finish(
+                functools.partial(fastq_io.file_record_blocks, revpath) if completed else None)
+        if mismatches:
+            self.log(f'{mismatches} pairs of mates have different sequence IDs')
+        if not fwd_valid:
+            return fwdpath, fwd_error
+        if mismatches:
+            return fwdpath, mismatch_error
+        if not rev_valid or stopped:
+            return revpath, rev_error
+        return None, None
+
+    def _stats_options(self):
+        # the duplicate counting arguments for fastq_stats. Fingerprints that don't fit in memory
+        # are spilled to scratch
+        return {'duplicate_memory': self.duplicate_memory,
+                'spill_dir': self.scratch,
+                'approximate_duplicates': self.duplicate_counting == self.APPROXIMATE_DUPLICATES}
+
+    def _validate_compress_and_stats(self, file_path, interleaved, min_read_length,
+                                     known_valid=False, blocks=None):
+        """
+        Reads a FASTQ file once and feeds the cleaned up data to the FASTQ validator, a
+        multithreaded BGZF compressor and the reads statistics calculator at the same time, as
+        per _validate_stream. If known_valid is true only the line count is checked. If blocks
+        is given the data is taken from it, file_path only names the compressed file, and the
+        result isn't cached.
+
+        Returns whether the file is valid, the path to the gzipped file, the statistics, which
+        are None if they're calculated by kb_ea_utils, and a description of the first error.
+        """
+        cached = None
+        options = self._validation_options(interleaved, min_read_length)
+        if blocks is None:
+            self._check_fastq_file(file_path)
+            cached = self._cached_validation(file_path, options)
+        self.log('Validating FASTQ file ' + file_path)
+        if cached == 0:
+            return 0, None, None, None
+        known_valid = known_valid or bool(cached)
+        gzdir = self.get_file_prefix()
+        os.makedirs(gzdir)
+        name = os.path.basename(file_path)
+        ext = self._get_ext(name.lower(), self.COMPRESS_EXT)
+        if ext:  # compressed reads are recompressed with gzip
+            name = name[:-len(ext)]
+        gzpath = os.path.join(gzdir, name + '.gz')
+        stats = None
+        if self.stats_engine != self.EA_UTILS_STATS_ENGINE:
+            stats = fastq_stats.FASTQStats(**self._stats_options())
+        try:
+            with bgzf.BGZFWriter(gzpath, self.GZIP_LEVEL) as gz:
+                consumers = [gz.write, stats.add] if stats else [gz.write]
+
+                def rescan():
+                    # the blocks can't be read twice, so the cleaned up data is read back from
+                    # the compressed file
+                    gz.close()
+                    return fastq_io.file_record_blocks(gzpath)
+
+                validated, error = self._validate_stream(
+                    file_path, interleaved, min_read_length, consumers, known_valid, blocks,
+                    rescan)
+                if not validated:
+                    gz.abort()  # the compressed file won't be used
+            if not known_valid and blocks is None:
+                self._cache_validation(file_path, options, validated)
+            return validated, gzpath, stats.result() if stats else None, error
+        finally:
+            if stats:
+                stats.close()
+
     def get_fq_stats(self, reads_object, file_path):
+        """
+        Gets the reads statistics for the FASTQ file at file_path from kb_ea_utils and adds
+        them to reads_object.
+        """
         eautils = kb_ea_utils(self.callback_url)
-        ea_stats_dict = eautils.calculate_fastq_stats(
-            {'read_library_path': file_path})
+        ea_stats_dict = eautils.calculate_fastq_stats({'read_library_path': file_path})
         for key in ea_stats_dict:
             reads_object[key] = ea_stats_dict[key]
         return reads_object
 
+    def _prepare_reads_object(self, params, user_id, token, dfu, ws_ids=None):
+        """
+        Processes the parameters for a reads upload as per upload_reads, and downloads,
+        validates, compresses and uploads the reads to Shock.
+
+        token authorizes deleting the uploaded reads from Shock if the upload fails. ws_ids is an
+        optional dict of workspace names to IDs that have already been looked up.
+        Returns the workspace ID and the object to save to it, as for save_objects.
+        """
+        o, wsid, name, objid, kbtype, single_end, fwdsource, revsource, reads_source = (
+            self._proc_upload_reads_params(params, dfu, ws_ids))
+        # If reads_source == 'shock', fwdsource and revsource are shock nodes
+        # If reads_source == 'web', fwdsource and revsource are urls
+        # If reads_source == 'staging', fwdsource and revsource are file name/subdirectory
+        #                               in staging area
+        # If reads_source == 'local', fwdsource and revsource are file paths
+        min_read_length = params.get('min_read_length', self.MIN_READS_LENGTH)
+        interleaved = 1 if not single_end else 0
+        download_type = params.get('download_type')
+        manifest = self._job_manifest(params, user_id)
+        try:
+            if self._streams_web(reads_source, download_type):
+                # streamed reads can't be fingerprinted, so the upload can't be resumed
+                fhandle, fsize = self._stream_web_reads(
+                    o, dfu, token, fwdsource, revsource, download_type, interleaved,
+                    min_read_length, checkpoint.JobManifest(None, None))
+            else:
+                fhandle, fsize = self._download_and_upload(
+                    o, dfu, token, fwdsource, revsource, reads_source, download_type, user_id,
+                    interleaved, min_read_length, manifest)
+        except ValueError:
+            # the reads are invalid, so a retry should start again with fixed files
+            manifest.remove()
+            raise
+
+        fwdfile = {'file': fhandle,
+                   'encoding': 'ascii',
+                   'size': fsize,
+                   'type': 'fq'
+                   }
+        if single_end:
+            o['lib'] = fwdfile
+        else:
+            o['lib1'] = fwdfile
+
+        so = {'type': kbtype,
+              'data': o
+              }
+        if name:
+            so['name'] = name
+        else:
+            so['objid'] = objid
+        return wsid, so
+
+    def _download_and_upload(self, reads_object, dfu, token, fwdsource, revsource,
+                             reads_source, download_type, user_id, interleaved, min_read_length,
+                             manifest):
+        """
+        Downloads the reads files as per _process_download, interleaves paired files, and
+        validates, compresses and uploads the reads to Shock, adding their statistics to
+        reads_object. Completed stages are recorded in the job manifest, and resumed from if
+        the input reads are unchanged.
+
+        Returns the handle for the uploaded file and its size.
+        """
+        fwdname, revname, fwdid, revid = (None,) * 4
+        # Shock nodes can't change, so only their downloads are resumed. Files from other
+        # sources are fetched again and identified by their contents
+        if reads_source in ['shock', 'local']:
+            manifest.set_inputs(
+                self._input_fingerprint(manifest, reads_source, fwdsource, revsource))
+        ret = manifest.get('downloaded') if reads_source == 'shock' else None
+        if ret:
+            self.log('Resuming upload from the reads files downloaded by an earlier attempt')
+            ret = dict(ret)
+        else:
+            ret = self._process_download(fwdsource, revsource, reads_source, download_type,
+                                         user_id)
+            if reads_source == 'shock':
+                manifest.record('downloaded', ret, [ret['fwdpath'], ret['revpath']])
+            elif reads_source != 'local':
+                manifest.set_inputs(self._input_fingerprint(
+                    manifest, reads_source, ret['fwdpath'], ret['revpath']))
+        uploaded = manifest.get('uploaded')
+        if uploaded:
+            self.log('Resuming upload: the reads were uploaded to Shock by an earlier attempt')
+            reads_object.update(uploaded['reads'])
+            return uploaded['handle'], uploaded['size']
+        fwdpath = ret.get('fwdpath')
+        revpath = ret.get('revpath')
+
+        if reads_source == 'shock':
+            fwdname = ret.get('fwdname')
+            revname = ret.get('revname')
+            fwdid = fwdsource
+            revid = revsource
+
+        file_info = ret
+        file_info['fwdsource'] = fwdsource
+        file_info['revsource'] = revsource
+        actualpath = fwdpath
+        pairs_valid = False
+        blocks = None
+        if revpath:
+            if self.paired_validation:
+                try:
+                    invalidpath, error = self._validate_paired(
+                        fwdpath, revpath, min_read_length)
+                except (fastq_io.TruncatedRecordError, fastq_io.RecordCountMismatchError):
+                    invalidpath = None  # interleaving reports these with the file details
+                else:
+                    pairs_valid = not invalidpath
+                if invalidpath:
+                    raise ValueError(self._generate_validation_error_message(
+                        reads_source, invalidpath, file_info, error))
+            # now interleave the files
+            actualpath = os.path.join(
+                self.scratch, self.get_file_prefix() + '.inter.fastq')
+            if self.stats_engine == self.EA_UTILS_STATS_ENGINE:
+                # kb_ea_utils needs the interleaved file
+                self.interleave(None, None, fwdname, fwdid, revname, revid, fwdpath, revpath,
+                                actualpath, reads_source, fwdsource, revsource)
+            else:
+                # the files are interleaved as they're validated and compressed, rather than
+                # written to disk and read back
+                blocks = self._interleaved_blocks(fwdpath, revpath)
+
+        fhandle = None
+        # gzipped reads from a single Shock node that need no cleaning up are copied in Shock
+        # rather than compressed and uploaded again. Reads compressed any other way, such as
+        # with bzip2, are recompressed so every uploaded file is gzipped
+        if (reads_source == 'shock' and not revpath
+                and fastq_io.compression_type(fwdpath) == fastq_io.GZIP
+                and self.stats_engine != self.EA_UTILS_STATS_ENGINE):
+            file_valid, stats, fhandle, error = self._copy_shock_reads(
+                dfu, fwdpath, fwdid, interleaved, min_read_length)
+            if not file_valid:
+                raise ValueError(self._generate_validation_error_message(
+                    reads_source, actualpath, file_info, error))
+        if fhandle:
+            fsize = os.path.getsize(fwdpath)
+            reads_object.update(stats)
+        else:
+            try:
+                fhandle, fsize = self._validate_and_upload(
+                    reads_object, dfu, token, actualpath, interleaved, min_read_length, pairs_valid,
+                    blocks, reads_source, file_info, manifest)
+            except (fastq_io.TruncatedRecordError, fastq_io.RecordCountMismatchError) as e:
+                raise self._interleave_error(
+                    e, None, None, fwdname, fwdid, revname, revid, fwdpath, revpath,
+                    reads_source, fwdsource, revsource) from e
+        manifest.record('uploaded', {'handle': fhandle, 'size': fsize, 'reads': reads_object})
+        return fhandle, fsize
+
+    def _streams_web(self, reads_source, download_type):
+        # whether reads from the web are streamed into validation rather than downloaded first.
+        # kb_ea_utils and validating the paired files separately both need the files on disk
+        return (reads_source == 'web' and self.web_streaming
+                and download_type in web_stream.STREAMABLE_TYPES
+                and self.stats_engine != self.EA_UTILS_STATS_ENGINE
+                and not self.paired_validation)
+
+    def _stream_web_reads(self, reads_object, dfu, token, fwdurl, revurl, download_type,
+                          interleaved, min_read_length, manifest):
+        """
+        Streams the reads files at the URLs into validation, compression and the statistics
+        calculator as they download, decompressing and interleaving them on the way, rather
+        than downloading them to scratch first. The reads are then uploaded to Shock and their
+        statistics added to reads_object.
+
+        Returns the handle for the uploaded file and its size.
+        """
+        # the URLs stand in for the downloaded file paths in error messages
+        file_info = {'fwdpath': fwdurl, 'revpath': revurl,
+                     'fwdsource': fwdurl, 'revsource': revurl}
+        with contextlib.ExitStack() as streams:
+            self.log('streaming reads file(s) from ' + fwdurl)
+            fwd = streams.enter_context(web_stream.open_url(fwdurl, download_type))
+            if revurl:
+                rev = streams.enter_context(web_stream.open_url(revurl, download_type))
+                actualpath = self.get_file_prefix() + '.inter.fastq'
+                blocks = fastq_io.interleaved_blocks(fwd, rev)
+            else:
+                name = os.path.basename(urllib.parse.unquote(urllib.parse.urlparse(fwdurl).path))
+                base, ext = os.path.splitext(name)
+                if ext.lower() in self.COMPRESS_EXT:
+                    name = base
+                # only names the compressed file, which is written to its own directory
+                actualpath = os.path.join(self.scratch, name)
+                self._check_fastq_ext(actualpath)
+                blocks = fastq_io.FASTQBlockReader(fwd).blocks()
+            try:
+                return self._validate_and_upload(
+                    reads_object, dfu, token, actualpath, interleaved, min_read_length, False,
+                    blocks, 'web', file_info, manifest)
+            except (fastq_io.TruncatedRecordError, fastq_io.RecordCountMismatchError) as e:
+                raise self._interleave_error(
+                    e, None, None, None, None, None, None, fwdurl, revurl, 'web', fwdurl,
+                    revurl) from e
+
+    def _resolve_workspace_names(self, dfu, params):
+        # looks up each workspace name in a list of upload parameters once. Names that can't be
+        # looked up are left out, so the error is reported for each upload that uses them
+        ws_ids = {}
+        for p in params:
+            wsname = p.get('wsname') if isinstance(p, dict) else None
+            if isinstance(wsname, str) and wsname and wsname not in ws_ids:
+                try:
+                    ws_ids[wsname] = dfu.ws_name_to_id(wsname)
+                except DFUError as e:
+                    self.log(f'Could not translate workspace name {wsname} to an id: {e}')
+        return ws_ids
+
+    def _save_reads_objects(self, dfu, prepared, out):
+        # saves the prepared objects in as few calls as possible, recording the reference, or
+        # the error if the save failed, for each in out
+        by_ws = {}
+        for i, p in enumerate(prepared):
+            if p:
+                by_ws.setdefault(p[0], []).append(i)
+        for wsid, indexes in by_ws.items():
+            for b in range(0, len(indexes), self.SAVE_BATCH_SIZE):
+                batch = indexes[b:b + self.SAVE_BATCH_SIZE]
+                self.log(f'Saving {len(batch)} reads objects to workspace {wsid}')
+                try:
+                    infos = dfu.save_objects(
+                        {'id': wsid, 'objects': [prepared[i][1] for i in batch]})
+                except Exception as e:
+                    for i in batch:
+                        out[i]['error'] = str(e)
+                else:
+                    for i, oi in zip(batch, infos):
+                        out[i]['obj_ref'] = self.make_ref(oi)
+
+    def _validate_and_upload(self, reads_object, dfu, token, actualpath, interleaved,
+                             min_read_length, pairs_valid, blocks, reads_source, file_info,
+                             manifest):
+        """
+        Validates, compresses and calculates the statistics for the reads in a single read,
+        as per _validate_compress_and_stats, then uploads the compressed file to Shock and adds
+        the statistics to reads_object. Paired files that have already been validated only have
+        the line count checked. The compressed file is recorded in the job manifest, and reused
+        if an earlier attempt recorded it. kb_ea_utils calculates the statistics while the file
+        uploads, and if it fails the uploaded file is deleted from Shock with token.
+
+        Returns the handle for the uploaded file and its size.
+        """
+        compressed = manifest.get('compressed')
+        if compressed:
+            self.log('Resuming upload from the reads file compressed by an earlier attempt')
+            gzpath, stats = compressed['gzpath'], compressed['stats']
+        else:
+            file_valid, gzpath, stats, error = self._validate_compress_and_stats(
+                actualpath, interleaved, min_read_length, pairs_valid, blocks)
+
+            if not file_valid:
+                validation_error_message = self._generate_validation_error_message(
+                    reads_source, actualpath, file_info, error)
+                raise ValueError(validation_error_message)
+            # kb_ea_utils calculates the statistics from the uncompressed file, which may not
+            # be kept, so the compressed file can only be reused with in process statistics
+            if stats is not None:
+                manifest.record('compressed', {'gzpath': gzpath, 'stats': stats}, [gzpath])
+
+        self.log('validation complete, uploading files to shock')
+
+        if stats is not None:
+            # the statistics were calculated as the file was compressed
+            reads_object.update(stats)
+            uploadedfile = self._file_to_shock(dfu, gzpath)
+            return uploadedfile['handle'], uploadedfile['size']
+
+        # kb_ea_utils calculates the statistics while the file uploads. Neither DataFileUtil
+        # nor kb_ea_utils can stop a call once it's started, so a stage is only skipped, or an
+        # upload not retried, if the other has already failed
+        uploaded = []
+
+        def upload(cancelled):
+            if not cancelled.is_set():
+                uploaded.append(self._file_to_shock(dfu, gzpath, cancelled))
+
+        def add_stats(cancelled):
+            if not cancelled.is_set():
+                self.get_fq_stats(reads_object, actualpath)
+
+        try:
+            stages.run_concurrently([upload, add_stats])
+        except Exception:
+            # the stages have all stopped, so the upload is either done or failed
+            for u in uploaded:
+                self._delete_shock_node(u['shock_id'], token)
+            raise
+        return uploaded[0]['handle'], uploaded[0]['size']
+
+    def _file_to_shock(self, dfu, file_path, cancelled=None):
+        # uploads the file to Shock and makes a handle for it, retrying failures such as
+        # timeouts unless the threading.Event cancelled is set
+        for attempt in range(self.upload_retries + 1):
+            try:
+                return dfu.file_to_shock({'file_path': file_path,
+                                          'make_handle': 1})
+            except (DFUError, OSError) as e:
+                if attempt == self.upload_retries or (cancelled and cancelled.is_set()):
+                    raise
+                delay = self.UPLOAD_RETRY_DELAY * 2 ** attempt
+                self.log(f'Uploading {file_path} failed, retrying in {delay}s: {e}')
+                time.sleep(delay)
+
+    def _delete_shock_node(self, node_id, token):
+        # deletes a node that won't be used, such as reads uploaded by a job that then failed.
+        # Failures are only logged, so they don't hide the error that failed the job
+        try:
+            requests.delete(self.shock_url + '/node/' + node_id,
+                            headers={'Authorization': 'OAuth ' + token},
+                            timeout=self.SHOCK_TIMEOUT).raise_for_status()
+            self.log('Deleted Shock node ' + node_id)
+        except requests.RequestException as e:
+            self.log(f'Deleting Shock node {node_id} failed: {e}')
+
+    def _input_fingerprint(self, manifest, reads_source, fwd, rev):
+        # identifies the input reads for the job manifest. Shock nodes can't change, local files
+        # are identified by their size, modification time and inode, and files fetched from the
+        # staging area or the web, which are written again each time, by their contents
+        if not manifest.enabled:
+            return None
+        if reads_source == 'shock':
+            return [fwd, rev]
+        fingerprint = (checkpoint.file_fingerprint if reads_source == 'local'
+                       else checkpoint.content_fingerprint)
+        return [fingerprint(p) if p else None for p in [fwd, rev]]
+
+    def _job_manifest(self, params, user_id):
+        # the manifest of completed upload stages, which are only recorded if the
+        # upload-checkpoint-dir config value is set
+        return checkpoint.JobManifest(self.checkpoint_dir, {'user': user_id, 'params': params})
+
+    def _copy_shock_reads(self, dfu, file_path, shock_id, interleaved, min_read_length):
+        """
+        Validates the gzipped reads downloaded from a Shock node and calculates their
+        statistics as they are decompressed. If they're valid and need no cleaning up the node
+        is copied in Shock, rather than compressing the reads and uploading them again.
+
+        Returns whether the reads are valid, their statistics, the handle for the copied
+        node, which is None if the node couldn't be copied, and a description of the first
+        error.
+        """
+        self._check_fastq_file(file_path)
+        self.log('Validating FASTQ file ' + file_path)
+        stats = fastq_stats.FASTQStats(**self._stats_options())
+        try:
+            with fastq_io.open_reads(file_path) as s:
+                reader = fastq_io.FASTQBlockReader(s)
+                validated, error = self._validate_stream(
+                    file_path, interleaved, min_read_length, [stats.add], blocks=reader.blocks(),
+                    rescan=functools.partial(fastq_io.file_record_blocks, file_path))
+            if not validated:
+                return 0, None, None, error
+            if reader.normalized:
+                self.log('The reads need cleaning up, so will be uploaded again')
+                return 1, None, None, None
+            self.log(f'validation complete, copying Shock node {shock_id}')
+            copied = dfu.copy_shock_node({'shock_id': shock_id, 'make_handle': 1})
+            return 1, stats.result(), copied['handle'], None
+        finally:
+            stats.close()
+
+    def _fetch_pair(self, fetch, fwd, rev):
+        # fetches the forward and, if given, reverse files at the same time with fetch, which
+        # takes a source and returns a path. The first error is thrown without waiting for the
+        # other download, which DataFileUtil can't stop and only writes to scratch
+        if not rev:
+            return fetch(fwd), None
+        self.log('downloading the forward and reverse reads files')
+        fwdpath, revpath = stages.run_concurrently([lambda cancelled: fetch(fwd),
+                                                    lambda cancelled: fetch(rev)],
+                                                   wait_on_failure=False)
+        return fwdpath, revpath
+
     def _process_download(self, fwd, rev, reads_source, download_type, user_id):
         """
         _process_download: processing different type of downloads
@@ -730,14 +1660,18 @@ class ReadsUtils:
 
         dfu = DataFileUtil(self.callback_url)
         if reads_source == 'shock':
-            # Grab files from Shock
+            # Grab files from Shock. Files are read compressed, so only a single file for
+            # kb_ea_utils, which needs an uncompressed file, is uncompressed. Each upload gets
+            # its own directory, as files are named for their Shock file names and
+            # upload_reads_mass runs uploads at the same time.
+            download_dir = self.get_file_prefix()
             fileinput = [{'shock_id': fwd,
-                          'file_path': self.scratch + '/fwd/',
-                          'unpack': 'uncompress'}]
+                          'file_path': os.path.join(download_dir, 'fwd') + '/'}]
             if rev:
                 fileinput.append({'shock_id': rev,
-                                  'file_path': self.scratch + '/rev/',
-                                  'unpack': 'uncompress'})
+                                  'file_path': os.path.join(download_dir, 'rev') + '/'})
+            elif self.stats_engine == self.EA_UTILS_STATS_ENGINE:
+                fileinput[0]['unpack'] = 'uncompress'
             self.log('downloading reads file(s) from Shock')
             files = dfu.shock_to_file_mass(fileinput)
             fwdpath = files[0]["file_path"]
@@ -746,21 +1680,16 @@ class ReadsUtils:
                 revpath = files[1]["file_path"]
                 revname = files[1]["node_file_name"]
         elif reads_source == 'web':
-            fwdpath = dfu.download_web_file(
-                        {'file_url': fwd,
-                        'download_type': download_type}).get(
-                                        'copy_file_path')
-            revpath = dfu.download_web_file(
-                        {'file_url': rev,
-                        'download_type': download_type}).get(
-                                        'copy_file_path') if rev else None
+            fwdpath, revpath = self._fetch_pair(
+                lambda url: dfu.download_web_file(
+                    {'file_url': url,
+                     'download_type': download_type}).get('copy_file_path'),
+                fwd, rev)
         elif reads_source == 'staging':
-            fwdpath = dfu.download_staging_file(
-                        {'staging_file_subdir_path': fwd}).get(
-                                        'copy_file_path')
-            revpath = dfu.download_staging_file(
-                        {'staging_file_subdir_path': rev}).get(
-                                        'copy_file_path') if rev else None
+            fwdpath, revpath = self._fetch_pair(
+                lambda subdir: dfu.download_staging_file(
+                    {'staging_file_subdir_path': subdir}).get('copy_file_path'),
+                fwd, rev)
         elif reads_source == 'local':
             fwdpath = fwd
             revpath = rev
@@ -775,7 +1704,9 @@ class ReadsUtils:
 
         return returnVal
 
-    def _generate_validation_error_message(self, reads_source, actualpath, file_info):
+    def _generate_validation_error_message(self, reads_source, actualpath, file_info,
+                                           error=None):
+        # error describes the first error found in the file, if it's known
         fwdpath = file_info.get('fwdpath')
         revpath = file_info.get('revpath')
         fwdname = file_info.get('fwdname')
@@ -814,6 +1745,8 @@ class ReadsUtils:
         else:
             raise ValueError(
                 f"Unexpected reads_source value. reads_source: {reads_source}")
+        if error:
+            validation_error_message += f" First error: {error}."
 
         return validation_error_message
 
@@ -826,6 +1759,27 @@ class ReadsUtils:
         self.scratch = config['scratch']
         self.callback_url = os.environ['SDK_CALLBACK_URL']
         self.ws_url = config['workspace-url']
+        self.shock_url = config['shock-url']
+        self.fastq_validator = config.get('fastq-validator') or self.FASTQ_EXE
+        self.fasta_validator = config.get('fasta-validator') or self.FASTA_JAR
+        self.validation_workers = int(config.get('validation-workers') or 0)
+        self.validation_fail_fast = config.get('validation-fail-fast') == self.TRUE
+        self.paired_validation = config.get('paired-validation') == self.TRUE
+        self.stats_engine = config.get('stats-engine')
+        self.download_stats = config.get('download-stats') == self.TRUE
+        self.upload_workers = int(config.get('upload-workers') or self.UPLOAD_WORKERS)
+        self.web_streaming = config.get('web-streaming') == self.TRUE
+        self.upload_retries = int(config.get('upload-retries') or self.UPLOAD_RETRIES)
+        self.checkpoint_dir = config.get('upload-checkpoint-dir')
+        self.duplicate_memory = int(config.get('duplicate-memory') or 0)
+        self.duplicate_counting = config.get('duplicate-counting')
+        self.validation_cache = None
+        cache_dir = config.get('validation-cache-dir') or os.path.join(
+            self.scratch, 'validation_cache')
+        if cache_dir != self.NO_VALIDATION_CACHE:
+            self.validation_cache = validation_cache.ValidationCache(
+                cache_dir, int(config.get('validation-cache-size') or 0),
+                config.get('validation-cache-full-hash') == self.TRUE)
         #END_CONSTRUCTOR
         pass
 
@@ -835,6 +1789,9 @@ class ReadsUtils:
         Validate a FASTQ file. The file extensions .fq, .fnq, and .fastq
         are accepted. Note that prior to validation the file will be altered in
         place to remove blank lines and CRLF characters if any exist.
+        gzip and bzip2 compressed files, which may also have a compression
+        extension such as .fastq.gz, are validated as they are decompressed
+        and are not altered.
         :param params: instance of list of type "ValidateFASTQParams" (Input
            to the validateFASTQ function. Required parameters: file_path -
            the path to the file to validate. Optional parameters: interleaved
@@ -855,53 +1812,26 @@ class ReadsUtils:
         #BEGIN validateFASTQ
         del ctx
         # TODO try and parse the validator output and return errors
-        out = []
+        # check every file before validating any, as validation may rewrite them
         for p in params:
-            file_path = p.get('file_path')
-            if not file_path or not os.path.isfile(file_path):
-                raise ValueError('No such file: ' + str(file_path))
-
-            if os.path.splitext(file_path)[1].lower() not in self.FASTQ_EXT:
-                raise ValueError(f'File {file_path} is not a FASTQ file')
-            self.log('Validating FASTQ file ' + file_path)
-            self.log('Checking line count')
-
-            c = 0
-            self.log('Removing blank lines and CRLF characters if any')
-            with open(file_path) as s, tempfile.NamedTemporaryFile(
-                    mode='w', dir=self.scratch) as t:
-                for l in s:
-                    l = l.strip()
-                    if l:
-                        t.write(l + '\n')
-                        c += 1
-                s.close()
-                t.flush()
-                shutil.copy2(t.name, file_path)
-            validated = 1
-            if p.get('interleaved') and c % 8 != 0:
-                err = f'Invalid FASTQ file, an interleaved FASTQ file is expected multiple of 8 lines, got {c}'
-                self.log(err)
-                validated = 0
-            elif c % 4 != 0:
-                err = f'Invalid FASTQ file, expected multiple of 4 lines, got {c}'
-                self.log(err)
-                validated = 0
-            else:
-                self.log(str(c) + ' lines in file')
-
-            if validated:
-                arguments = [self.FASTQ_EXE, '--file', file_path,
-                             '--maxErrors', '10',
-                             '--minReadLen', str((p.get('min_read_length') or self.MIN_READS_LENGTH))]
-                if p.get('interleaved'):
-                    arguments.append('--disableSeqIDCheck')
-                retcode = subprocess.call(arguments)
-                self.log('Validation return code: ' + str(retcode))
-                validated = 1 if retcode == 0 else 0
-                self.log('Validation ' +
-                         ('succeeded' if validated else 'failed'))
-            out.append({'validated': validated})
+            self._check_fastq_file(p.get('file_path'))
+        workers = self._validation_workers(len(params))
+        if len({os.path.realpath(p['file_path']) for p in params}) < len(params):
+            workers = 1  # a file listed twice mustn't be rewritten by two threads at once
+        # split the cores between the files being validated at once
+        file_workers = max(1, (os.cpu_count() or 1) // workers)
+
+        def validate(p):
+            return {'validated': self._validate_fastq(
+                p.get('file_path'), p.get('interleaved'), p.get('min_read_length'),
+                file_workers)}
+
+        if workers > 1:
+            self.log(f'Validating {len(params)} FASTQ files, {workers} at a time')
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                out = list(pool.map(validate, params))
+        else:
+            out = [validate(p) for p in params]
         #END validateFASTQ
 
         # At some point might do deeper type checking...
@@ -1044,81 +1974,15 @@ class ReadsUtils:
         # return variables are: returnVal
         #BEGIN upload_reads
         self.log('Starting upload reads, parsing args')
-        o, wsid, name, objid, kbtype, single_end, fwdsource, revsource, reads_source = (
-                                                    self._proc_upload_reads_params(params))
-        # If reads_source == 'shock', fwdsource and revsource are shock nodes
-        # If reads_source == 'web', fwdsource and revsource are urls
-        # If reads_source == 'staging', fwdsource and revsource are file name/subdirectory
-        #                               in staging area
-        # If reads_source == 'local', fwdsource and revsource are file paths
         dfu = DataFileUtil(self.callback_url)
-        fwdname, revname, fwdid, revid = (None,) * 4
-        ret = self._process_download(fwdsource, revsource, reads_source,
-                                     params.get('download_type'), ctx['user_id'])
-        fwdpath = ret.get('fwdpath')
-        revpath = ret.get('revpath')
-
-        if reads_source == 'shock':
-            fwdname = ret.get('fwdname')
-            revname = ret.get('revname')
-            fwdid = fwdsource
-            revid = revsource
-
-        actualpath = fwdpath
-        if revpath:
-            # now interleave the files
-            actualpath = os.path.join(
-                self.scratch, self.get_file_prefix() + '.inter.fastq')
-            self.interleave(None, None, fwdname, fwdid,
-                            revname, revid, fwdpath, revpath, actualpath,
-                            reads_source, fwdsource, revsource)
-
-        interleaved = 1 if not single_end else 0
-        file_valid = self.validateFASTQ({}, [{'file_path': actualpath,
-                                              'interleaved': interleaved,
-                                              'min_read_length': params.get('min_read_length', self.MIN_READS_LENGTH)}])
-
-        if not file_valid[0][0]['validated']:
-            file_info = ret
-            file_info['fwdsource'] = fwdsource
-            file_info['revsource'] = revsource
-            validation_error_message = self._generate_validation_error_message(
-                reads_source, actualpath, file_info)
-            raise ValueError(validation_error_message)
-
-        self.log('validation complete, uploading files to shock')
-        uploadedfile = dfu.file_to_shock({'file_path': actualpath,
-                                          'make_handle': 1,
-                                          'pack': 'gzip'})
-        fhandle = uploadedfile['handle']
-        fsize = uploadedfile['size']
-
-        # calculate the stats for file.
-        o = self.get_fq_stats(o, actualpath)
-
-        fwdfile = {'file': fhandle,
-                   'encoding': 'ascii',
-                   'size': fsize,
-                   'type': 'fq'
-                   }
-        if single_end:
-            o['lib'] = fwdfile
-        else:
-            o['lib1'] = fwdfile
-
-        so = {'type': kbtype,
-              'data': o
-              }
-        if name:
-            so['name'] = name
-        else:
-            so['objid'] = objid
+        wsid, so = self._prepare_reads_object(params, ctx['user_id'], ctx['token'], dfu)
         self.log('saving workspace object')
 
         oi = dfu.save_objects({'id': wsid, 'objects': [so]})[0]
         self.log('save complete')
+        self._job_manifest(params, ctx['user_id']).remove()
 
-        returnVal = {'obj_ref': f"{oi[6]}/{oi[0]}/{oi[4]}"}
+        returnVal = {'obj_ref': self.make_ref(oi)}
         #END upload_reads
 
         # At some point might do deeper type checking...
@@ -1128,6 +1992,59 @@ class ReadsUtils:
         # return the results
         return [returnVal]
 
+    def upload_reads_mass(self, ctx, params):
+        """
+        Loads many sets of reads to KBase data stores. The reads are
+        processed concurrently, each workspace name is looked up once, and the
+        objects are saved in batches. A failure to upload one set of reads
+        does not stop the others.
+        :param params: instance of list of type "UploadReadsParams" (Input to
+           the upload_reads function, as described there.)
+        :returns: instance of list of type "UploadReadsMassOutput" (The
+           output of the upload_reads_mass function for one set of reads, in
+           the same order as the input. obj_ref - a reference to the new
+           Workspace object in the form X/Y/Z, where X is the workspace ID, Y
+           is the object ID, and Z is the version, or null if the upload
+           failed. error - the reason the upload failed, or null if it
+           succeeded.) -> structure: parameter "obj_ref" of String, parameter
+           "error" of String
+        """
+        # ctx is the context object
+        # return variables are: returnVal
+        #BEGIN upload_reads_mass
+        if not isinstance(params, list):
+            raise ValueError('The parameters must be a list')
+        self.log(f'Starting upload of {len(params)} reads libraries')
+        dfu = DataFileUtil(self.callback_url)
+        ws_ids = self._resolve_workspace_names(dfu, params)
+        out = [{'obj_ref': None, 'error': None} for _ in params]
+
+        def prepare(index):
+            try:
+                return self._prepare_reads_object(
+                    params[index], ctx['user_id'], ctx['token'], dfu, ws_ids)
+            except Exception as e:
+                self.log(f'Upload {index} failed: {e}')
+                out[index]['error'] = str(e)
+                return None
+
+        workers = max(1, min(self.upload_workers, len(params)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            prepared = list(pool.map(prepare, range(len(params))))
+        self._save_reads_objects(dfu, prepared, out)
+        for p, o in zip(params, out):
+            if o['obj_ref']:
+                self._job_manifest(p, ctx['user_id']).remove()
+        returnVal = out
+        #END upload_reads_mass
+
+        # At some point might do deeper type checking...
+        if not isinstance(returnVal, list):
+            raise ValueError('Method upload_reads_mass return value ' +
+                             'returnVal is not type list as required.')
+        # return the results
+        return [returnVal]
+
     def download_reads(self, ctx, params):
         """
         Download read libraries. Reads compressed with gzip or bzip are
@@ -1138,13 +2055,20 @@ class ReadsUtils:
            download. tern interleaved - if true, provide the files in
            interleaved format if they are not already. If false, provide
            forward and reverse reads files. If null or missing, leave files
-           as is.) -> structure: parameter "read_libraries" of list of type
+           as is. boolean write_index - if true, write a sidecar record index next
+           to each reads file, at the file path with .fqi appended. The index
+           holds the byte offset of every 4096th record, the record count and
+           the total number of bases, so the file can be split into record
+           aligned chunks without scanning it. Defaults to false.) ->
+           structure: parameter "read_libraries" of list of type
            "read_lib" (A reference to a read library stored in the workspace
            service, whether of the KBaseAssembly or KBaseFile type. Usage of
            absolute references (e.g. 256/3/6) is strongly encouraged to avoid
            race conditions, although any valid reference is allowed.),
            parameter "interleaved" of type "tern" (A ternary. Allowed values
-           are 'false', 'true', or null. Any other value is invalid.)
+           are 'false', 'true', or null. Any other value is invalid.),
+           parameter "write_index" of type "boolean" (A boolean - 0 for
+           false, 1 for true. @range (0, 1))
         :returns: instance of type "DownloadReadsOutput" (The output of the
            download method. mapping<read_lib, DownloadedReadLibrary> files -
            a mapping of the read library workspace references to information
@@ -1293,7 +2217,7 @@ class ReadsUtils:
             self.log('=== processing read library ' + read_name + '===\n',
                      prefix_newline=True)
             output[read_name] = self.process_reads(
-                read, params[self.PARAM_IN_INTERLEAVED])
+                read, params[self.PARAM_IN_INTERLEAVED], params.get(self.PARAM_IN_INDEX))
         output = {'files': output}
         #END download_reads
 
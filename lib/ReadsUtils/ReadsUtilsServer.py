@@ -346,6 +346,10 @@ class Application(object):
                              name='ReadsUtils.upload_reads',
                              types=[dict])
         self.method_authentication['ReadsUtils.upload_reads'] = 'required'  # noqa
+        self.rpc_service.add(impl_ReadsUtils.upload_reads_mass,
+                             name='ReadsUtils.upload_reads_mass',
+                             types=[list])
+        self.method_authentication['ReadsUtils.upload_reads_mass'] = 'required'  # noqa
         self.rpc_service.add(impl_ReadsUtils.download_reads,
                              name='ReadsUtils.download_reads',
                              types=[dict])
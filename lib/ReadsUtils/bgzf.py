@@ -0,0 +1,277 @@
+'''
+Multithreaded BGZF compression and decompression.
+
+BGZF, as used by samtools and htslib, is gzip made of a series of independently compressed
+gzip members, each holding at most BLOCK_DATA_SIZE bytes of data and recording its own
+compressed size in a header extra field. Any gzip reader can decompress it, the members can be
+compressed and decompressed in parallel, and readers that understand the format can seek to any
+member.
+'''
+
+import gzip
+import io
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_DATA_SIZE = 0xff00  # the maximum data per member, as per htslib
+CHUNK_SIZE = 16 * BLOCK_DATA_SIZE  # the data compressed per task
+# the empty member that marks the end of a BGZF file
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# magic, deflate, FEXTRA flag, mtime, xfl, unknown OS, extra length, BC subfield of length 2
+_HEADER = struct.Struct('<BBBBIBBHBBHH')
+_TRAILER = struct.Struct('<II')
+# the header fields, other than the modification time, extra flags, OS and block size, that
+# every BGZF member starts with
+_MAGIC = b'\x1f\x8b\x08\x04'
+_EXTRA = b'\x06\x00BC\x02\x00'
+
+
+def compress_block(data, level):
+    ''' Compress up to BLOCK_DATA_SIZE bytes of data into a single BGZF member. '''
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = c.compress(data) + c.flush()
+    size = _HEADER.size + len(deflated) + _TRAILER.size
+    return b''.join([_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2,
+                                  size - 1),
+                     deflated,
+                     _TRAILER.pack(zlib.crc32(data), len(data))])
+
+
+def compress_chunk(data, level):
+    ''' Compress data of any size into a series of BGZF members. '''
+    return b''.join([compress_block(data[i:i + BLOCK_DATA_SIZE], level)
+                     for i in range(0, len(data), BLOCK_DATA_SIZE)])
+
+
+class BGZFWriter(object):
+    '''
+    Writes BGZF to a file, compressing chunks of data in a pool of threads. zlib releases the
+    GIL while compressing, so the threads run in parallel. Use as a context manager or call
+    close() to write the remaining data and the end of file marker. If the context manager
+    exits with an exception the file is left incomplete.
+    '''
+
+    def __init__(self, path, level=6, threads=None):
+        self._file = open(path, 'wb')
+        self._level = level
+        self._threads = threads or os.cpu_count() or 1
+        self._pool = ThreadPoolExecutor(max_workers=self._threads)
+        self._pending = deque()
+        self._buf = bytearray()
+
+    def write(self, data):
+        self._buf += data
+        if len(self._buf) >= CHUNK_SIZE:
+            whole = len(self._buf) - len(self._buf) % CHUNK_SIZE
+            chunk = bytes(self._buf[:whole])
+            del self._buf[:whole]
+            for i in range(0, whole, CHUNK_SIZE):
+                self._submit(chunk[i:i + CHUNK_SIZE])
+
+    def _submit(self, data):
+        # keep enough work queued to keep every thread busy, but no more, so memory is bounded
+        while len(self._pending) >= 2 * self._threads:
+            self._file.write(self._pending.popleft().result())
+        self._pending.append(self._pool.submit(compress_chunk, data, self._level))
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            if self._buf:
+                self._submit(bytes(self._buf))
+                self._buf = bytearray()
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+            self._file.write(EOF_BLOCK)
+        finally:
+            self._pool.shutdown()
+            self._file.close()
+
+    def abort(self):
+        ''' Close the file without compressing any more data or writing the end of file marker. '''
+        if self._file.closed:
+            return
+        for f in self._pending:
+            f.cancel()
+        self._pending.clear()
+        self._buf = bytearray()
+        self._pool.shutdown()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _is_member_header(header):
+    return header[:4] == _MAGIC and header[10:16] == _EXTRA
+
+
+def is_bgzf(path):
+    ''' Whether the file at path starts with a BGZF member. '''
+    with open(path, 'rb') as f:
+        return _is_member_header(f.read(_HEADER.size))
+
+
+def decompress_members(data):
+    '''
+    Decompress data made of whole BGZF members, checking the CRC and size of each. Throws a
+    gzip.BadGzipFile if a member is corrupt.
+    '''
+    out = []
+    offset = 0
+    while offset < len(data):
+        size = _HEADER.unpack_from(data, offset)[-1] + 1
+        member = data[offset:offset + size]
+        if len(member) < size:
+            raise gzip.BadGzipFile('Truncated BGZF member')
+        inflated = zlib.decompress(member[_HEADER.size:-_TRAILER.size], -zlib.MAX_WBITS)
+        crc, length = _TRAILER.unpack_from(member, size - _TRAILER.size)
+        if zlib.crc32(inflated) != crc or len(inflated) != length:
+            raise gzip.BadGzipFile('CRC check failed for a BGZF member')
+        out.append(inflated)
+        offset += size
+    return b''.join(out)
+
+
+def member_offsets(path):
+    '''
+    The offsets of the members of the BGZF file at path, followed by the size of the file, or
+    None if any of the file isn't BGZF or its last member is truncated. Only the member headers
+    are read.
+    '''
+    offsets = []
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        pos = 0
+        while pos < size:
+            f.seek(pos)
+            header = f.read(_HEADER.size)
+            if not _is_member_header(header):
+                return None
+            offsets.append(pos)
+            pos += _HEADER.unpack(header)[-1] + 1
+    if pos != size:
+        return None
+    offsets.append(size)
+    return offsets
+
+
+def decompress_range(path, start=0, end=None):
+    '''
+    Yield the decompressed data of the members of the BGZF file at path from offset start,
+    which must be the start of a member, up to offset end or the end of the file, about
+    CHUNK_SIZE bytes of members at a time. Throws a gzip.BadGzipFile if the data isn't BGZF or
+    a member is corrupt.
+    '''
+    with open(path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        chunk = []
+        size = 0
+        while end is None or pos < end:
+            header = f.read(_HEADER.size)
+            if not header:
+                break
+            if not _is_member_header(header):
+                raise gzip.BadGzipFile('Not a BGZF member')
+            body = f.read(_HEADER.unpack(header)[-1] + 1 - _HEADER.size)
+            chunk += [header, body]
+            size += len(header) + len(body)
+            pos += len(header) + len(body)
+            if size >= CHUNK_SIZE:
+                yield decompress_members(b''.join(chunk))
+                chunk, size = [], 0
+        if chunk:
+            yield decompress_members(b''.join(chunk))
+
+
+class BGZFReader(io.RawIOBase):
+    '''
+    Reads a BGZF file, decompressing chunks of members in a pool of threads. zlib releases the
+    GIL while decompressing, so the threads run in parallel. If part of the file isn't BGZF,
+    for instance because another gzip file was appended to it, the rest of the file is
+    decompressed in a single stream.
+    '''
+
+    def __init__(self, path, threads=None):
+        self._file = open(path, 'rb')
+        self._threads = threads or os.cpu_count() or 1
+        self._pool = ThreadPoolExecutor(max_workers=self._threads)
+        self._pending = deque()
+        self._buf = b''
+        self._pos = 0
+        self._tail = None  # the stream the rest of the file is read from, if it isn't BGZF
+        self._members_done = False
+
+    def readable(self):
+        return True
+
+    def _read_members(self):
+        # reads about CHUNK_SIZE bytes of whole members from the file
+        chunk = []
+        size = 0
+        while size < CHUNK_SIZE:
+            start = self._file.tell()
+            header = self._file.read(_HEADER.size)
+            if not header or not _is_member_header(header):
+                if header:
+                    self._file.seek(start)
+                    self._tail = gzip.GzipFile(fileobj=self._file, mode='rb')
+                self._members_done = True
+                break
+            body = self._file.read(_HEADER.unpack(header)[-1] + 1 - _HEADER.size)
+            chunk += [header, body]
+            size += len(header) + len(body)
+        return b''.join(chunk)
+
+    def _next_chunk(self):
+        # returns the next decompressed data, or None at the end of the file. Enough work is
+        # queued to keep every thread busy, but no more, so memory is bounded
+        while not self._members_done and len(self._pending) < 2 * self._threads:
+            members = self._read_members()
+            if members:
+                self._pending.append(self._pool.submit(decompress_members, members))
+        if self._pending:
+            return self._pending.popleft().result()
+        if self._tail:
+            return self._tail.read(CHUNK_SIZE) or None
+        return None
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(CHUNK_SIZE), b''))
+        while self._pos == len(self._buf):
+            chunk = self._next_chunk()
+            if chunk is None:
+                return b''
+            self._buf, self._pos = chunk, 0
+        data = self._buf[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            for f in self._pending:
+                f.cancel()
+            self._pending.clear()
+            self._pool.shutdown()
+            if self._tail:
+                self._tail.close()
+            self._file.close()
+        super().close()
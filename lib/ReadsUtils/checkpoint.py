@@ -0,0 +1,123 @@
+'''
+Job manifests that record the completed stages of a reads upload, so an upload retried with the
+same parameters after a failure, such as a timeout uploading to Shock, resumes from the last
+good stage rather than downloading, validating and compressing the reads again.
+
+Each manifest is a small JSON file named for a hash of the job parameters. A stage records its
+outputs, a fingerprint of the input reads it was made from, and the fingerprints - size,
+modification time and inode - of the files it wrote. A stage is only resumed from if the input
+reads and its files are unchanged, and every stage recorded before it can be resumed from too,
+so replacing the input files and retrying starts again.
+'''
+
+import hashlib
+import json
+import os
+import tempfile
+
+_MANIFEST_EXT = '.json'
+_READ_SIZE = 1024 * 1024
+
+
+def file_fingerprint(path):
+    ''' A fingerprint of the file at path that changes if the file is changed or replaced. '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f'{st.st_size}-{st.st_mtime_ns}-{st.st_ino}'
+
+
+def content_fingerprint(path):
+    '''
+    A hash of the contents of the file at path, for files that are fetched again, and so
+    written again, on each attempt.
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_READ_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class JobManifest(object):
+    '''
+    The manifest of the job with params, a JSON serializable dict, stored in directory, which is
+    created when needed. If directory is None nothing is recorded.
+    '''
+
+    def __init__(self, directory, params):
+        self._stages = {}  # in the order they were recorded
+        self._inputs = None
+        self._path = None
+        if directory:
+            key = json.dumps(params, sort_keys=True, default=str)
+            self._path = os.path.join(
+                directory, hashlib.sha256(key.encode()).hexdigest() + _MANIFEST_EXT)
+            try:
+                with open(self._path) as f:
+                    self._stages = json.load(f)['stages']
+            except (OSError, ValueError, KeyError):
+                pass  # a new job, or a manifest that was being replaced
+
+    @property
+    def enabled(self):
+        ''' Whether stages are recorded. '''
+        return self._path is not None
+
+    def set_inputs(self, fingerprint):
+        '''
+        Set the JSON serializable fingerprint of the input reads. Stages recorded with different
+        input reads can't be resumed from.
+        '''
+        self._inputs = fingerprint
+
+    def _valid(self, entry):
+        if entry['inputs'] != self._inputs:
+            return False
+        return all(file_fingerprint(path) == fingerprint
+                   for path, fingerprint in entry['files'].items())
+
+    def get(self, stage):
+        '''
+        Get the outputs recorded for stage, or None if it hasn't completed, or it or a stage
+        recorded before it was made from different input reads or its files have changed.
+        '''
+        if stage not in self._stages:
+            return None
+        for name, entry in self._stages.items():
+            if not self._valid(entry):
+                return None
+            if name == stage:
+                return entry['outputs']
+
+    def record(self, stage, outputs, files=()):
+        '''
+        Record that stage completed with outputs, a JSON serializable value, from the current
+        input reads, having written the files at the paths in files.
+        '''
+        if not self._path:
+            return
+        if stage in self._stages:
+            # the stage was done again, so the stages after it were made from old outputs
+            names = list(self._stages)
+            for name in names[names.index(stage):]:
+                del self._stages[name]
+        self._stages[stage] = {'outputs': outputs,
+                               'inputs': self._inputs,
+                               'files': {f: file_fingerprint(f) for f in files if f}}
+        directory = os.path.dirname(self._path)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                mode='w', dir=directory, suffix='.tmp', delete=False) as t:
+            json.dump({'stages': self._stages}, t)
+        os.replace(t.name, self._path)
+
+    def remove(self):
+        ''' Remove the manifest once the job is finished, or can't be resumed. '''
+        self._stages = {}
+        if self._path:
+            try:
+                os.remove(self._path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,233 @@
+'''
+Memory bounded counting of distinct reads.
+
+Reads are reduced to 64 bit fingerprints held in NumPy arrays. When the fingerprints held in
+memory exceed the memory limit they're sorted, deduplicated and spilled to a run file, and the
+number of distinct fingerprints is found with an external merge of the runs, so memory use does
+not grow with the size of the library. The chance of two distinct reads in a library of n reads
+having the same fingerprint is about n^2 / 2^65, and a collision undercounts by one.
+
+Alternatively the count can be estimated with a HyperLogLog sketch, which uses a fixed 16KB and
+no disk, with a standard error of about 0.8%.
+'''
+
+import math
+import os
+import tempfile
+
+import numpy
+
+MEMORY_LIMIT = 256 * 1024 * 1024  # the default memory for buffered fingerprints, in bytes
+HLL_PRECISION = 14  # 2^14 registers
+_MIN_MERGE_CHUNK = 64 * 1024  # the minimum number of fingerprints read from a run at once
+_RUN_EXT = '.run'
+
+_FNV_OFFSET = numpy.uint64(0xcbf29ce484222325)
+_FNV_PRIME = numpy.uint64(0x100000001b3)
+_MIX1 = numpy.uint64(0xbf58476d1ce4e5b9)
+_MIX2 = numpy.uint64(0x94d049bb133111eb)
+
+
+def fingerprints(rows):
+    '''
+    Hash each row of a 2 dimensional uint8 array, e.g. the first bases of a set of reads padded
+    with zeros, to a 64 bit fingerprint. Returns a uint64 array.
+    '''
+    count, width = rows.shape
+    padded = numpy.zeros((count, -(-width // 8) * 8), dtype=numpy.uint8)
+    padded[:, :width] = rows
+    words = padded.view(numpy.uint64)
+    h = numpy.full(count, _FNV_OFFSET, dtype=numpy.uint64)
+    for i in range(words.shape[1]):
+        h ^= words[:, i]
+        h *= _FNV_PRIME
+    # the splitmix64 finalizer spreads the bits of the last word into the high bits
+    h ^= h >> numpy.uint64(30)
+    h *= _MIX1
+    h ^= h >> numpy.uint64(27)
+    h *= _MIX2
+    h ^= h >> numpy.uint64(31)
+    return h
+
+
+class DuplicateCounter(object):
+    '''
+    Counts the distinct 64 bit fingerprints added to it, buffering up to memory_limit bytes
+    of them and spilling sorted runs to temporary files in spill_dir, the system temporary
+    directory by default. If approximate is true the count is estimated with a HyperLogLog
+    sketch instead.
+
+    If keep_repeated is true the fingerprints added more than once are kept too, up to another
+    memory_limit bytes of them, so the items they were made from can be checked for collisions.
+
+    Counters can be merged, e.g. after counting parts of a file in separate processes. Call
+    close() to remove any spilled runs.
+    '''
+
+    def __init__(self, memory_limit=None, spill_dir=None, approximate=False,
+                 keep_repeated=False):
+        # keep at least two fingerprints so a full buffer always shrinks when spilled
+        self._limit = max(2, (memory_limit or MEMORY_LIMIT) // 8)
+        self._spill_dir = spill_dir
+        self._registers = None
+        if approximate:
+            self._registers = numpy.zeros(1 << HLL_PRECISION, dtype=numpy.uint8)
+        self._buffer = []  # arrays of fingerprints
+        self._buffered = 0
+        self._runs = []  # paths of files of sorted, distinct fingerprints
+        # arrays of repeated fingerprints, or None if they're not kept or there were too many
+        self._repeated = [] if keep_repeated and not approximate else None
+        self._repeated_count = 0
+
+    def add(self, prints):
+        ''' Add a uint64 array of fingerprints. '''
+        if self._registers is not None:
+            _hll_add(self._registers, prints)
+            return
+        self._buffer.append(prints)
+        self._buffered += len(prints)
+        if self._buffered > self._limit:
+            self._compact_buffer()
+
+    def _unique(self, prints):
+        # the distinct fingerprints in prints, noting those that are repeated
+        if self._repeated is None:
+            return numpy.unique(prints)
+        unique, counts = numpy.unique(prints, return_counts=True)
+        self._add_repeated(unique[counts > 1])
+        return unique
+
+    def _add_repeated(self, repeated):
+        if self._repeated is None or not len(repeated):
+            return
+        self._repeated.append(repeated)
+        self._repeated_count += len(repeated)
+        if self._repeated_count > self._limit:
+            # a fingerprint can be noted as repeated more than once, e.g. in each compaction
+            unique = numpy.unique(numpy.concatenate(self._repeated))
+            self._repeated, self._repeated_count = [unique], len(unique)
+            if len(unique) > self._limit:
+                self._repeated = None
+
+    def _compact_buffer(self):
+        # deduplicate the buffer, and spill it if it's still more than half full
+        unique = self._unique(numpy.concatenate(self._buffer))
+        self._buffer, self._buffered = [unique], len(unique)
+        if len(unique) > self._limit // 2:
+            self._spill(unique)
+            self._buffer, self._buffered = [], 0
+
+    def _spill(self, unique):
+        with tempfile.NamedTemporaryFile(
+                dir=self._spill_dir, prefix='duplicates_', suffix=_RUN_EXT, delete=False) as f:
+            unique.tofile(f)
+        self._runs.append(f.name)
+
+    def merge(self, other):
+        '''
+        Add the fingerprints counted by another DuplicateCounter made with the same settings,
+        which takes over its spilled runs. Returns this object.
+        '''
+        if self._registers is not None:
+            numpy.maximum(self._registers, other._registers, out=self._registers)
+            return self
+        self._runs.extend(other._runs)
+        other._runs = []
+        if other._repeated is None:
+            self._repeated = None
+        for repeated in other._repeated or []:
+            self._add_repeated(repeated)
+        for prints in other._buffer:
+            self.add(prints)
+        return self
+
+    def count(self):
+        ''' The number of distinct fingerprints added. '''
+        if self._registers is not None:
+            return _hll_estimate(self._registers)
+        if not self._runs:
+            if not self._buffer:
+                return 0
+            self._buffer = [self._unique(numpy.concatenate(self._buffer))]
+            self._buffered = len(self._buffer[0])
+            return self._buffered
+        if self._buffer:
+            self._spill(self._unique(numpy.concatenate(self._buffer)))
+            self._buffer, self._buffered = [], 0
+        if len(self._runs) > 1:
+            self._merge_runs()
+        return os.path.getsize(self._runs[0]) // 8
+
+    def _merge_runs(self):
+        # merges the runs into a single run of distinct fingerprints, a chunk of each run at a
+        # time. Every fingerprint up to the smallest of the last fingerprints in the chunks has
+        # been read, so those are written out and the rest kept for the next round. Each run is
+        # distinct, so a fingerprint equal to that bound can't appear again.
+        chunk = max(_MIN_MERGE_CHUNK, self._limit // len(self._runs))
+        files = [open(r, 'rb') for r in self._runs]
+        try:
+            with tempfile.NamedTemporaryFile(
+                    dir=self._spill_dir, prefix='duplicates_', suffix=_RUN_EXT,
+                    delete=False) as out:
+                pending = [numpy.fromfile(f, dtype=numpy.uint64, count=chunk) for f in files]
+                while True:
+                    live = [i for i, p in enumerate(pending) if len(p)]
+                    if not live:
+                        break
+                    bound = min(pending[i][-1] for i in live)
+                    taken = []
+                    for i in live:
+                        cut = numpy.searchsorted(pending[i], bound, side='right')
+                        taken.append(pending[i][:cut])
+                        pending[i] = pending[i][cut:]
+                        if not len(pending[i]):
+                            pending[i] = numpy.fromfile(files[i], dtype=numpy.uint64,
+                                                        count=chunk)
+                    self._unique(numpy.concatenate(taken)).tofile(out)
+        finally:
+            for f in files:
+                f.close()
+        self.close()
+        self._runs = [out.name]
+
+    def repeated(self):
+        '''
+        The fingerprints added more than once, as a sorted uint64 array, or None if the counter
+        wasn't made with keep_repeated or there were too many of them to keep.
+        '''
+        self.count()  # fingerprints repeated across runs are found as the runs are merged
+        if self._repeated is None:
+            return None
+        if not self._repeated:
+            return numpy.array([], dtype=numpy.uint64)
+        return numpy.unique(numpy.concatenate(self._repeated))
+
+    def close(self):
+        ''' Remove any spilled runs. '''
+        for r in self._runs:
+            try:
+                os.remove(r)
+            except FileNotFoundError:
+                pass
+        self._runs = []
+
+
+def _hll_add(registers, prints):
+    # the top bits of each fingerprint select a register, which keeps the largest position of
+    # the first set bit in the remaining bits seen
+    bits = 64 - HLL_PRECISION
+    index = (prints >> numpy.uint64(bits)).astype(numpy.intp)
+    rest = prints & numpy.uint64((1 << bits) - 1)
+    # the remaining bits fit exactly in a double, so frexp gives their bit length
+    rank = (bits + 1 - numpy.frexp(rest.astype(numpy.float64))[1]).astype(numpy.uint8)
+    numpy.maximum.at(registers, index, rank)
+
+
+def _hll_estimate(registers):
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / float(numpy.sum(numpy.ldexp(1.0, -registers.astype(int))))
+    zeros = int(numpy.count_nonzero(registers == 0))
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * math.log(m / zeros)  # linear counting is more accurate for small counts
+    return int(round(estimate))
@@ -0,0 +1,125 @@
+'''
+An in process FASTA validator.
+
+Makes the same kinds of checks as the FastaValidator jar's FVTester: the file must start with a
+header line, every header line must start with > followed by an identifier and be followed by
+at least one line of sequence, and sequence lines may only contain IUPAC nucleotide and amino
+acid codes, gaps (-) and stop codons (*). Blank lines and trailing whitespace, including CR
+characters, are ignored.
+
+Files are read in large blocks that are checked with vectorized operations, so there's no JVM
+to start for each file.
+'''
+
+import numpy
+
+from ReadsUtils import fastq_io
+
+MAX_ERRORS = 10  # the number of errors to report
+
+_HEADER = ord('>')
+_SEQ_OK = numpy.zeros(256, dtype=bool)
+_SEQ_OK[ord('A'):ord('Z') + 1] = True
+_SEQ_OK[ord('a'):ord('z') + 1] = True
+_SEQ_OK[list(b'*-\n')] = True
+_SEQ_OK[fastq_io._WHITESPACE] = True
+
+
+class FASTAValidator(object):
+    '''
+    Validates a stream of FASTA data given a block of whole, newline terminated lines at a time.
+    '''
+
+    def __init__(self):
+        self._offset = 0
+        self._started = False  # whether any non blank lines have been seen
+        self._open_header = None  # the offset of the last header if no sequence followed it yet
+        self._errors = []
+        self._error_count = 0
+
+    def _error(self, errors):
+        self._error_count += len(errors)
+        self._errors.extend(sorted(errors)[:MAX_ERRORS - len(self._errors)])
+
+    def add(self, block):
+        ''' Check the next block of data. '''
+        arr = numpy.frombuffer(block, dtype=numpy.uint8)
+        ends = numpy.flatnonzero(arr == fastq_io.NEWLINE)
+        starts = numpy.concatenate(([0], ends[:-1] + 1))
+        lengths = ends - starts
+        first = arr[starts]
+        blank = lengths == 0
+        # lines that start with whitespace are rare, so are checked one at a time
+        for i in numpy.flatnonzero(fastq_io._WHITESPACE[first]):
+            blank[i] = not block[starts[i]:ends[i]].strip()
+        header = first == _HEADER
+
+        errors = []
+        seq_line = numpy.repeat(~header & ~blank, lengths + 1)
+        bad = numpy.flatnonzero(seq_line & ~_SEQ_OK[arr])
+        bad_lines = numpy.unique(numpy.searchsorted(ends, bad))
+        errors.extend((int(starts[i]), 'Invalid sequence character') for i in bad_lines)
+        no_id = header & ((lengths < 2) | fastq_io._WHITESPACE[
+            arr[numpy.minimum(starts + 1, len(arr) - 1)]])
+        errors.extend((int(o), 'The header line has no identifier') for o in starts[no_id])
+
+        solid = numpy.flatnonzero(~blank)
+        if len(solid):
+            solid_header = header[solid]
+            if not self._started and not solid_header[0]:
+                errors.append((int(starts[solid[0]]), 'The file does not start with a header'))
+            self._started = True
+            if self._open_header is not None and solid_header[0]:
+                errors.append((self._open_header - self._offset, 'The sequence is missing'))
+            # headers followed by another header
+            missing = solid[:-1][solid_header[:-1] & solid_header[1:]]
+            errors.extend((int(o), 'The sequence is missing') for o in starts[missing])
+            self._open_header = (int(starts[solid[-1]]) + self._offset
+                                 if solid_header[-1] else None)
+        self._error([(o + self._offset, m) for o, m in errors])
+        self._offset += len(block)
+
+    def result(self):
+        '''
+        Returns the total number of errors and a list of up to MAX_ERRORS (offset, message)
+        tuples describing the first errors.
+        '''
+        count, errors = self._error_count, list(self._errors)
+        if not self._started:
+            count += 1
+            errors.append((0, 'The file contains no sequences'))
+        elif self._open_header is not None:
+            count += 1
+            errors.append((self._open_header, 'The sequence is missing'))
+        return count, errors[:MAX_ERRORS]
+
+
+def line_blocks(stream, block_size=None):
+    ''' Yield the contents of a binary stream as large blocks of whole, newline ended lines. '''
+    block_size = block_size or fastq_io.BLOCK_SIZE
+    buf = b''
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            if buf:
+                yield buf if buf.endswith(b'\n') else buf + b'\n'
+            return
+        buf += block
+        cut = buf.rfind(b'\n') + 1
+        if cut:
+            yield buf[:cut]
+            buf = buf[cut:]
+
+
+def validate_file(path, block_size=None):
+    '''
+    Validate the FASTA file at path, which may be gzip or bzip2 compressed.
+
+    Returns the total number of errors and a list of up to MAX_ERRORS (offset, message)
+    tuples describing the first errors.
+    '''
+    v = FASTAValidator()
+    with fastq_io.open_reads(path) as f:
+        for block in line_blocks(f, block_size):
+            v.add(block)
+    return v.result()
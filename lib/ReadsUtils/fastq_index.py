@@ -0,0 +1,152 @@
+'''
+Sidecar record indexes for FASTQ files.
+
+An index records the byte offset of every INTERVAL'th record in an uncompressed FASTQ file,
+along with the record count and total number of bases, so that the file can be split into
+record aligned byte ranges without scanning it. The index for a file is stored next to it, at
+the file path with INDEX_EXT appended.
+'''
+
+import json
+import os
+
+import numpy
+
+from ReadsUtils import fastq_io
+
+INDEX_EXT = '.fqi'
+INTERVAL = 4096  # records per index entry
+VERSION = 1
+
+
+class FASTQIndex(object):
+    '''
+    A FASTQ record index.
+
+    offsets - the byte offsets of records 0, interval, 2 * interval, and so on.
+    interval - the number of records between each offset.
+    record_count - the number of whole records in the file.
+    total_bases - the total number of bases in the whole records.
+    size - the size of the file in bytes.
+    '''
+
+    def __init__(self, offsets, interval, record_count, total_bases, size):
+        self.offsets = offsets
+        self.interval = interval
+        self.record_count = record_count
+        self.total_bases = total_bases
+        self.size = size
+
+    def ranges(self, count):
+        '''
+        Split the file into at most count record aligned byte ranges with as close to equal
+        numbers of records as the index interval allows.
+
+        Returns a list of (start, end) tuples, where end is exclusive. Adjacent ranges share
+        their end and start, and the last range ends at the end of the file.
+        '''
+        if count < 1:
+            raise ValueError('count must be at least 1')
+        starts = [0]
+        for i in range(1, count):
+            entry = round(self.record_count * i / count / self.interval)
+            if 0 < entry < len(self.offsets) and self.offsets[entry] > starts[-1]:
+                starts.append(self.offsets[entry])
+        return list(zip(starts, starts[1:] + [self.size]))
+
+    def save(self, path):
+        ''' Write the index as JSON to path. '''
+        with open(path, 'w') as f:
+            json.dump({'version': VERSION,
+                       'interval': self.interval,
+                       'record_count': self.record_count,
+                       'total_bases': self.total_bases,
+                       'size': self.size,
+                       'offsets': self.offsets
+                       }, f)
+
+    @classmethod
+    def load(cls, path):
+        ''' Read an index written by save(). '''
+        with open(path) as f:
+            i = json.load(f)
+        if i.get('version') != VERSION:
+            raise ValueError(f'Unsupported FASTQ index version in {path}: {i.get("version")}')
+        return cls(i['offsets'], i['interval'], i['record_count'], i['total_bases'], i['size'])
+
+
+def build_index(path, interval=None, block_size=None):
+    '''
+    Scan the uncompressed FASTQ file at path and return a FASTQIndex for it. Blank lines are
+    skipped, so offsets are correct for files that have not been cleaned up.
+    '''
+    interval = interval or INTERVAL
+    block_size = block_size or fastq_io.BLOCK_SIZE
+    offsets = []
+    lines = 0  # non-blank lines seen so far
+    bases = 0
+    last_seq = 0  # the length of the last sequence line seen
+    pos = 0  # the file offset of the start of buf
+    buf = b''
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        while True:
+            block = f.read(block_size)
+            buf += block
+            if not block and buf and not buf.endswith(b'\n'):
+                buf += b'\n'
+            arr = numpy.frombuffer(buf, dtype=numpy.uint8)
+            newlines = numpy.flatnonzero(arr == fastq_io.NEWLINE)
+            if len(newlines):
+                starts = numpy.concatenate(([0], newlines[:-1] + 1))
+                # the number of non whitespace characters in each line
+                solid = numpy.zeros(len(arr) + 1, dtype=numpy.int32)
+                numpy.cumsum(~fastq_io._WHITESPACE[arr], out=solid[1:])
+                widths = solid[newlines] - solid[starts]
+                nonblank = widths > 0
+                starts = starts[nonblank]
+                widths = widths[nonblank]
+                index = numpy.arange(lines, lines + len(starts))
+                offsets.extend((starts[index % (4 * interval) == 0] + pos).tolist())
+                seq_widths = widths[index % 4 == 1]
+                if len(seq_widths):
+                    bases += int(seq_widths.sum())
+                    last_seq = int(seq_widths[-1])
+                lines += len(starts)
+                consumed = int(newlines[-1]) + 1
+                pos += consumed
+                buf = buf[consumed:]
+            if not block:
+                break
+    # leave out any trailing partial record
+    record_count = lines // 4
+    if lines % 4 > 1:
+        bases -= last_seq
+    offsets = offsets[:-(-record_count // interval)]
+    return FASTQIndex(offsets, interval, record_count, bases, size)
+
+
+def index_path(path):
+    ''' The path of the sidecar index for the FASTQ file at path. '''
+    return path + INDEX_EXT
+
+
+def write_index(path, interval=None):
+    ''' Build the index for the FASTQ file at path, save it next to the file, and return it. '''
+    index = build_index(path, interval)
+    index.save(index_path(path))
+    return index
+
+
+def record_ranges(path, count):
+    '''
+    Split the uncompressed FASTQ file at path into at most count record aligned byte ranges,
+    as per FASTQIndex.ranges(). The sidecar index is used if it exists and matches the file
+    size, otherwise the file is scanned.
+    '''
+    index = None
+    if os.path.isfile(index_path(path)):
+        index = FASTQIndex.load(index_path(path))
+        if index.size != os.path.getsize(path):
+            index = None
+    return (index or build_index(path)).ranges(count)
@@ -0,0 +1,680 @@
+'''
+Block oriented FASTQ I/O.
+
+Rather than reading FASTQ files a line at a time, the functions here read large binary blocks,
+find record boundaries with vectorized newline scans, and write output in large joined buffers.
+'''
+
+import bisect
+import bz2
+import gzip
+import itertools
+import mmap
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+from ReadsUtils import bgzf
+
+BLOCK_SIZE = 16 * 1024 * 1024  # 16MB per read() call
+NEWLINE = ord('\n')
+# the characters that bytes.strip() removes, other than newlines
+_WHITESPACE = numpy.zeros(256, dtype=bool)
+_WHITESPACE[list(b' \t\r\x0b\x0c')] = True
+
+GZIP = 'gzip'
+BZIP2 = 'bzip2'
+_MAGIC = [(b'\x1f\x8b', GZIP), (b'BZh', BZIP2)]
+
+
+class TruncatedRecordError(ValueError):
+    ''' Thrown when a FASTQ stream ends part way through a record. '''
+
+    def __init__(self, stream_name):
+        super().__init__(f'The {stream_name} FASTQ stream ends part way through a record')
+        self.stream_name = stream_name
+
+
+class RecordCountMismatchError(ValueError):
+    ''' Thrown when two FASTQ streams that are being paired have different record counts. '''
+
+
+def compression_type(path):
+    '''
+    Determine how a file is compressed from its leading magic bytes, regardless of its name.
+    Returns GZIP, BZIP2, or None if the file is not compressed.
+    '''
+    with open(path, 'rb') as f:
+        return magic_compression(f.read(3))
+
+
+def magic_compression(magic):
+    '''
+    Determine how data is compressed from its first bytes. Returns GZIP, BZIP2, or None if the
+    data is not compressed.
+    '''
+    for m, compression in _MAGIC:
+        if magic.startswith(m):
+            return compression
+    return None
+
+
+def open_reads(path):
+    '''
+    Open a reads file for binary reading, decompressing it on the fly if it is gzip or bzip2
+    compressed. BGZF files, such as the reads files this module uploads, are decompressed in
+    parallel threads.
+    '''
+    compression = compression_type(path)
+    if compression == GZIP:
+        if bgzf.is_bgzf(path):
+            return bgzf.BGZFReader(path)
+        return gzip.open(path, 'rb')
+    if compression == BZIP2:
+        return bz2.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def decompress_stream(stream):
+    '''
+    Wrap a buffered binary stream, such as an io.BufferedReader, so it's decompressed on the
+    fly if it is gzip or bzip2 compressed. The stream is returned as is otherwise.
+    '''
+    compression = magic_compression(stream.peek(3)[:3])
+    if compression == GZIP:
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if compression == BZIP2:
+        return bz2.BZ2File(stream, 'rb')
+    return stream
+
+
+def normalize_lines(data):
+    '''
+    Strip leading and trailing whitespace, including CR characters, from each line of a run of
+    whole, newline terminated lines and remove any lines that are then blank.
+    '''
+    lines = [line.strip() for line in data.split(b'\n')]
+    lines = [line for line in lines if line]
+    lines.append(b'')
+    return b'\n'.join(lines)
+
+
+def _find_newlines(arr):
+    return numpy.flatnonzero(arr == NEWLINE)
+
+
+def _needs_normalizing(arr, newlines, line_start=True):
+    # checks an array of lines for blank lines and whitespace at either end of a line. Only the
+    # bytes either side of each newline need to be examined, and the first byte if the array
+    # starts at a line start - otherwise it may be part way through a line with spaces in it.
+    if not len(arr):
+        return False
+    if line_start and _WHITESPACE[arr[0]]:
+        return True
+    if not len(newlines):
+        return False
+    if (line_start and newlines[0] == 0) or (numpy.diff(newlines) == 1).any():
+        return True
+    if _WHITESPACE[arr[newlines - 1]].any():
+        return True
+    return bool(_WHITESPACE[arr[newlines[newlines < len(arr) - 1] + 1]].any())
+
+
+# characters that only occur in files that need cleaning up - no FASTQ line should contain them
+_DIRTY = [b'\r', b'\x0b', b'\x0c']
+# the characters that can't be either side of a newline in a cleaned up file
+_LINE_EDGE = _WHITESPACE.copy()
+_LINE_EDGE[NEWLINE] = True
+
+
+def clean_line_count(path, block_size=None):
+    '''
+    Check whether the uncompressed file at path is already cleaned up as described in
+    FASTQBlockReader, using bulk searches over a memory map of the file.
+
+    Returns the number of lines in the file if so, or None if the file is compressed or needs
+    cleaning up.
+    '''
+    if compression_type(path):
+        return None
+    block_size = block_size or BLOCK_SIZE
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if _LINE_EDGE[m[0]] or m[-1] != NEWLINE:
+                return None
+            lines = 0
+            for start in range(0, size, block_size):
+                # each block includes the first byte of the next one, so the bytes either side
+                # of every newline are in the same block
+                block = m[start:start + block_size + 1]
+                if any(d in block for d in _DIRTY):
+                    return None
+                arr = numpy.frombuffer(block, dtype=numpy.uint8)
+                newlines = _find_newlines(arr)
+                if (_LINE_EDGE[arr[newlines[newlines > 0] - 1]].any() or
+                        _LINE_EDGE[arr[newlines[newlines < len(arr) - 1] + 1]].any()):
+                    return None
+                lines += int(numpy.searchsorted(newlines, block_size))
+            return lines
+
+
+class FASTQBlockReader(object):
+    '''
+    Reads a binary FASTQ stream in large blocks and hands out whole records as newline
+    terminated bytes. Lines are cleaned up on the way in the same way as validateFASTQ does -
+    leading and trailing whitespace, including CR characters, is removed and blank lines are
+    skipped - so the records are always LF terminated and contain no blank lines.
+    '''
+
+    def __init__(self, stream, block_size=None):
+        self._stream = stream
+        self._block_size = block_size or BLOCK_SIZE
+        # the buffer always starts at the beginning of a line and may end part way through one
+        self._buf = b''
+        self._ends = []  # the offsets in _buf one past the end of each whole record
+        self._next = 0  # the index in _ends of the next record to hand out
+        self._pending = 0  # the number of whole lines in _buf after the last whole record
+        self.eof = False
+        self.normalized = False  # whether any of the data needed cleaning up
+
+    def fill(self):
+        '''
+        Read the next block from the stream. Returns False if the stream is exhausted.
+        '''
+        if self.eof:
+            return False
+        block = self._stream.read(self._block_size)
+        buf = self._buf[self._offset():]
+        if block:
+            buf += block
+        else:
+            self.eof = True
+            if buf and not buf.endswith(b'\n'):
+                buf += b'\n'
+                self.normalized = True
+        arr = numpy.frombuffer(buf, dtype=numpy.uint8)
+        newlines = _find_newlines(arr)
+        if _needs_normalizing(arr, newlines):
+            # the trailing partial line is left alone until the rest of it arrives
+            cut = buf.rfind(b'\n') + 1
+            buf = normalize_lines(buf[:cut]) + buf[cut:]
+            self.normalized = True
+            newlines = _find_newlines(numpy.frombuffer(buf, dtype=numpy.uint8))
+        self._buf = buf
+        self._ends = (newlines[3::4] + 1).tolist()
+        self._next = 0
+        self._pending = len(newlines) % 4
+        return not self.eof
+
+    def _offset(self):
+        return self._ends[self._next - 1] if self._next else 0
+
+    def records_available(self):
+        ''' The number of whole records that can be taken without reading more data. '''
+        return len(self._ends) - self._next
+
+    def pending_lines(self):
+        ''' The number of lines buffered beyond the last whole record. '''
+        return self._pending
+
+    def ensure_records(self, count=1):
+        '''
+        Read blocks until at least count whole records are buffered or the stream is exhausted.
+        Returns the number of whole records available.
+        '''
+        while self.records_available() < count and self.fill():
+            pass
+        return self.records_available()
+
+    def take(self, count):
+        ''' Remove and return the next count records as a list of bytes, one per record. '''
+        start = self._offset()
+        ends = self._ends[self._next:self._next + count]
+        self._next += count
+        buf = self._buf
+        return [buf[s:e] for s, e in zip([start] + ends[:-1], ends)]
+
+    def take_block(self, count):
+        ''' Remove and return the next count records as a single bytes object. '''
+        start = self._offset()
+        self._next += count
+        return self._buf[start:self._offset()]
+
+    def take_all(self):
+        '''
+        Remove and return all the buffered whole records as a single bytes object. Once the
+        stream is exhausted this includes any trailing lines that do not make up a whole record.
+        '''
+        start = self._offset()
+        if self.eof:
+            block = self._buf[start:]
+            self._buf, self._ends, self._next, self._pending = b'', [], 0, 0
+            return block
+        self._next = len(self._ends)
+        return self._buf[start:self._offset()]
+
+    def blocks(self):
+        '''
+        Yield the rest of the stream as large blocks of whole records. If the stream ends part
+        way through a record the last block ends with the remaining lines.
+        '''
+        while True:
+            more = self.fill()
+            block = self.take_all()
+            if block:
+                yield block
+            if not more:
+                return
+
+
+def record_blocks(stream, block_size=None):
+    '''
+    Yield the contents of a binary FASTQ stream, cleaned up as described in FASTQBlockReader, as
+    large blocks of whole records. If the stream ends part way through a record the last block
+    ends with the remaining lines.
+    '''
+    return FASTQBlockReader(stream, block_size).blocks()
+
+
+def file_record_blocks(path, block_size=None):
+    '''
+    Yield the contents of the FASTQ file at path, which may be compressed, as per
+    record_blocks. The file is closed once the last block has been read.
+    '''
+    with open_reads(path) as s:
+        yield from record_blocks(s, block_size)
+
+
+def interleave_records(fwd_records, rev_records):
+    ''' Interleave two equal length lists of records and return the result as bytes. '''
+    out = [None] * (len(fwd_records) * 2)
+    out[0::2] = fwd_records
+    out[1::2] = rev_records
+    return b''.join(out)
+
+
+def interleave(fwd, rev, target, block_size=None, consumers=()):
+    '''
+    Interleave the records of two binary FASTQ streams into the binary stream target. Each
+    block of interleaved records written is also passed to the callables in consumers.
+
+    Lines are cleaned up as described in FASTQBlockReader. Throws a
+    TruncatedRecordError if either stream ends part way through a record and a
+    RecordCountMismatchError if the streams have different numbers of records.
+
+    Returns the number of lines written.
+    '''
+    f = FASTQBlockReader(fwd, block_size)
+    r = FASTQBlockReader(rev, block_size)
+    lines = 0
+    while True:
+        count = min(f.ensure_records(), r.ensure_records())
+        if not count:
+            break
+        block = interleave_records(f.take(count), r.take(count))
+        target.write(block)
+        for c in consumers:
+            c(block)
+        lines += 8 * count
+    _check_paired_ends(f, r)
+    return lines
+
+
+def interleaved_blocks(fwd, rev, block_size=None):
+    '''
+    Yield the records of two binary FASTQ streams interleaved, as large blocks of bytes.
+
+    Lines are cleaned up, and errors are thrown, as for interleave().
+    '''
+    f = FASTQBlockReader(fwd, block_size)
+    r = FASTQBlockReader(rev, block_size)
+    while True:
+        count = min(f.ensure_records(), r.ensure_records())
+        if not count:
+            break
+        yield interleave_records(f.take(count), r.take(count))
+    _check_paired_ends(f, r)
+
+
+def paired_blocks(fwd, rev, block_size=None):
+    '''
+    Yield the records of two binary FASTQ streams as (forward, reverse) tuples of blocks of
+    records, where both blocks hold the same number of records.
+
+    Lines are cleaned up, and errors are thrown, as for interleave().
+    '''
+    f = FASTQBlockReader(fwd, block_size)
+    r = FASTQBlockReader(rev, block_size)
+    while True:
+        count = min(f.ensure_records(), r.ensure_records())
+        if not count:
+            break
+        yield f.take_block(count), r.take_block(count)
+    _check_paired_ends(f, r)
+
+
+def _check_paired_ends(f, r):
+    # check the forward stream first to match the order records are read in
+    if not f.records_available() and f.pending_lines():
+        raise TruncatedRecordError('forward')
+    if not r.records_available() and r.pending_lines():
+        raise TruncatedRecordError('reverse')
+    if f.records_available() or r.records_available():
+        raise RecordCountMismatchError(
+            'The FASTQ streams do not have an equal number of records')
+
+
+def deinterleave(source, fwd, rev, block_size=None, consumers=()):
+    '''
+    Split the records of an interleaved binary FASTQ stream into the binary streams fwd and rev.
+    Each block of records written is also passed to the callables in consumers.
+
+    Lines are cleaned up as described in FASTQBlockReader. Returns the number of non-blank lines
+    read, which will not be divisible by 8 if the source is not a whole number of
+    record pairs; in that case any trailing partial pair is not written.
+    '''
+    reader = FASTQBlockReader(source, block_size)
+    pairs = 0
+    while True:
+        count = reader.ensure_records(2) // 2
+        if not count:
+            break
+        records = reader.take(2 * count)
+        for out, block in [(fwd, b''.join(records[0::2])), (rev, b''.join(records[1::2]))]:
+            out.write(block)
+            for c in consumers:
+                c(block)
+        pairs += count
+    return 8 * pairs + 4 * reader.records_available() + reader.pending_lines()
+
+
+class _ChunkRange(object):
+    ''' A read only file-like view of length bytes of an iterable of chunks, after skip bytes. '''
+
+    def __init__(self, chunks, skip, length):
+        self._chunks = iter(chunks)
+        self._skip = skip
+        self._left = length
+        self._buf = memoryview(b'')
+
+    def read(self, size):
+        out = []
+        size = min(size, self._left)
+        while size > 0:
+            if not self._buf:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                skipped = min(self._skip, len(chunk))
+                self._skip -= skipped
+                self._buf = memoryview(chunk)[skipped:]
+                continue
+            data = self._buf[:size]
+            self._buf = self._buf[len(data):]
+            out.append(data)
+            size -= len(data)
+        self._left -= sum(len(d) for d in out)
+        return b''.join(out)
+
+
+class _MappedRange(object):
+    ''' A read only file-like view of a byte range of a memory mapped file. '''
+
+    def __init__(self, mapped, start, end):
+        self._mapped = mapped
+        self._pos = start
+        self._end = end
+
+    def read(self, size):
+        end = min(self._pos + size, self._end)
+        data = self._mapped[self._pos:end]
+        self._pos = end
+        return data
+
+
+def _scan_range(path, start, end):
+    # returns the number of newlines in the range and whether it might need cleaning up. Each
+    # block is examined one byte past its end to catch blank lines and leading whitespace that
+    # straddle block boundaries, so only the first block in the file is checked for leading
+    # whitespace.
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        newlines = 0
+        dirty = False
+        for s in range(start, end, BLOCK_SIZE):
+            count = min(BLOCK_SIZE, end - s)
+            arr = numpy.frombuffer(m, dtype=numpy.uint8, count=min(count + 1, len(m) - s),
+                                   offset=s)
+            nl = _find_newlines(arr)
+            newlines += int(numpy.count_nonzero(nl < count))
+            dirty = dirty or _needs_normalizing(arr, nl, s == 0)
+            del arr  # the map can't be closed while arrays refer to it
+    return newlines, dirty
+
+
+def _scan_bgzf_range(path, start, end, lines):
+    # as for _scan_range, for the data in the BGZF members from offset start to end, which is
+    # decompressed. Also returns the size of the data, the offsets in it of the starts of the
+    # lines after its first lines newlines, and its last byte
+    following = next((c[:1] for c in bgzf.decompress_range(path, end) if c), b'')
+    size = newlines = 0
+    dirty = False
+    line_starts = []
+    prev = last = b''
+    for chunk in itertools.chain((c for c in bgzf.decompress_range(path, start, end) if c),
+                                 [None]):
+        if prev:
+            arr = numpy.frombuffer(prev + (following if chunk is None else chunk[:1]),
+                                   dtype=numpy.uint8)
+            nl = _find_newlines(arr)
+            inside = nl[nl < len(prev)]
+            line_starts += (inside[:lines - len(line_starts)] + size + 1).tolist()
+            newlines += len(inside)
+            dirty = dirty or _needs_normalizing(arr, nl, start == 0 and not size)
+            size += len(prev)
+            last = prev[-1:]
+        prev = chunk
+    return size, newlines, dirty, line_starts, last
+
+
+def _deinterleave_range(path, start, end, fwdpath, revpath, summarize):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        return _deinterleave_stream(_MappedRange(m, start, end), fwdpath, revpath, summarize)
+
+
+def _deinterleave_bgzf_range(path, member, member_start, start, end, fwdpath, revpath,
+                             summarize):
+    # deinterleaves the data from start to end of the BGZF file at path, given in decompressed
+    # offsets, decompressing from the member at offset member, which holds the data from
+    # member_start. The data may run into later members
+    data = _ChunkRange(bgzf.decompress_range(path, member), start - member_start, end - start)
+    return _deinterleave_stream(data, fwdpath, revpath, summarize)
+
+
+def _deinterleave_stream(stream, fwdpath, revpath, summarize):
+    summary = summarize() if summarize else None
+    with open(fwdpath, 'wb') as fwd, open(revpath, 'wb') as rev:
+        count = deinterleave(stream, fwd, rev, consumers=[summary.add] if summary else ())
+    return count, summary
+
+
+def _unit_boundary(mapped, offset, line_index, lines):
+    # finds the first line start at or after offset that begins a unit of the given number of
+    # lines, e.g. 4 for a record or 8 for a record pair, given the index of the first line
+    # starting at or after offset
+    if offset and mapped[offset - 1] != NEWLINE:
+        offset = mapped.find(b'\n', offset) + 1
+        if not offset:
+            return len(mapped)
+    for _ in range(-line_index % lines):
+        offset = mapped.find(b'\n', offset) + 1
+        if not offset:
+            return len(mapped)
+    return offset
+
+
+def aligned_ranges(pool, path, parts, lines=4):
+    '''
+    Split the uncompressed FASTQ file at path into at most parts byte ranges that each start at
+    a multiple of lines lines, e.g. 4 for records or 8 for record pairs. The file is scanned in
+    parallel in the process pool pool.
+
+    Returns a list of (start, end) tuples, where end is exclusive, or None if the file needs
+    cleaning up as described in FASTQBlockReader, as line counts then can't be mapped to
+    offsets, or is empty, as empty files can't be memory mapped.
+    '''
+    size = os.path.getsize(path)
+    if not size:
+        return None
+    step = -(-size // parts)
+    starts = list(range(0, size, step))
+    ends = starts[1:] + [size]
+    scans = list(pool.map(_scan_range, [path] * len(starts), starts, ends))
+    if any(dirty for _, dirty in scans):
+        return None
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        bounds = [0]
+        line_count = 0
+        for start, (newlines, _) in zip(starts[1:], scans):
+            line_count += newlines
+            # the line containing start has index line_count if it starts exactly at start,
+            # otherwise the next line does
+            bounds.append(max(bounds[-1], _unit_boundary(
+                m, start, line_count if m[start - 1] == NEWLINE else line_count + 1, lines)))
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def concatenate(paths, target):
+    '''
+    Append the files in paths, in order, to the file target and delete them. Data is copied
+    within the kernel where possible.
+    '''
+    with open(target, 'wb') as t:
+        for p in paths:
+            with open(p, 'rb') as f:
+                _copy_file(f, t)
+            os.remove(p)
+
+
+def _copy_file(source, target):
+    size = os.fstat(source.fileno()).st_size
+    copied = 0
+    try:
+        while copied < size:
+            if hasattr(os, 'copy_file_range'):
+                c = os.copy_file_range(source.fileno(), target.fileno(), size - copied)
+            else:
+                c = os.sendfile(target.fileno(), source.fileno(), None, size - copied)
+            if not c:
+                break
+            copied += c
+    except OSError:
+        # e.g. cross device copies on older kernels. Carry on from wherever the kernel stopped.
+        pass
+    if copied < size:
+        source.seek(copied)
+        target.seek(0, os.SEEK_END)
+        shutil.copyfileobj(source, target, BLOCK_SIZE)
+
+
+def deinterleave_file(path, fwdpath, revpath, workers=1, summarize=None):
+    '''
+    Deinterleave the FASTQ file at path, which may be gzip or bzip2 compressed, into the files
+    fwdpath and revpath, using up to workers processes.
+
+    With more than one worker, the file is split into ranges aligned to record pair boundaries.
+    Each range is deinterleaved by a separate process into fragment files, and the fragments
+    are then joined. Uncompressed files are memory mapped and split into byte ranges. BGZF
+    files, such as the reads files this module uploads, are split at member boundaries, and
+    each process decompresses its own members. Files that need cleaning up, as described in
+    FASTQBlockReader, are deinterleaved in a single stream, as line counts cannot be mapped to
+    offsets up front, as are other compressed files.
+
+    summarize is an optional picklable callable, such as a class, that makes an object with an
+    add method, e.g. a fastq_stats.FASTQStats. One is made for each part of the file processed
+    at once, and passed each block of records as it's written.
+
+    Returns the number of non-blank lines read, as per deinterleave(), and the list of summary
+    objects, which is empty if summarize isn't given.
+    '''
+    size = os.path.getsize(path)
+    compression = compression_type(path) if size else None
+    if workers > 1 and size and compression in (None, GZIP):
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            if compression:
+                result = _deinterleave_bgzf_parallel(
+                    pool, workers, path, fwdpath, revpath, summarize)
+            else:
+                result = _deinterleave_file_parallel(
+                    pool, workers, path, fwdpath, revpath, summarize)
+        if result is not None:
+            return result
+    summary = summarize() if summarize else None
+    with open_reads(path) as s, open(fwdpath, 'wb') as f, open(revpath, 'wb') as r:
+        count = deinterleave(s, f, r, consumers=[summary.add] if summary else ())
+    return count, [summary] if summary else []
+
+
+def _deinterleave_file_parallel(pool, workers, path, fwdpath, revpath, summarize):
+    ranges = aligned_ranges(pool, path, workers, 8)
+    if ranges is None:
+        return None
+    return _deinterleave_parts(
+        pool, _deinterleave_range, [(path, start, end) for start, end in ranges], fwdpath,
+        revpath, summarize)
+
+
+def _deinterleave_bgzf_parallel(pool, workers, path, fwdpath, revpath, summarize):
+    # splits a BGZF file into ranges of whole members of about the same compressed size, and
+    # scans them to find the record pair boundaries in the decompressed data. Returns None if
+    # the file isn't all BGZF or needs cleaning up
+    offsets = bgzf.member_offsets(path)
+    if offsets is None:
+        return None
+    size = offsets[-1]
+    members = sorted({offsets[bisect.bisect_left(offsets, size * i // workers)]
+                      for i in range(workers)} - {size})
+    ends = members[1:] + [size]
+    scans = list(pool.map(_scan_bgzf_range, [path] * len(members), members, ends,
+                          [8] * len(members)))
+    if any(dirty for _, _, dirty, _, _ in scans):
+        return None
+    parts = []  # the start of each part, and the member and data offset it's decompressed from
+    data_start = line_count = 0
+    line_start = True
+    for member, (data_size, newlines, _, line_starts, last) in zip(members, scans):
+        # the line at the start of the range has index line_count if it starts there,
+        # otherwise the first whole line in the range does
+        starts = ([0] if line_start else []) + line_starts
+        skip = -(line_count if line_start else line_count + 1) % 8
+        if skip < len(starts) and (not parts or data_start + starts[skip] > parts[-1][0]):
+            parts.append((data_start + starts[skip], member, data_start))
+        data_start += data_size
+        line_count += newlines
+        if data_size:
+            line_start = last == b'\n'
+    if not parts:
+        return None
+    return _deinterleave_parts(
+        pool, _deinterleave_bgzf_range,
+        [(path, member, member_start, start, end) for (start, member, member_start), end
+         in zip(parts, [p[0] for p in parts[1:]] + [data_start])],
+        fwdpath, revpath, summarize)
+
+
+def _deinterleave_parts(pool, deinterleave_range, ranges, fwdpath, revpath, summarize):
+    # deinterleaves each range, given as the leading arguments to deinterleave_range, into
+    # fragment files in the process pool, and joins them
+    fwdparts = [f'{fwdpath}.part{i}' for i in range(len(ranges))]
+    revparts = [f'{revpath}.part{i}' for i in range(len(ranges))]
+    results = list(pool.map(deinterleave_range, *zip(*ranges), fwdparts, revparts,
+                            [summarize] * len(ranges)))
+    concatenate(fwdparts, fwdpath)
+    concatenate(revparts, revpath)
+    return (sum(count for count, _ in results),
+            [summary for _, summary in results if summary])
@@ -0,0 +1,175 @@
+'''
+In process FASTQ statistics.
+
+Computes the same statistics as the kb_ea_utils calculate_fastq_stats method, which runs the
+ea-utils fastq-stats program, from blocks of cleaned up FASTQ records as they stream past.
+As with fastq-stats, the base composition, quality and duplicate statistics only consider the
+first CYCLE_MAX bases of each read. Duplicates are counted with a DuplicateCounter, so memory
+use is bounded whatever the size of the file.
+
+The accumulated state is mergeable, so parts of a file, or several files, can be summarized
+separately - for example in parallel processes - and combined into the statistics for the whole.
+'''
+
+import math
+import mmap
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+from ReadsUtils import duplicate_counter, fastq_io
+
+CYCLE_MAX = 35
+BASES = 'ACGTN'
+NEWLINE = ord('\n')
+
+
+class FASTQStats(object):
+    '''
+    Accumulates statistics over blocks of whole, LF terminated FASTQ records with no blank lines,
+    such as those produced by fastq_io.FASTQBlockReader. The duplicate counting arguments are
+    passed to duplicate_counter.DuplicateCounter. Call close() once done to remove any
+    fingerprints spilled to disk.
+    '''
+
+    def __init__(self, duplicate_memory=None, spill_dir=None, approximate_duplicates=False):
+        self.read_count = 0
+        self.total_bases = 0
+        self._length_sq_sum = 0
+        # counts of each byte value in the sequence and quality cycles
+        self._base_counts = numpy.zeros(256, dtype=numpy.int64)
+        self._qual_counts = numpy.zeros(256, dtype=numpy.int64)
+        self._duplicates = duplicate_counter.DuplicateCounter(
+            duplicate_memory, spill_dir, approximate_duplicates)
+
+    def add(self, data):
+        ''' Add the statistics for a block of records, given as bytes. '''
+        arr = numpy.frombuffer(data, dtype=numpy.uint8)
+        newlines = numpy.flatnonzero(arr == NEWLINE)
+        count = len(newlines) // 4
+        if not count:
+            return
+        newlines = newlines[:count * 4]
+        seq_starts = newlines[0::4] + 1
+        seq_lengths = newlines[1::4] - seq_starts
+        qual_starts = newlines[2::4] + 1
+        self.read_count += count
+        self.total_bases += int(seq_lengths.sum())
+        self._length_sq_sum += int((seq_lengths * seq_lengths).sum())
+
+        cycles = numpy.arange(CYCLE_MAX)
+        in_read = cycles < seq_lengths[:, None]
+        # positions past the end of a read are masked out, but must still be valid indexes
+        last = len(arr) - 1
+        bases = arr[numpy.minimum(seq_starts[:, None] + cycles, last)]
+        quals = arr[numpy.minimum(qual_starts[:, None] + cycles, last)]
+        self._base_counts += numpy.bincount(bases[in_read], minlength=256)
+        self._qual_counts += numpy.bincount(quals[in_read], minlength=256)
+
+        bases[~in_read] = 0
+        self._duplicates.add(duplicate_counter.fingerprints(bases))
+
+    def merge(self, other):
+        '''
+        Add the statistics accumulated by another FASTQStats, e.g. for another part of the same
+        file, to these. Returns this object.
+        '''
+        self.read_count += other.read_count
+        self.total_bases += other.total_bases
+        self._length_sq_sum += other._length_sq_sum
+        self._base_counts += other._base_counts
+        self._qual_counts += other._qual_counts
+        self._duplicates.merge(other._duplicates)
+        return self
+
+    def close(self):
+        ''' Remove any duplicate counting data spilled to disk. '''
+        self._duplicates.close()
+
+    def result(self):
+        '''
+        Returns the statistics as a dict with the same keys and values as calculate_fastq_stats.
+        '''
+        n = self.read_count
+        stats = {'read_count': n,
+                 'total_bases': self.total_bases,
+                 'read_length_mean': None,
+                 'read_length_stdev': None,
+                 'phred_type': None,
+                 'number_of_duplicates': max(0, n - self._duplicates.count()),
+                 'qual_min': None,
+                 'qual_max': None,
+                 'qual_mean': None,
+                 'qual_stdev': None,
+                 'gc_content': None,
+                 'base_percentages': None
+                 }
+        if not n:
+            return stats
+        stats['read_length_mean'] = round(self.total_bases / n, 4)
+        stats['read_length_stdev'] = round(
+            _stdev(n, self.total_bases, self._length_sq_sum), 4)
+
+        cycle_bases = int(self._base_counts.sum())
+        percentages = {b: round(100 * int(self._base_counts[ord(b)]) / cycle_bases, 4)
+                       for b in BASES}
+        stats['base_percentages'] = percentages
+        stats['gc_content'] = round((percentages['G'] + percentages['C']) / 100, 6)
+
+        present = numpy.flatnonzero(self._qual_counts)
+        offset = 64 if present[0] >= 64 else 33
+        values = numpy.arange(256) - offset
+        qcount = int(self._qual_counts.sum())
+        qsum = int((self._qual_counts * values).sum())
+        qsq_sum = int((self._qual_counts * values * values).sum())
+        stats['phred_type'] = str(offset)
+        stats['qual_min'] = float(present[0] - offset)
+        stats['qual_max'] = float(present[-1] - offset)
+        stats['qual_mean'] = round(qsum / qcount, 4)
+        stats['qual_stdev'] = round(_stdev(qcount, qsum, qsq_sum), 4)
+        return stats
+
+
+def _stdev(n, total, sq_total):
+    # the sample standard deviation from the count, sum and sum of squares of the values
+    if n < 2:
+        return 0.0
+    return math.sqrt(max(sq_total - total * total / n, 0) / (n - 1))
+
+
+def _stats_range(path, start, end, options):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        stats = FASTQStats(**options)
+        for block in fastq_io.record_blocks(fastq_io._MappedRange(m, start, end)):
+            stats.add(block)
+        return stats
+
+
+def file_stats(path, workers=1, duplicate_memory=None, spill_dir=None,
+               approximate_duplicates=False):
+    '''
+    Accumulate the statistics for the FASTQ file at path, which may be gzip or bzip2 compressed.
+    Uncompressed files are split into record aligned ranges summarized by up to workers
+    processes, which share duplicate_memory between them. The other arguments are as for
+    FASTQStats.
+
+    Returns a FASTQStats, which may be merged with the statistics for other files.
+    '''
+    options = {'duplicate_memory': duplicate_memory, 'spill_dir': spill_dir,
+               'approximate_duplicates': approximate_duplicates}
+    if workers > 1 and not fastq_io.compression_type(path):
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            ranges = fastq_io.aligned_ranges(pool, path, workers)
+            if ranges is not None:
+                part_options = dict(options, duplicate_memory=(
+                    duplicate_memory or duplicate_counter.MEMORY_LIMIT) // workers)
+                stats = FASTQStats(**options)
+                for part in pool.map(_stats_range, *zip(*[(path, s, e, part_options)
+                                                          for s, e in ranges])):
+                    stats.merge(part)
+                return stats
+    stats = FASTQStats(**options)
+    with fastq_io.open_reads(path) as f:
+        for block in fastq_io.record_blocks(f):
+            stats.add(block)
+    return stats
@@ -0,0 +1,57 @@
+'''
+Feeds a single stream of data blocks to several consumers at once, so that data only needs to
+be read once no matter how many things need to be done with it.
+'''
+
+import queue
+import threading
+
+QUEUE_DEPTH = 4  # the number of blocks each consumer may fall behind the reader
+
+
+def tee(blocks, consumers, depth=None):
+    '''
+    Pass every block from the iterable blocks to each of the consumers, which are callables
+    that take a block as their only argument.
+
+    Each consumer runs in its own thread, so consumers that release the GIL, such as
+    compressors and writes to subprocess pipes, run in parallel. Blocks are passed through a
+    bounded queue per consumer so a slow consumer throttles the reader rather than blocks
+    accumulating in memory.
+
+    If a consumer throws an exception reading stops, any blocks the consumers haven't started on
+    are dropped, and the exception is rethrown.
+    '''
+    queues = [queue.Queue(depth or QUEUE_DEPTH) for _ in consumers]
+    errors = [None] * len(consumers)
+
+    def run(index):
+        q = queues[index]
+        while True:
+            block = q.get()
+            if block is None:
+                return
+            if not any(errors):  # keep draining the queue after a failure
+                try:
+                    consumers[index](block)
+                except BaseException as e:
+                    errors[index] = e
+
+    threads = [threading.Thread(target=run, args=(i,), daemon=True)
+               for i in range(len(consumers))]
+    for t in threads:
+        t.start()
+    try:
+        for block in blocks:
+            if any(errors):
+                break
+            for q in queues:
+                q.put(block)
+    finally:
+        for q in queues:
+            q.put(None)
+        for t in threads:
+            t.join()
+    for e in errors:
+        if e is not None:
+            raise e
@@ -0,0 +1,384 @@
+'''
+An in process FASTQ validator.
+
+Performs the same checks as fastQValidator with the default base space settings, on cleaned
+up FASTQ data as produced by fastq_io - i.e. with no blank lines and no leading or trailing
+whitespace. Records are checked a block at a time with vectorized operations, and whole files
+can be split into record aligned ranges that are checked in parallel processes.
+
+Sequence identifiers, the text between the @ and the first whitespace in the header, are
+checked for duplicates by counting the distinct 64 bit hashes of them with a
+duplicate_counter.DuplicateCounter, which spills hashes that don't fit in memory to disk. Two
+distinct identifiers can have the same hash - for a file of n records the chance is about
+n^2 / 2^65 - so if any hashes are repeated the data is read again and the identifiers with
+those hashes compared. If there are too many repeated hashes to keep in memory, which
+collisions alone all but never cause, the count of duplicates is taken from the hashes.
+'''
+
+import mmap
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy
+
+from ReadsUtils import duplicate_counter, fastq_io
+
+MAX_ERRORS = 10  # the number of errors to report, as per fastQValidator --maxErrors
+# the default memory for buffered sequence identifier hashes, in bytes
+ID_MEMORY_LIMIT = 128 * 1024 * 1024
+# when validation stops at the first errors, files are split into this many ranges per worker,
+# so the ranges that haven't been started yet can be dropped once an error is found
+STOP_EARLY_SPLIT = 8
+
+_SEQ_CHARS = b'acgtn'  # matched case insensitively, along with .
+_QUAL_MIN = ord('!')
+_QUAL_RANGE = ord('~') - _QUAL_MIN
+
+_FNV_OFFSET = numpy.uint64(0xcbf29ce484222325)
+_FNV_PRIME = numpy.uint64(0x100000001b3)
+
+
+class ValidationStopped(Exception):
+    ''' Thrown to stop feeding data to a validator once it has found enough errors. '''
+
+
+def _hash_ids(arr, starts, ends):
+    # FNV-1a hashes of the byte ranges [starts, ends), one character position at a time
+    hashes = numpy.full(len(starts), _FNV_OFFSET, dtype=numpy.uint64)
+    lengths = ends - starts
+    last = len(arr) - 1
+    for i in range(int(lengths.max()) if len(lengths) else 0):
+        live = lengths > i
+        chars = arr[numpy.minimum(starts + i, last)].astype(numpy.uint64)
+        hashes = numpy.where(live, (hashes ^ chars) * _FNV_PRIME, hashes)
+    return hashes
+
+
+def check_records(data, offset=0, min_read_length=1):
+    '''
+    Check a block of whole, cleaned up FASTQ records, given as bytes. Any trailing lines that
+    don't make up a whole record are ignored.
+
+    offset is the position of the block in its file, and is added to the offsets of any
+    errors.
+
+    Returns a list of (offset, message) tuples, one for the first problem found in each bad
+    record, in file order, and a numpy array of the hashes of the sequence identifiers.
+    '''
+    arr = numpy.frombuffer(data, dtype=numpy.uint8)
+    newlines = numpy.flatnonzero(arr == fastq_io.NEWLINE)
+    count = len(newlines) // 4
+    newlines = newlines[:count * 4]
+    starts = numpy.concatenate(([0], newlines[:-1] + 1))[:count * 4]
+    head_starts, seq_starts, plus_starts, qual_starts = (starts[i::4] for i in range(4))
+    head_ends, seq_ends, plus_ends, qual_ends = (newlines[i::4] for i in range(4))
+    seq_lengths = seq_ends - seq_starts
+
+    # the type of line each byte is in - 0 for identifiers, 1 for sequences, and so on
+    line_types = numpy.repeat(numpy.tile(numpy.arange(4, dtype=numpy.uint8), count),
+                              newlines - starts + 1)
+    body = arr[:len(line_types)]
+    bad_seq = _records_at(head_starts, numpy.flatnonzero((line_types == 1) & _bad_bases(body)))
+    bad_qual = _records_at(head_starts, numpy.flatnonzero((line_types == 3) & _bad_quals(body)))
+
+    id_ends = _id_ends(arr, head_starts, head_ends)
+
+    # checks in the order fastQValidator makes them, so the first failure for each record is
+    # reported
+    checks = [(arr[head_starts] != ord('@'),
+               'The sequence identifier line does not start with @'),
+              (head_ends - head_starts < 2, 'The sequence identifier is missing'),
+              (id_ends - head_starts < 2,
+               'No sequence identifier specified before the comment'),
+              (bad_seq, 'Invalid sequence character'),
+              (seq_lengths < (min_read_length or 1),
+               f'The sequence is shorter than the minimum read length of {min_read_length}'),
+              (arr[plus_starts] != ord('+'), 'The separator line does not start with +'),
+              (_plus_mismatches(data, head_starts, head_ends, plus_starts, plus_ends),
+               'The separator line does not match the sequence identifier line'),
+              (qual_ends - qual_starts != seq_lengths,
+               'The quality string length does not match the sequence length'),
+              (bad_qual, 'Invalid quality character'),
+              ]
+    reported = numpy.zeros(count, dtype=bool)
+    errors = []
+    for failed, message in checks:
+        failed = failed & ~reported
+        reported |= failed
+        errors.extend((int(o) + offset, message) for o in head_starts[failed])
+    errors.sort()
+
+    return errors, _hash_ids(arr, head_starts + 1, id_ends)
+
+
+def _id_ends(arr, head_starts, head_ends):
+    # the ends of the sequence identifiers, at the first whitespace in each header line
+    spaces = numpy.flatnonzero((arr == ord(' ')) | (arr == ord('\t')))
+    if not len(spaces):
+        return head_ends
+    first = numpy.searchsorted(spaces, head_starts)
+    has_space = first < len(spaces)
+    first_space = spaces[numpy.minimum(first, len(spaces) - 1)]
+    return numpy.where(has_space & (first_space < head_ends), first_space, head_ends)
+
+
+def _headers(data):
+    # the starts and ends of the identifier lines in a block of whole, cleaned up records
+    arr = numpy.frombuffer(data, dtype=numpy.uint8)
+    newlines = numpy.flatnonzero(arr == fastq_io.NEWLINE)
+    head_ends = newlines[0:len(newlines) // 4 * 4:4]
+    head_starts = numpy.concatenate(([0], newlines[3::4] + 1))[:len(head_ends)]
+    return arr, head_starts, head_ends
+
+
+def mate_mismatches(fwd, rev):
+    '''
+    Compare the sequence identifiers of each pair of mates in two blocks of the same number of
+    whole, cleaned up FASTQ records, ignoring any /1 and /2 suffixes.
+
+    Returns an array of the offsets in fwd of the records whose mates have different
+    identifiers.
+    '''
+    starts = []
+    hashes = []
+    for data in (fwd, rev):
+        arr, head_starts, head_ends = _headers(data)
+        id_ends = _id_ends(arr, head_starts, head_ends)
+        last = arr[id_ends - 1]
+        suffixed = ((id_ends - head_starts > 3) & (arr[id_ends - 2] == ord('/')) &
+                    ((last == ord('1')) | (last == ord('2'))))
+        starts.append(head_starts)
+        hashes.append(_hash_ids(arr, head_starts + 1, id_ends - 2 * suffixed))
+    return starts[0][hashes[0] != hashes[1]]
+
+
+# the character checks below are made with comparisons rather than lookup tables, as numpy
+# compares whole arrays several times faster than it indexes them
+
+def _bad_bases(arr):
+    # a mask of the bytes that aren't valid bases or newlines
+    lower = arr | 0x20
+    bad = (lower != _SEQ_CHARS[0]) & (arr != ord('.')) & (arr != fastq_io.NEWLINE)
+    for c in _SEQ_CHARS[1:]:
+        bad &= lower != c
+    return bad
+
+
+def _bad_quals(arr):
+    # a mask of the bytes that aren't valid quality characters or newlines
+    return ((arr - numpy.uint8(_QUAL_MIN)) > _QUAL_RANGE) & (arr != fastq_io.NEWLINE)
+
+
+def _records_at(record_starts, positions):
+    # a mask of the records containing the byte positions
+    mask = numpy.zeros(len(record_starts), dtype=bool)
+    mask[numpy.searchsorted(record_starts, positions, 'right') - 1] = True
+    return mask
+
+
+def _plus_mismatches(data, head_starts, head_ends, plus_starts, plus_ends):
+    # a separator line with anything after the + must repeat the identifier line. That is
+    # rare, so those records are compared one at a time
+    mismatch = numpy.zeros(len(plus_starts), dtype=bool)
+    for i in numpy.flatnonzero(plus_ends - plus_starts > 1):
+        mismatch[i] = (data[plus_starts[i] + 1:plus_ends[i]] !=
+                       data[head_starts[i] + 1:head_ends[i]])
+    return mismatch
+
+
+class FASTQValidator(object):
+    '''
+    Validates a stream of cleaned up FASTQ data given a block at a time, e.g. as produced by
+    fastq_io.record_blocks().
+
+    If max_errors is given, the validator is done once that many errors have been found and
+    there's no need to pass it any more data.
+
+    Sequence identifier hashes beyond id_memory bytes, ID_MEMORY_LIMIT by default, are spilled
+    to temporary files in spill_dir, the system temporary directory by default. Validators
+    can be merged, e.g. after checking parts of a file in separate processes. Once all the data
+    has been added, call confirm_duplicates() before result() so hash collisions aren't
+    reported as duplicates, and close() once done to remove any spilled hashes.
+    '''
+
+    def __init__(self, min_read_length=1, check_ids=True, max_errors=None, id_memory=None,
+                 spill_dir=None):
+        self._min_read_length = min_read_length
+        self._max_errors = max_errors
+        self._offset = 0
+        self._errors = []
+        self._error_count = 0
+        self._ids = None
+        if check_ids:
+            self._ids = duplicate_counter.DuplicateCounter(
+                id_memory or ID_MEMORY_LIMIT, spill_dir, keep_repeated=True)
+        self._id_count = 0
+        self._duplicates = None  # the duplicates confirmed by comparing the identifiers
+        self._records = 0  # the records checked before the first error
+        self._first_error_record = None
+
+    @property
+    def done(self):
+        ''' Whether max_errors errors have been found. '''
+        return self._max_errors is not None and self._error_count >= self._max_errors
+
+    @property
+    def first_error_record(self):
+        '''
+        The number, counting from 1, of the first record with an error, or None if no record
+        has an error. Each record is 4 lines of the cleaned up data, so the error is on or after
+        line 4 * (record - 1) + 1.
+        '''
+        return self._first_error_record
+
+    def add(self, block):
+        ''' Check the next block of data. Blocks must start at a record boundary. '''
+        errors, hashes = check_records(block, self._offset, self._min_read_length)
+        if self._max_errors is not None:
+            errors = errors[:self._max_errors - self._error_count]
+        if self._first_error_record is None:
+            # errors are in file order, and earlier blocks had none
+            before = block[:errors[0][0] - self._offset] if errors else block
+            self._records += before.count(b'\n') // 4
+            if errors:
+                self._first_error_record = self._records + 1
+        self._offset += len(block)
+        self._error_count += len(errors)
+        self._errors.extend(errors[:MAX_ERRORS - len(self._errors)])
+        if self._ids is not None:
+            self._ids.add(hashes)
+            self._id_count += len(hashes)
+
+    def merge(self, other):
+        '''
+        Add the results of another FASTQValidator made with the same settings, which takes over
+        its spilled hashes. Returns this object.
+        '''
+        self._errors = sorted(self._errors + other._errors)[:MAX_ERRORS]
+        self._error_count += other._error_count
+        if self._ids is not None:
+            self._ids.merge(other._ids)
+            self._id_count += other._id_count
+        return self
+
+    def confirm_duplicates(self, rescan):
+        '''
+        Compare the sequence identifiers that have the same hashes, so distinct identifiers
+        whose hashes collide aren't reported as duplicates. rescan is a function that returns
+        the data passed to the validator again as an iterable of blocks, and is only called if
+        any hashes are repeated.
+
+        Nothing is checked once max_errors errors have been found, as the data may not have
+        been passed to the validator to the end.
+        '''
+        if self._ids is None or self.done or self._ids.count() == self._id_count:
+            return
+        repeated = self._ids.repeated()
+        if repeated is None:
+            return
+        ids = {}  # the distinct identifiers for each repeated hash
+        occurrences = 0
+        for block in rescan():
+            arr, head_starts, head_ends = _headers(block)
+            id_ends = _id_ends(arr, head_starts, head_ends)
+            hashes = _hash_ids(arr, head_starts + 1, id_ends)
+            for i in numpy.flatnonzero(numpy.isin(hashes, repeated)):
+                ids.setdefault(int(hashes[i]), set()).add(
+                    bytes(block[head_starts[i] + 1:id_ends[i]]))
+                occurrences += 1
+        self._duplicates = occurrences - sum(len(i) for i in ids.values())
+
+    def result(self):
+        '''
+        Returns the total number of errors and a list of up to MAX_ERRORS (offset, message)
+        tuples describing the first errors.
+        '''
+        count = self._error_count
+        errors = sorted(self._errors)
+        if self._ids is not None:
+            duplicates = self._duplicates
+            if duplicates is None:
+                duplicates = self._id_count - self._ids.count()
+            if duplicates:
+                count += duplicates
+                if len(errors) < MAX_ERRORS:
+                    errors.append((None, f'{duplicates} duplicate sequence identifiers'))
+        return count, errors
+
+    def close(self):
+        ''' Remove any spilled sequence identifier hashes. '''
+        if self._ids is not None:
+            self._ids.close()
+
+
+def _validate_blocks(validator, blocks):
+    for block in blocks:
+        validator.add(block)
+        if validator.done:
+            return
+
+
+def _validate_range(path, start, end, min_read_length, check_ids, max_errors, id_memory,
+                    spill_dir):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        v = FASTQValidator(min_read_length, check_ids, max_errors, id_memory, spill_dir)
+        v._offset = start
+        _validate_blocks(v, fastq_io.record_blocks(fastq_io._MappedRange(m, start, end)))
+        return v
+
+
+def validate_file(path, min_read_length=1, check_ids=True, workers=1, max_errors=None,
+                  id_memory=None, spill_dir=None):
+    '''
+    Validate the cleaned up, uncompressed FASTQ file at path, splitting it into record aligned
+    ranges checked by up to workers processes. The processes share id_memory bytes of memory for
+    sequence identifier hashes, and spill any more to spill_dir, as per FASTQValidator. If any
+    hashes are repeated the file is read again to compare the identifiers.
+
+    If max_errors is given validation stops once at least that many errors have been found, so
+    a file with a bad record near the start isn't read to the end. The errors found are then
+    not necessarily the first in the file.
+
+    Returns the total number of errors and a list of up to MAX_ERRORS (offset, message)
+    tuples describing the first errors. The offset is None for duplicate identifier errors.
+    '''
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            ranges = fastq_io.aligned_ranges(
+                pool, path, workers * (STOP_EARLY_SPLIT if max_errors else 1))
+            if ranges is not None:
+                futures = [pool.submit(_validate_range, path, start, end, min_read_length,
+                                       check_ids, max_errors,
+                                       (id_memory or ID_MEMORY_LIMIT) // workers, spill_dir)
+                           for start, end in ranges]
+                return _merge_ranges(path, futures)
+    with open(path, 'rb') as f:
+        v = FASTQValidator(min_read_length, check_ids, max_errors, id_memory, spill_dir)
+        try:
+            _validate_blocks(v, fastq_io.record_blocks(f))
+            v.confirm_duplicates(lambda: fastq_io.file_record_blocks(path))
+            return v.result()
+        finally:
+            v.close()
+
+
+def _merge_ranges(path, futures):
+    # merges the validators for the ranges of the file at path as they complete, stopping once
+    # the merged validator is done
+    merged = None
+    pending = set(futures)
+    try:
+        for f in as_completed(futures):
+            pending.discard(f)
+            merged = f.result() if merged is None else merged.merge(f.result())
+            if merged.done:
+                break
+        merged.confirm_duplicates(lambda: fastq_io.file_record_blocks(path))
+        return merged.result()
+    finally:
+        if merged:
+            merged.close()
+        # the ranges that haven't started are dropped, and the hashes spilled by the others
+        # removed once they finish
+        for f in pending:
+            if not f.cancel() and not f.exception():
+                f.result().close()
@@ -0,0 +1,34 @@
+'''
+Runs independent stages of a job, such as uploading a file and calculating its statistics, at
+the same time, so the job takes about as long as its slowest stage rather than the sum of them.
+'''
+
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+
+def run_concurrently(stages, wait_on_failure=True):
+    '''
+    Run each of the callables in the list stages in its own thread and return their results
+    in the same order.
+
+    Each stage is passed a threading.Event that is set if another stage fails, which long
+    running stages may check to stop early or skip work they haven't started. If a stage throws
+    an exception the event is set, the other stages are waited for, so none are left running,
+    and the first exception is rethrown. If wait_on_failure is false the exception is rethrown
+    straight away instead, for stages that can't be stopped and leave nothing to clean up.
+    '''
+    cancelled = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=max(1, len(stages)))
+    try:
+        futures = [pool.submit(s, cancelled) for s in stages]
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        failed = [f for f in futures if f in done and f.exception() is not None]
+        if failed:
+            cancelled.set()
+            if wait_on_failure:
+                wait(futures)
+            raise failed[0].exception()
+        return [f.result() for f in futures]
+    finally:
+        pool.shutdown(wait=wait_on_failure)
@@ -0,0 +1,94 @@
+'''
+A persistent cache of reads file validation results.
+
+Results are keyed by a fingerprint of the file - its size, modification time and inode along
+with a hash of a few sampled blocks of its contents, or optionally a hash of all of it - and
+the options the file was validated with. Each entry is a small JSON file in the cache directory.
+Reading an entry updates its modification time, and once there are more than max_entries
+entries the least recently used are removed.
+'''
+
+import hashlib
+import json
+import os
+import tempfile
+
+MAX_ENTRIES = 10000
+SAMPLE_SIZE = 64 * 1024  # the size of each block hashed for the fingerprint
+SAMPLE_COUNT = 3  # blocks at the start, middle and end of the file
+_READ_SIZE = 1024 * 1024
+_ENTRY_EXT = '.json'
+
+
+class ValidationCache(object):
+    '''
+    A validation result cache stored in directory, which is created when needed. If full_hash
+    is true the whole of each file is hashed rather than sampled blocks.
+    '''
+
+    def __init__(self, directory, max_entries=None, full_hash=False):
+        self._dir = directory
+        self._max_entries = max_entries or MAX_ENTRIES
+        self._full_hash = full_hash
+
+    def fingerprint(self, path):
+        ''' A fingerprint of the file at path that changes if the file does. '''
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if self._full_hash:
+                for block in iter(lambda: f.read(_READ_SIZE), b''):
+                    h.update(block)
+            else:
+                step = max(0, st.st_size - SAMPLE_SIZE) // max(1, SAMPLE_COUNT - 1)
+                for i in range(SAMPLE_COUNT):
+                    f.seek(i * step)
+                    h.update(f.read(SAMPLE_SIZE))
+        return f'{st.st_size}-{st.st_mtime_ns}-{st.st_ino}-{h.hexdigest()}'
+
+    def _entry_path(self, path, options):
+        key = json.dumps([self.fingerprint(path), options], sort_keys=True)
+        return os.path.join(self._dir, hashlib.sha256(key.encode()).hexdigest() + _ENTRY_EXT)
+
+    def get(self, path, options):
+        '''
+        Get the cached result of validating the file at path with options, a JSON serializable
+        dict, or None if there is no cached result.
+        '''
+        entry = self._entry_path(path, options)
+        try:
+            with open(entry) as f:
+                result = json.load(f)['result']
+            os.utime(entry)
+        except (OSError, ValueError, KeyError):
+            return None  # a missing entry, or one removed or being replaced by another thread
+        return result
+
+    def put(self, path, options, result):
+        '''
+        Cache the JSON serializable result of validating the file at path with options, and
+        remove the least recently used entries if the cache is full.
+        '''
+        entry = self._entry_path(path, options)
+        os.makedirs(self._dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                mode='w', dir=self._dir, suffix='.tmp', delete=False) as t:
+            json.dump({'path': path, 'options': options, 'result': result}, t)
+        os.replace(t.name, entry)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for e in os.scandir(self._dir):
+            if e.name.endswith(_ENTRY_EXT):
+                try:
+                    entries.append((e.stat().st_mtime_ns, e.path))
+                except FileNotFoundError:
+                    pass
+        if len(entries) > self._max_entries:
+            entries.sort()
+            for _, e in entries[:len(entries) - self._max_entries]:
+                try:
+                    os.remove(e)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,90 @@
+'''
+Streams reads files from the web, so they can be validated, compressed and uploaded as they
+download rather than being written to disk first.
+
+Only direct downloads over HTTP(S) and files on FTP servers are streamed. Other download types,
+such as Dropbox and Google Drive links, need the URL rewriting DataFileUtil does.
+'''
+
+import contextlib
+import ftplib
+import io
+import posixpath
+from urllib.parse import unquote, urlparse
+
+import requests
+
+from ReadsUtils import fastq_io
+
+DIRECT_DOWNLOAD = 'Direct Download'
+FTP = 'FTP'
+STREAMABLE_TYPES = [DIRECT_DOWNLOAD, FTP]
+
+TIMEOUT = 60  # the seconds to wait to connect to a server or for it to send more data
+BUFFER_SIZE = 1024 * 1024
+
+
+class _FTPFile(io.RawIOBase):
+    ''' The contents of a file on an FTP server, read as it's transferred. '''
+
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self._ftp = ftplib.FTP(timeout=TIMEOUT)
+        try:
+            self._ftp.connect(parsed.hostname, parsed.port or ftplib.FTP_PORT)
+            # ftplib logs in anonymously if no user is given
+            self._ftp.login(unquote(parsed.username or ''), unquote(parsed.password or ''))
+            directory, name = posixpath.split(unquote(parsed.path))
+            if directory and directory != '/':
+                self._ftp.cwd(directory)
+            self._ftp.voidcmd('TYPE I')
+            self._conn = self._ftp.transfercmd('RETR ' + name)
+        except BaseException:
+            self._ftp.close()
+            raise
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self._conn.recv_into(b)
+
+    def close(self):
+        if not self.closed:
+            # the transfer may not be complete, so the connection is dropped rather than
+            # waiting for the server to reply
+            self._conn.close()
+            self._ftp.close()
+        super().close()
+
+
+def _http_file(url):
+    response = requests.get(url, stream=True, timeout=TIMEOUT)
+    try:
+        response.raise_for_status()
+    except requests.HTTPError:
+        response.close()
+        raise
+    # undo any content encoding the server added, which is separate from the file compression
+    response.raw.decode_content = True
+    # keep reads at the end of the file working for buffered readers, which may read again
+    response.raw.auto_close = False
+    return response.raw
+
+
+@contextlib.contextmanager
+def open_url(url, download_type):
+    '''
+    Open the file at url, which is downloaded as per download_type, one of STREAMABLE_TYPES, for
+    binary reading, decompressing it on the fly if it is gzip or bzip2 compressed. Use as a
+    context manager.
+    '''
+    if download_type == FTP:
+        raw = _FTPFile(url)
+    elif download_type == DIRECT_DOWNLOAD:
+        raw = _http_file(url)
+    else:
+        raise ValueError(f'Download type {download_type} cannot be streamed')
+    with io.BufferedReader(raw, BUFFER_SIZE) as buffered:
+        with fastq_io.decompress_stream(buffered) as stream:
+            yield stream
@@ -0,0 +1,100 @@
+'''
+Benchmarks the block based FASTQ interleaver against the previous line based implementation.
+
+Usage: python scripts/benchmark_interleave.py [size_in_MB_per_file] [read_length]
+
+Synthetic forward and reverse files are written to a temporary directory, interleaved with
+both implementations, and the throughput in GB/s of input is reported for each.
+'''
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from ReadsUtils import fastq_io  # noqa: E402
+
+
+def write_fastq(path, size, read_length, direction):
+    rand = random.Random(direction)
+    with open(path, 'w') as f:
+        written = 0
+        i = 0
+        while written < size:
+            seq = ''.join(rand.choice('ACGT') for _ in range(read_length))
+            qual = ''.join(rand.choice('ABCDEFGHIJ') for _ in range(read_length))
+            rec = f'@read{i}/{direction}\n{seq}\n+\n{qual}\n'
+            f.write(rec)
+            written += len(rec)
+            i += 1
+
+
+# the implementation that the block interleaver replaced, minus the error reporting
+def read_fq_record_line_based(f):
+    r = ''
+    for i in range(4):
+        l = f.readline()
+        while l == '\n':
+            l = f.readline()
+        if not l:
+            if i != 0:
+                raise ValueError('non-blank lines are not a multiple of four')
+            return ''
+        r = r + l
+    return r
+
+
+def interleave_line_based(fwdpath, revpath, targetpath):
+    with open(targetpath, 'w') as t:
+        with open(fwdpath, 'r') as f, open(revpath, 'r') as r:
+            while True:
+                frec = read_fq_record_line_based(f)
+                rrec = read_fq_record_line_based(r)
+                if bool(frec) != bool(rrec):
+                    raise ValueError('reads files do not have an equal number of records')
+                if not frec:
+                    break
+                t.write(frec)
+                t.write(rrec)
+
+
+def interleave_block_based(fwdpath, revpath, targetpath):
+    with open(targetpath, 'wb') as t:
+        with open(fwdpath, 'rb') as f, open(revpath, 'rb') as r:
+            fastq_io.interleave(f, r, t)
+
+
+def time_it(name, func, fwdpath, revpath, targetpath, input_size):
+    start = time.time()
+    func(fwdpath, revpath, targetpath)
+    elapsed = time.time() - start
+    print(f'{name}: {elapsed:.2f}s, {input_size / elapsed / 1e9:.3f} GB/s')
+    return elapsed
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 else 256 * 1024 * 1024
+    read_length = int(sys.argv[2]) if len(sys.argv) > 2 else 150
+    with tempfile.TemporaryDirectory() as tmp:
+        fwdpath = os.path.join(tmp, 'fwd.fastq')
+        revpath = os.path.join(tmp, 'rev.fastq')
+        print(f'Writing {size / 1024 / 1024:.0f}MB test files to {tmp}')
+        write_fastq(fwdpath, size, read_length, 1)
+        write_fastq(revpath, size, read_length, 2)
+        input_size = os.path.getsize(fwdpath) + os.path.getsize(revpath)
+        line = time_it('line based', interleave_line_based, fwdpath, revpath,
+                       os.path.join(tmp, 'line.fastq'), input_size)
+        block = time_it('block based', interleave_block_based, fwdpath, revpath,
+                        os.path.join(tmp, 'block.fastq'), input_size)
+        print(f'Speedup: {line / block:.2f}x')
+        with open(os.path.join(tmp, 'line.fastq'), 'rb') as lf, \
+                open(os.path.join(tmp, 'block.fastq'), 'rb') as b:
+            if lf.read() != b.read():
+                raise ValueError('Interleaved outputs differ')
+        print('Outputs are identical')
+
+
+if __name__ == '__main__':
+    main()
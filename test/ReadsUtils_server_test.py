@@ -1,4 +1,6 @@
+import bz2
 import ftplib
+import gzip
 import hashlib
 import inspect
 import os
@@ -6,6 +8,7 @@ import shutil
 import subprocess
 import tempfile
 import socket
+import stat
 import time
 import unittest
 from configparser import ConfigParser
@@ -18,7 +21,10 @@ from pyftpdlib.handlers import FTPHandler
 from pyftpdlib.servers import ThreadedFTPServer
 import threading
 import requests
+import numpy
 
+from ReadsUtils import (bgzf, checkpoint, duplicate_counter, fasta_validator, fastq_index,
+                        fastq_io, fastq_stats, fastq_validator, stages, validation_cache)
 from ReadsUtils.ReadsUtilsImpl import ReadsUtils
 from ReadsUtils.ReadsUtilsServer import MethodContext
 from ReadsUtils.authclient import KBaseAuth as _KBaseAuth
@@ -622,6 +628,27 @@ class ReadsUtilsTest(unittest.TestCase):
         self.fail_val_FASTA('data/sample.txt',
                             'File data/sample.txt is not a FASTA file')
 
+    def test_FASTA_validation_native(self):
+        with patch.object(self.impl, 'fasta_validator', ReadsUtils.NATIVE_FASTA_VALIDATOR):
+            self.test_FASTA_validation()
+        self.assertEqual(fasta_validator.validate_file('data/sample_missing_data.fa'),
+                         (1, [(295, 'The sequence is missing')]))
+        self.assertEqual(fasta_validator.validate_file('data/Sample1.fastq')[1][:2],
+                         [(0, 'Invalid sequence character'),
+                          (0, 'The file does not start with a header')])
+
+    def test_FASTA_batch(self):
+        files = ['data/sample.fa', 'data/sample_missing_data.fa', 'data/sample.fna']
+        for validator in [ReadsUtils.FASTA_JAR, ReadsUtils.NATIVE_FASTA_VALIDATOR]:
+            with patch.object(self.impl, 'fasta_validator', validator), patch.object(
+                    self.impl, 'validation_workers', 2):
+                self.assertEqual(self.impl.validateFASTA_batch(
+                    self.ctx, [{'file_path': f} for f in files])[0],
+                    [{'valid': 1}, {'valid': 0}, {'valid': 1}])
+        with self.assertRaisesRegex(ValueError, 'File data/sample.txt is not a FASTA file'):
+            self.impl.validateFASTA_batch(
+                self.ctx, [{'file_path': 'data/sample.fa'}, {'file_path': 'data/sample.txt'}])
+
     def test_FASTQ_validation(self):
         self.check_fq('data/Sample1.fastq', 0, 1)
         self.check_fq('data/sample_with_CRLF.fastq', 0, 1)
@@ -647,6 +674,108 @@ class ReadsUtilsTest(unittest.TestCase):
         self.check_fq('data/min_single_Sample.fastq', 0, 1)  # test default min_len=1
         self.check_fq('data/min_single_Sample.fastq', 0, 0, min_len=2)
 
+    def test_FASTQ_validation_native(self):
+        with patch.object(self.impl, 'fastq_validator', ReadsUtils.NATIVE_FASTQ_VALIDATOR):
+            self.test_FASTQ_validation()
+            self.test_FASTQ_multiple()
+
+    def test_FASTQ_validation_native_parallel(self):
+        for workers in [1, 3]:
+            self.assertEqual(fastq_validator.validate_file(
+                'data/Sample4_interleaved_NCBI_SRA.fastq', check_ids=False, workers=workers),
+                (0, []))
+            self.assertEqual(fastq_validator.validate_file(
+                'data/Sample4_interleaved_NCBI_SRA.fastq', workers=workers),
+                (50, [(None, '50 duplicate sequence identifiers')]))
+            self.assertEqual(fastq_validator.validate_file(
+                'data/Sample1_invalid.fastq', workers=workers),
+                (1, [(1536, 'The sequence identifier line does not start with @')]))
+            self.assertEqual(fastq_validator.validate_file(
+                'data/min_Sample.fastq', 3, workers=workers),
+                (1, [(0, 'The sequence is shorter than the minimum read length of 3')]))
+        # sequence ID hashes that don't fit in memory are spilled to disk and removed after
+        spill_dir = tempfile.mkdtemp(dir=self.scratch)
+        for workers in [1, 3]:
+            with patch.object(fastq_io, 'BLOCK_SIZE', 1000):
+                self.assertEqual(fastq_validator.validate_file(
+                    'data/Sample4_interleaved_NCBI_SRA.fastq', workers=workers, id_memory=64,
+                    spill_dir=spill_dir),
+                    (50, [(None, '50 duplicate sequence identifiers')]))
+            self.assertEqual(os.listdir(spill_dir), [])
+        # empty files can't be memory mapped, so are validated in a single pass
+        empty = os.path.join(self.scratch, 'empty_parallel.fastq')
+        open(empty, 'w').close()
+        for workers in [1, 3]:
+            self.assertEqual(fastq_validator.validate_file(empty, workers=workers), (0, []))
+
+    def test_FASTQ_validation_native_hash_collisions(self):
+        # distinct sequence IDs with the same hash aren't reported as duplicates
+        def collide(arr, starts, ends):
+            return numpy.zeros(len(starts), dtype=numpy.uint64)
+
+        with patch.object(fastq_validator, '_hash_ids', side_effect=collide), patch.object(
+                self.impl, 'fastq_validator', ReadsUtils.NATIVE_FASTQ_VALIDATOR):
+            for workers in [1, 3]:
+                self.assertEqual(fastq_validator.validate_file(
+                    'data/Sample1.fastq', workers=workers), (0, []))
+                self.assertEqual(fastq_validator.validate_file(
+                    'data/Sample4_interleaved_NCBI_SRA.fastq', workers=workers),
+                    (50, [(None, '50 duplicate sequence identifiers')]))
+            # compressed files are read again, and streamed data from the compressed copy
+            self.assertEqual(self.impl._validate_stream('data/Sample1.fastq.gz', 0, 1), (1, None))
+            validated, gzpath, _, _ = self.impl._validate_compress_and_stats(
+                os.path.join(self.scratch, 'collide.fastq'), 0, 1,
+                blocks=fastq_io.file_record_blocks('data/Sample1.fastq'))
+            self.assertEqual(validated, 1)
+            with gzip.open(gzpath, 'rb') as gz, open('data/Sample1.fastq', 'rb') as f:
+                self.assertEqual(gz.read(), f.read())
+            self.assertEqual(self.impl._validate_paired(
+                'data/Sample5_noninterleaved.1.fastq', 'data/Sample5_noninterleaved.2.fastq', 1),
+                (None, None))
+
+    def test_FASTQ_validation_native_empty_id(self):
+        # as for fastQValidator, a comment must follow a sequence ID
+        self.assertEqual(fastq_validator.check_records(b'@ foo\nACGT\n+\nIIII\n')[0],
+                         [(0, 'No sequence identifier specified before the comment')])
+        self.assertEqual(fastq_validator.check_records(b'@id foo\nACGT\n+\nIIII\n')[0], [])
+
+    def test_FASTQ_validation_fail_fast(self):
+        path = os.path.join(self.scratch, 'fail_fast_Sample1.fastq')
+        with open('data/Sample1.fastq', 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(b'X' + data[1:].replace(b'\n@', b'\nX'))
+        for workers in [1, 3]:
+            self.assertEqual(fastq_validator.validate_file(path, workers=workers)[0], 50)
+            count, errors = fastq_validator.validate_file(path, workers=workers, max_errors=1)
+            self.assertEqual(count, 1)
+            self.assertEqual(errors[0][1], 'The sequence identifier line does not start with @')
+        first_error = 'record 1, line 1: The sequence identifier line does not start with @'
+        with patch.object(self.impl, 'validation_fail_fast', True), patch.object(
+                self.impl, 'fastq_validator', ReadsUtils.NATIVE_FASTQ_VALIDATOR):
+            result = self.impl._validate_compress_and_stats(path, 0, None)
+            self.assertEqual((result[0], result[3]), (0, first_error))
+            # the lines are counted as the file is validated rather than in a pass before it
+            with patch.object(fastq_io, 'clean_line_count',
+                              side_effect=AssertionError('counted first')):
+                self.assertEqual(self.impl.validateFASTQ(self.ctx, [{'file_path': path}])[0],
+                                 [{'validated': 0}])
+                self.assertEqual(self.impl._run_fastq_validation(path, 0, None, 1),
+                                 (0, first_error))
+                # valid files that need cleaning up are only rewritten after validation
+                crlf = os.path.join(self.scratch, 'fail_fast_CRLF.fastq')
+                shutil.copyfile('data/sample_with_CRLF.fastq', crlf)
+                self.assertEqual(self.impl._run_fastq_validation(crlf, 0, None, 1), (1, None))
+                with open(crlf, 'rb') as f:
+                    self.assertNotIn(b'\r', f.read())
+        # the location of the first error is counted in records of the cleaned up data
+        validator = fastq_validator.FASTQValidator()
+        lines = data.split(b'\n')
+        validator.add(b'\n'.join(lines[:8]) + b'\n')
+        self.assertIsNone(validator.first_error_record)
+        validator.add(b'\n'.join([b'X'] + lines[9:12] + lines[8:12]) + b'\n')
+        self.assertEqual(validator.first_error_record, 3)
+
     def test_FASTQ_multiple(self):
         f1 = 'data/Sample1.fastq'
         f2 = 'data/Sample4_interleaved_NCBI_SRA.fastq'
@@ -669,6 +798,78 @@ class ReadsUtilsTest(unittest.TestCase):
                         'interleaved': 0}
                        ])[0], [{'validated': 1}, {'validated': 1}, {'validated': 1}])
 
+    def test_FASTQ_validation_compressed(self):
+        cases = [('data/Sample5_interleaved_blank_lines.fastq', 1, None, 1),
+                 ('data/Sample5_interleaved_missing_line.fastq', 1, None, 0),
+                 ('data/Sample2_interleaved_illumina.fnq', 0, None, 0),
+                 ('data/min_Sample.fastq', 0, 2, 1),
+                 ('data/min_Sample.fastq', 0, 3, 0)]
+        for opener, ext in [(gzip.open, '.gz'), (bz2.open, '.bz2')]:
+            for f, interleaved, min_len, ok in cases:
+                path = os.path.join(self.scratch, 'compressed_' + os.path.basename(f) + ext)
+                with open(f, 'rb') as i, opener(path, 'wb') as o:
+                    shutil.copyfileobj(i, o)
+                md5 = self.md5(path)
+                self.assertEqual(self.impl.validateFASTQ(
+                    self.ctx, [{'file_path': path,
+                                'interleaved': interleaved,
+                                'min_read_length': min_len}])[0][0]['validated'], ok)
+                self.assertEqual(self.md5(path), md5)
+        txt = os.path.join(self.scratch, 'compressed_sample.txt.gz')
+        shutil.copyfile(path, txt)
+        self.fail_val_FASTQ([{'file_path': txt}], f'File {txt} is not a FASTQ file')
+
+    def test_FASTQ_multiple_parallel(self):
+        files = [('data/Sample1.fastq', 0, 1),
+                 ('data/Sample1_invalid.fastq', 0, 0),
+                 ('data/Sample5_interleaved_blank_lines.fastq', 1, 1),
+                 ('data/Sample5_interleaved_missing_line.fastq', 1, 0),
+                 ('data/Sample4_interleaved_NCBI_SRA.fastq', 1, 1)]
+        params = []
+        for i, (f, interleaved, _) in enumerate(files):
+            path = os.path.join(self.scratch, f'parallel_{i}_' + os.path.basename(f))
+            shutil.copyfile(f, path)
+            params.append({'file_path': path, 'interleaved': interleaved})
+        with patch.object(self.impl, 'validation_workers', 3):
+            self.assertEqual(self.impl.validateFASTQ(self.ctx, params)[0],
+                             [{'validated': ok} for _, _, ok in files])
+            # the same file listed twice
+            self.assertEqual(self.impl.validateFASTQ(self.ctx, params[2:3] * 2)[0],
+                             [{'validated': 1}, {'validated': 1}])
+
+    def test_FASTQ_validation_cache(self):
+        path = os.path.join(self.scratch, 'cached_Sample1_invalid.fastq')
+        shutil.copyfile('data/Sample1_invalid.fastq', path)
+        params = [{'file_path': path}, {'file_path': path, 'min_read_length': 2}]
+        self.assertEqual(self.impl.validateFASTQ(self.ctx, params)[0],
+                         [{'validated': 0}, {'validated': 0}])
+        with patch.object(self.impl, '_run_fastq_validation',
+                          side_effect=AssertionError('cache miss')):
+            self.assertEqual(self.impl.validateFASTQ(self.ctx, params)[0],
+                             [{'validated': 0}, {'validated': 0}])
+            # uploads don't read invalid files again
+            self.assertEqual(self.impl._validate_compress_and_stats(path, 0, 2),
+                             (0, None, None, None))
+        # a changed file is validated again
+        shutil.copyfile('data/Sample1.fastq', path)
+        self.assertEqual(self.impl.validateFASTQ(self.ctx, params[:1])[0], [{'validated': 1}])
+
+    def test_validation_cache_eviction(self):
+        cache = validation_cache.ValidationCache(
+            os.path.join(self.scratch, 'eviction_cache'), max_entries=2)
+        paths = []
+        for i in range(3):
+            paths.append(os.path.join(self.scratch, f'eviction_{i}.fastq'))
+            with open(paths[-1], 'w') as f:
+                f.write(str(i))
+        cache.put(paths[0], {'interleaved': 0}, 1)
+        cache.put(paths[1], {'interleaved': 0}, 1)
+        time.sleep(0.01)
+        self.assertEqual(cache.get(paths[0], {'interleaved': 0}), 1)
+        self.assertIsNone(cache.get(paths[0], {'interleaved': 1}))
+        cache.put(paths[2], {'interleaved': 0}, 0)
+        self.assertEqual([cache.get(p, {'interleaved': 0}) for p in paths], [1, None, 0])
+
     def check_fq(self, filepath, interleaved, ok, min_len=None):
         fn = os.path.basename(filepath)
         newfn = self.cfg['scratch'] + '/' + fn
@@ -680,6 +881,24 @@ class ReadsUtilsTest(unittest.TestCase):
         for l in open(newfn):
             self.assertNotEqual(l, '')
 
+    def test_FASTQ_validation_clean_file_not_rewritten(self):
+        clean = os.path.join(self.scratch, 'clean_Sample5_interleaved.fastq')
+        shutil.copyfile('data/Sample5_interleaved.fastq', clean)
+        inode = os.stat(clean).st_ino
+        self.assertEqual(self.impl.validateFASTQ(
+            self.ctx, [{'file_path': clean, 'interleaved': 1}])[0], [{'validated': 1}])
+        self.assertEqual(os.stat(clean).st_ino, inode)
+
+        dirty = os.path.join(self.scratch, 'dirty_Sample5_interleaved_blank_lines.fastq')
+        shutil.copyfile('data/Sample5_interleaved_blank_lines.fastq', dirty)
+        os.chmod(dirty, 0o640)
+        self.assertIsNone(fastq_io.clean_line_count(dirty))
+        self.assertEqual(self.impl.validateFASTQ(
+            self.ctx, [{'file_path': dirty, 'interleaved': 1}])[0], [{'validated': 1}])
+        self.assertEqual(self.md5(dirty), self.md5('data/Sample5_interleaved.fastq'))
+        self.assertEqual(stat.S_IMODE(os.stat(dirty).st_mode), 0o640)
+        self.assertEqual(fastq_io.clean_line_count(dirty), fastq_io.clean_line_count(clean))
+
     def test_FASTQ_val_fail_no_file(self):
         self.fail_val_FASTQ([{'file_path': 'nofile'}], 'No such file: nofile')
         self.fail_val_FASTQ([{'file_path': None}], 'No such file: None')
@@ -689,6 +908,168 @@ class ReadsUtilsTest(unittest.TestCase):
         self.fail_val_FASTQ([{'file_path': 'data/sample.txt'}],
                             'File data/sample.txt is not a FASTQ file')
 
+    def test_bgzf(self):
+        with open('data/small.forward.fq', 'rb') as f:
+            data = f.read()
+        path = os.path.join(self.scratch, 'bgzf_small.forward.fq.gz')
+        with patch.object(bgzf, 'CHUNK_SIZE', 3 * bgzf.BLOCK_DATA_SIZE):
+            with bgzf.BGZFWriter(path, 3, 4) as w:
+                for i in range(0, len(data), 100000):
+                    w.write(data[i:i + 100000])
+        with gzip.open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        # walk the members using the sizes in their headers
+        with open(path, 'rb') as f:
+            compressed = f.read()
+        self.assertTrue(compressed.endswith(bgzf.EOF_BLOCK))
+        offset = 0
+        members = 0
+        while offset < len(compressed):
+            self.assertEqual(compressed[offset:offset + 4], b'\x1f\x8b\x08\x04')
+            offset += int.from_bytes(compressed[offset + 16:offset + 18], 'little') + 1
+            members += 1
+        self.assertEqual(offset, len(compressed))
+        self.assertEqual(members, -(-len(data) // bgzf.BLOCK_DATA_SIZE) + 1)
+
+        # the members are decompressed in parallel, whatever the size of the reads
+        self.assertTrue(bgzf.is_bgzf(path))
+        with patch.object(bgzf, 'CHUNK_SIZE', 3 * bgzf.BLOCK_DATA_SIZE):
+            with bgzf.BGZFReader(path, 4) as r:
+                self.assertEqual(b''.join(iter(lambda: r.read(100000), b'')), data)
+        with fastq_io.open_reads(path) as r:
+            self.assertIsInstance(r, bgzf.BGZFReader)
+            self.assertEqual(b''.join(fastq_io.record_blocks(r)), data)
+        # gzip data appended to BGZF is decompressed as a single stream
+        mixed = os.path.join(self.scratch, 'bgzf_mixed.fq.gz')
+        with open(mixed, 'wb') as f:
+            f.write(compressed + gzip.compress(b'@r\nACGT\n+\nIIII\n'))
+        with bgzf.BGZFReader(mixed) as r:
+            self.assertEqual(r.read(), data + b'@r\nACGT\n+\nIIII\n')
+        plain = os.path.join(self.scratch, 'bgzf_plain.fq.gz')
+        with open(plain, 'wb') as f:
+            f.write(gzip.compress(data))
+        self.assertFalse(bgzf.is_bgzf(plain))
+        with fastq_io.open_reads(plain) as r:
+            self.assertNotIsInstance(r, bgzf.BGZFReader)
+        corrupt = os.path.join(self.scratch, 'bgzf_corrupt.fq.gz')
+        with open(corrupt, 'wb') as f:
+            f.write(compressed[:len(compressed) // 2])
+        with self.assertRaisesRegex(gzip.BadGzipFile, 'Truncated BGZF member'):
+            with bgzf.BGZFReader(corrupt) as r:
+                r.read()
+
+    def test_validate_paired(self):
+        with open('data/Sample1.fastq', 'rb') as f, open('data/Sample_rev.fq', 'rb') as r:
+            fwd, rev = next(fastq_io.paired_blocks(f, r))
+        self.assertEqual(fastq_validator.mate_mismatches(fwd, fwd).tolist(), [])
+        self.assertEqual(fastq_validator.mate_mismatches(fwd, rev).tolist()[:3], [0, 192, 384])
+        for validator in [ReadsUtils.FASTQ_EXE, ReadsUtils.NATIVE_FASTQ_VALIDATOR]:
+            with patch.object(self.impl, 'fastq_validator', validator):
+                self.assertEqual(self.impl._validate_paired(
+                    'data/Sample5_noninterleaved.1.fastq', 'data/Sample5_noninterleaved.2.fastq',
+                    None), (None, None))
+                self.assertEqual(self.impl._validate_paired(
+                    'data/small.forward.fq', 'data/small.reverse.fq', None), (None, None))
+                self.assertEqual(self.impl._validate_paired(
+                    'data/Sample1.fastq', 'data/Sample_rev.fq', None),
+                    ('data/Sample1.fastq',
+                     'record 1, line 1: The mate has a different sequence ID'))
+                self.assertEqual(self.impl._validate_paired(
+                    'data/min_Sample.fastq', 'data/min_Sample.fastq', 3)[0],
+                    'data/min_Sample.fastq')
+                with self.assertRaises(fastq_io.RecordCountMismatchError):
+                    self.impl._validate_paired('data/Sample5_noninterleaved.1.missing_rec.fastq',
+                                               'data/Sample5_noninterleaved.2.fastq', None)
+
+    def test_validate_compress_and_stats(self):
+        # the cleaned up data is validated, compressed and summarized without altering the file
+        f = os.path.join(self.scratch, 'tee_Sample5_interleaved_blank_lines.fastq')
+        shutil.copy('data/Sample5_interleaved_blank_lines.fastq', f)
+        md5 = self.md5(f)
+        validated, gzpath, stats, _ = self.impl._validate_compress_and_stats(f, 1, None)
+        self.assertEqual(validated, 1)
+        self.assertEqual(self.md5(f), md5)
+        self.assertEqual(os.path.basename(gzpath),
+                         'tee_Sample5_interleaved_blank_lines.fastq.gz')
+        with gzip.open(gzpath, 'rb') as gz:
+            self.assertEqual(hashlib.md5(gz.read()).hexdigest(), self.MD5_FR_TO_I_BLANK)
+        self.assertEqual(stats['read_count'], 4)
+        self.assertEqual(stats['total_bases'], 1004)
+        self.assertEqual(stats['gc_content'], 0.6)
+        self.assertEqual(stats['qual_stdev'], 10.081)
+
+        for filepath, interleaved in [('data/Sample1_invalid.fastq', 0),
+                                      ('data/Sample6_interleaved_odd_num_reads.fastq', 1)]:
+            f = os.path.join(self.scratch, 'tee_' + os.path.basename(filepath))
+            shutil.copy(filepath, f)
+            validated, _, _, error = self.impl._validate_compress_and_stats(
+                f, interleaved, None)
+            self.assertEqual(validated, 0)
+            self.assertIsNotNone(error)
+
+    def test_stats_engine(self):
+        # the in process statistics match those from kb_ea_utils
+        f = os.path.join(self.scratch, 'engine_Sample5_interleaved.fastq')
+        shutil.copy('data/Sample5_interleaved.fastq', f)
+        _, _, stats, _ = self.impl._validate_compress_and_stats(f, 1, None)
+        with patch.object(self.impl, 'stats_engine', ReadsUtils.EA_UTILS_STATS_ENGINE):
+            validated, _, ea_stats, _ = self.impl._validate_compress_and_stats(f, 1, None)
+        self.assertEqual(validated, 1)
+        self.assertIsNone(ea_stats)
+        self.assertEqual(self.impl.get_fq_stats({}, f), stats)
+
+    def test_validate_compress_and_stats_interleaving(self):
+        # paired files are interleaved as they're validated and compressed
+        validated, gzpath, stats, _ = self.impl._validate_compress_and_stats(
+            os.path.join(self.scratch, 'stream.inter.fastq'), 1, None, False,
+            self.impl._interleaved_blocks('data/Sample5_noninterleaved.1.fastq',
+                                          'data/Sample5_noninterleaved.2.fastq'))
+        self.assertEqual(validated, 1)
+        with gzip.open(gzpath, 'rb') as gz:
+            self.assertEqual(hashlib.md5(gz.read()).hexdigest(), self.MD5_FR_TO_I_BLANK)
+        self.assertEqual(stats['read_count'], 4)
+        with self.assertRaises(fastq_io.RecordCountMismatchError):
+            self.impl._validate_compress_and_stats(
+                os.path.join(self.scratch, 'stream_bad.inter.fastq'), 1, None, False,
+                self.impl._interleaved_blocks('data/Sample5_noninterleaved.1.missing_rec.fastq',
+                                              'data/Sample5_noninterleaved.2.fastq'))
+
+    def test_run_stages_concurrently(self):
+        started = threading.Event()
+
+        def slow(cancelled):
+            started.set()
+            cancelled.wait(60)
+            return cancelled.is_set()
+
+        self.assertEqual(stages.run_concurrently([lambda c: 1, lambda c: 2]), [1, 2])
+        results = []
+
+        def fail(cancelled):
+            started.wait(60)
+            raise ValueError('stage failed')
+
+        # the other stages are cancelled, and have stopped by the time the failure is raised
+        with self.assertRaisesRegex(ValueError, 'stage failed'):
+            stages.run_concurrently([lambda c: results.append(slow(c)), fail])
+        self.assertEqual(results, [True])
+
+        # or the failure is raised straight away, leaving a stage that can't stop running
+        release = threading.Event()
+        with self.assertRaisesRegex(ValueError, 'stage failed'):
+            stages.run_concurrently([lambda c: release.wait(60), fail], wait_on_failure=False)
+
+        # as for paired downloads, which DataFileUtil can't stop
+        def fetch(source):
+            if source == 'rev':
+                raise ValueError('download failed')
+            release.wait(60)
+            return source
+        with self.assertRaisesRegex(ValueError, 'download failed'):
+            self.impl._fetch_pair(fetch, 'fwd', 'rev')
+        release.set()
+        self.assertEqual(self.impl._fetch_pair(fetch, 'fwd', None), ('fwd', None))
+
     # Upload tests ########################################################
     def test_upload_fail_min_len_reads(self):
         # In the file min_Sample.fastq, there are two reads: one with a length of 2 bases and another with a length of 3 bases.
@@ -736,7 +1117,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d['single_genome'], 1)
         self.assertEqual('source' not in d, True)
         self.assertEqual('strain' not in d, True)
-        self.check_lib(d['lib'], 109, 'min_Sample.fastq.gz',
+        self.check_lib(d['lib'], 128, 'min_Sample.fastq.gz',
                        '4b8ba940f1bf90695b35625c21ed4574')
         node = d['lib']['file']['id']
         self.delete_shock_node(node)
@@ -764,7 +1145,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d['single_genome'], 1)
         self.assertEqual('source' not in d, True)
         self.assertEqual('strain' not in d, True)
-        self.check_lib(d['lib'], 95, 'min_single_Sample.fastq.gz',
+        self.check_lib(d['lib'], 107, 'min_single_Sample.fastq.gz',
                        'a9bacab6ea7c3563c3ba90bb27fac3a4')
         node = d['lib']['file']['id']
         self.delete_shock_node(node)
@@ -787,11 +1168,34 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d['single_genome'], 1)
         self.assertEqual('source' not in d, True)
         self.assertEqual('strain' not in d, True)
-        self.check_lib(d['lib'], 2966, 'Sample1.fastq.gz',
+        self.assertEqual(d['read_count'], 50)
+        # the node is copied rather than compressed and uploaded again
+        self.assertNotEqual(d['lib']['file']['id'], ret['shock_id'])
+        self.check_lib(d['lib'], 2847, 'Sample1.fastq.gz',
                        'f118ee769a5e1b40ec44629994dfc3cd')
         node = d['lib']['file']['id']
         self.delete_shock_node(node)
 
+    def test_single_end_reads_bzip2(self):
+        # only gzipped nodes are copied, so bzip2 reads are recompressed with gzip
+        bzpath = os.path.join(self.scratch, 'Sample1.fastq.bz2')
+        with open('data/Sample1.fastq', 'rb') as s, bz2.open(bzpath, 'wb') as t:
+            shutil.copyfileobj(s, t)
+        ret = self.upload_file_to_shock(bzpath)
+        with patch.object(DataFileUtil, 'copy_shock_node', autospec=True) as copy:
+            self.impl.upload_reads(self.ctx, {'fwd_id': ret['shock_id'],
+                                              'sequencing_tech': 'seqtech',
+                                              'wsname': self.ws_info[1],
+                                              'name': 'singlereadsbz2'})
+        copy.assert_not_called()
+        self.delete_shock_node(ret['shock_id'])
+        d = self.dfu.get_objects(
+            {'object_refs': [self.ws_info[1] + '/singlereadsbz2']})['data'][0]['data']
+        self.assertEqual(d['read_count'], 50)
+        self.check_lib(d['lib'], 2988, 'Sample1.fastq.gz',
+                       'f118ee769a5e1b40ec44629994dfc3cd')
+        self.delete_shock_node(d['lib']['file']['id'])
+
     def test_forward_reads_file(self):
         tf = 'Sample1.fastq'
         target = os.path.join(self.scratch, tf)
@@ -811,7 +1215,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d['single_genome'], 1)
         self.assertEqual('source' not in d, True)
         self.assertEqual('strain' not in d, True)
-        self.check_lib(d['lib'], 2966, 'Sample1.fastq.gz',
+        self.check_lib(d['lib'], 2988, 'Sample1.fastq.gz',
                        'f118ee769a5e1b40ec44629994dfc3cd')
         node = d['lib']['file']['id']
         self.delete_shock_node(node)
@@ -834,7 +1238,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d['single_genome'], 0)
         self.assertEqual('source' not in d, True)
         self.assertEqual('strain' not in d, True)
-        self.check_lib(d['lib'], 611, 'Sample5_noninterleaved.1.fastq.gz',
+        self.check_lib(d['lib'], 616, 'Sample5_noninterleaved.1.fastq.gz',
                        '140a61c7f183dd6a2b93ef195bb3ec63')
         node = d['lib']['file']['id']
         self.delete_shock_node(node)
@@ -856,7 +1260,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d['single_genome'], 1)
         self.assertEqual('source' not in d, True)
         self.assertEqual('strain' not in d, True)
-        self.check_lib(d['lib'], 611, 'Sample5_noninterleaved.1.fastq.gz',
+        self.check_lib(d['lib'], 616, 'Sample5_noninterleaved.1.fastq.gz',
                        '140a61c7f183dd6a2b93ef195bb3ec63')
         node = d['lib']['file']['id']
         self.delete_shock_node(node)
@@ -908,7 +1312,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d["gc_content"], 0.44)
         self.assertEqual(d["read_length_mean"], 50)
         self.assertEqual(d["read_length_stdev"], 0)
-        self.check_lib(d['lib'], 2966, 'Sample1.fastq.gz',
+        self.check_lib(d['lib'], 2988, 'Sample1.fastq.gz',
                        'f118ee769a5e1b40ec44629994dfc3cd')
         node = d['lib']['file']['id']
         self.delete_shock_node(node)
@@ -942,7 +1346,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d['read_orientation_outward'], 0)
         self.assertEqual(d['insert_size_mean'], None)
         self.assertEqual(d['insert_size_std_dev'], None)
-        self.check_lib(d['lib1'], 2696029, file_name,
+        self.check_lib(d['lib1'], 2728208, file_name,
                        '1c58d7d59c656db39cedcb431376514b')
         node = d['lib1']['file']['id']
         self.delete_shock_node(node)
@@ -999,7 +1403,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d["gc_content"], 0.679273)
         self.assertEqual(d["read_length_mean"], 100)
         self.assertEqual(d["read_length_stdev"], 0)
-        self.check_lib(d['lib1'], 2696029, file_name,
+        self.check_lib(d['lib1'], 2728208, file_name,
                        '1c58d7d59c656db39cedcb431376514b')
         node = d['lib1']['file']['id']
         self.delete_shock_node(node)
@@ -1050,7 +1454,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d["gc_content"], 0.6)
         self.assertEqual(d["read_length_mean"], 251)
         self.assertEqual(d["read_length_stdev"], 0)
-        self.check_lib(d['lib1'], 1063, 'Sample5_interleaved.fastq.gz',
+        self.check_lib(d['lib1'], 1073, 'Sample5_interleaved.fastq.gz',
                        '971a5f445055c85fd45b17459e15e3ed')
         node = d['lib1']['file']['id']
         self.delete_shock_node(node)
@@ -1312,6 +1716,50 @@ class ReadsUtilsTest(unittest.TestCase):
                 self.ws_info[0], self.ws_info[1]),
             exception=ServerError)
 
+    def test_upload_reads_mass(self):
+        paths = []
+        for f in ['small.forward.fq', 'small.reverse.fq', 'Sample1_invalid.fastq']:
+            paths.append(os.path.join(self.scratch, 'mass_' + f))
+            shutil.copy('data/' + f, paths[-1])
+        std = {'sequencing_tech': 'seqtech-mass', 'wsname': self.ws_info[1]}
+        ret = self.impl.upload_reads_mass(self.ctx, [
+            dictmerge(std, {'fwd_file': paths[0], 'name': 'massreads1'}),
+            dictmerge(std, {'fwd_file': paths[2], 'name': 'massreads2'}),
+            dictmerge(std, {'fwd_file': paths[0], 'rev_file': paths[1],
+                            'name': 'massreads3'}),
+            dictmerge(std, {'name': 'massreads4'})])[0]
+        objs = self.dfu.get_objects({'object_refs': [
+            self.ws_info[1] + '/massreads1', self.ws_info[1] + '/massreads3']})['data']
+        self.assertEqual(ret[0], {'obj_ref': self.make_ref(objs[0]['info']), 'error': None})
+        self.assertEqual(ret[2], {'obj_ref': self.make_ref(objs[1]['info']), 'error': None})
+        self.assertEqual(objs[0]['data']['read_count'], 12500)
+        self.assertEqual(objs[1]['data']['read_count'], 25000)
+        self.assertIsNone(ret[1]['obj_ref'])
+        self.assertIn('Invalid FASTQ file - Path: ' + paths[2], ret[1]['error'])
+        self.assertIsNone(ret[3]['obj_ref'])
+        self.assertIn('Exactly one of a file, shock id', ret[3]['error'])
+        for o in objs:
+            self.delete_shock_node(o['data'].get('lib', o['data'].get('lib1'))['file']['id'])
+
+    def test_upload_reads_mass_same_shock_file_name(self):
+        # concurrent uploads of Shock nodes with the same file name don't overwrite each other
+        nodes = []
+        for f in ['small.forward.fq', 'Sample1.fastq']:
+            d = tempfile.mkdtemp(dir=self.scratch)
+            shutil.copy('data/' + f, os.path.join(d, 'reads.fq'))
+            nodes.append(self.upload_file_to_shock(os.path.join(d, 'reads.fq'))['shock_id'])
+            self.nodes_to_delete.append(nodes[-1])
+        std = {'sequencing_tech': 'seqtech-mass', 'wsname': self.ws_info[1]}
+        ret = self.impl.upload_reads_mass(self.ctx, [
+            dictmerge(std, {'fwd_id': nodes[0], 'name': 'masssame1'}),
+            dictmerge(std, {'fwd_id': nodes[1], 'name': 'masssame2'})])[0]
+        self.assertEqual([r['error'] for r in ret], [None, None])
+        objs = self.dfu.get_objects({'object_refs': [r['obj_ref'] for r in ret]})['data']
+        self.assertEqual(objs[0]['data']['read_count'], 12500)
+        self.assertEqual(objs[1]['data']['read_count'], 50)
+        for o in objs:
+            self.delete_shock_node(o['data']['lib']['file']['id'])
+
     def check_lib(self, lib, size, filename, md5):
         shock_id = lib["file"]["id"]
         print("LIB: {}".format(str(lib)))
@@ -1570,13 +2018,13 @@ class ReadsUtilsTest(unittest.TestCase):
     def test_upload_fail_bad_fastq(self):
         print('*** upload_fail_bad_fastq ***')
         ret = self.upload_file_to_shock('data/Sample1_invalid.fastq')
-        self.fail_upload_reads(
+        self.fail_upload_reads_regex(
             {'sequencing_tech': 'tech',
              'wsname': self.ws_info[1],
              'fwd_id': ret['shock_id'],
              'name': 'bar'
              },
-            'Invalid FASTQ file - Path: /kb/module/work/tmp/fwd/Sample1_invalid.fastq. ' +
+            'Invalid FASTQ file - Path: /kb/module/work/tmp/[^/]+/fwd/Sample1_invalid.fastq. ' +
             'Input Shock ID : ' + ret['shock_id'] +
             '. File Name : Sample1_invalid.fastq.')
         self.delete_shock_node(ret['shock_id'])
@@ -1601,6 +2049,126 @@ class ReadsUtilsTest(unittest.TestCase):
 
         return {'copy_file_path': fq_path}
 
+    def test_process_download_concurrent(self):
+        # the forward and reverse files are fetched at the same time, so each fetch can wait
+        # for the other to start
+        barrier = threading.Barrier(2, timeout=30)
+
+        def fetch(params):
+            barrier.wait()
+            if params['staging_file_subdir_path'] == 'missing.fq':
+                raise ValueError('no such staging file')
+            return type(self).mock_download_staging_file(params)
+
+        with patch.object(DataFileUtil, 'download_staging_file', side_effect=fetch):
+            ret = self.impl._process_download('small.forward.fq', 'small.reverse.fq',
+                                              'staging', None, 'user')
+            self.assertEqual(ret['fwdpath'], '/kb/module/work/tmp/small.forward.fq')
+            self.assertEqual(ret['revpath'], '/kb/module/work/tmp/small.reverse.fq')
+            with self.assertRaisesRegex(ValueError, 'no such staging file'):
+                self.impl._process_download('small.forward.fq', 'missing.fq',
+                                            'staging', None, 'user')
+
+    def test_upload_reads_resume(self):
+        # an upload that fails uploading to Shock is resumed from the compressed file, without
+        # validating the reads again. Staging files can change, so are fetched again
+        real_upload = DataFileUtil.file_to_shock
+        failures = [ServerError('JSONRPCError', -32000, 'Shock upload timed out')]
+
+        def upload(dfu, params):
+            if failures:
+                raise failures.pop()
+            return real_upload(dfu, params)
+
+        checkpoint_dir = tempfile.mkdtemp(dir=self.cfg['scratch'])
+        params = {'fwd_staging_file_name': 'small.forward.fq',
+                  'rev_staging_file_name': 'small.reverse.fq',
+                  'sequencing_tech': 'seqtech',
+                  'wsname': self.ws_info[1],
+                  'name': 'resumed'}
+        with patch.object(self.impl, 'checkpoint_dir', checkpoint_dir), patch.object(
+                self.impl, 'upload_retries', 0), patch.object(
+                DataFileUtil, 'download_staging_file',
+                side_effect=type(self).mock_download_staging_file) as download, patch.object(
+                DataFileUtil, 'file_to_shock', autospec=True, side_effect=upload):
+            with self.assertRaisesRegex(ServerError, 'Shock upload timed out'):
+                self.impl.upload_reads(self.ctx, params)
+            self.assertEqual(len(os.listdir(checkpoint_dir)), 1)
+            with patch.object(self.impl, '_validate_compress_and_stats') as validate:
+                ref = self.impl.upload_reads(self.ctx, params)
+            validate.assert_not_called()
+        self.assertEqual(download.call_count, 4)
+        self.assertEqual(os.listdir(checkpoint_dir), [])  # removed once the object is saved
+        d = self.dfu.get_objects({'object_refs': [ref[0]['obj_ref']]})['data'][0]['data']
+        self.assertEqual(d['read_count'], 25000)
+        self.delete_shock_node(d['lib1']['file']['id'])
+
+    def test_upload_reads_stats_failure(self):
+        # the reads are uploaded while kb_ea_utils calculates their statistics, so the uploaded
+        # file is deleted from Shock if the statistics fail
+        real_upload = DataFileUtil.file_to_shock
+        uploaded = []
+
+        def upload(dfu, params):
+            uploaded.append(real_upload(dfu, params))
+            return uploaded[-1]
+
+        stats_failed = RuntimeError('stats failed')
+        with patch.object(self.impl, 'get_fq_stats', side_effect=stats_failed), patch.object(
+                self.impl, 'stats_engine', ReadsUtils.EA_UTILS_STATS_ENGINE), patch.object(
+                DataFileUtil, 'file_to_shock', autospec=True, side_effect=upload):
+            with self.assertRaisesRegex(RuntimeError, 'stats failed'):
+                self.impl.upload_reads(self.ctx, {'fwd_file': 'data/Sample1.fastq',
+                                                  'sequencing_tech': 'seqtech',
+                                                  'wsname': self.ws_info[1],
+                                                  'name': 'statsfailed'})
+        self.assertEqual(len(uploaded), 1)
+        r = requests.get(self.shockURL + '/node/' + uploaded[0]['shock_id'],
+                         headers={'Authorization': 'OAuth ' + self.token})
+        self.assertEqual(r.status_code, 404)
+
+        # the native engine has the statistics before the upload starts, so there's no overlap
+        with patch.object(stages, 'run_concurrently') as run:
+            ref = self.impl.upload_reads(self.ctx, {'fwd_file': 'data/Sample1.fastq',
+                                                    'sequencing_tech': 'seqtech',
+                                                    'wsname': self.ws_info[1],
+                                                    'name': 'nativestats'})
+        run.assert_not_called()
+        d = self.dfu.get_objects({'object_refs': [ref[0]['obj_ref']]})['data'][0]['data']
+        self.assertEqual(d['read_count'], 50)
+        self.delete_shock_node(d['lib']['file']['id'])
+
+    def test_job_manifest(self):
+        d = tempfile.mkdtemp(dir=self.scratch)
+        inp, gz = os.path.join(d, 'in.fq'), os.path.join(d, 'out.gz')
+        for f in [inp, gz]:
+            with open(f, 'w') as fh:
+                fh.write('x')
+        manifest = checkpoint.JobManifest(d, {'fwd_file': inp})
+        manifest.set_inputs([checkpoint.file_fingerprint(inp)])
+        manifest.record('compressed', {'gzpath': gz}, [gz])
+        manifest.record('uploaded', {'handle': 'h'})
+
+        manifest = checkpoint.JobManifest(d, {'fwd_file': inp})
+        manifest.set_inputs([checkpoint.file_fingerprint(inp)])
+        self.assertEqual(manifest.get('uploaded'), {'handle': 'h'})
+        self.assertIsNone(checkpoint.JobManifest(d, {'fwd_file': gz}).get('uploaded'))
+        # the upload was made from the compressed file, so is stale if it changes
+        with open(gz, 'a') as fh:
+            fh.write('y')
+        self.assertIsNone(manifest.get('compressed'))
+        self.assertIsNone(manifest.get('uploaded'))
+        # or if the input is replaced
+        manifest.record('compressed', {'gzpath': gz}, [gz])
+        self.assertIsNone(manifest.get('uploaded'))  # dropped when compressed was redone
+        os.remove(inp)
+        with open(inp, 'w') as fh:
+            fh.write('z')
+        manifest.set_inputs([checkpoint.file_fingerprint(inp)])
+        self.assertIsNone(manifest.get('compressed'))
+        manifest.remove()
+        self.assertEqual(sorted(os.listdir(d)), ['in.fq', 'out.gz'])
+
     @patch.object(DataFileUtil, "download_staging_file",
                                         side_effect=mock_download_staging_file)
     def test_upload_fail_bad_fastq_file_staging(self, download_staging_file):
@@ -1706,8 +2274,8 @@ class ReadsUtilsTest(unittest.TestCase):
              'REV Shock ID : {}. ' +
              'FWD File Name : Sample1_invalid.fastq. ' +
              'REV File Name : Sample_rev.fq. ' +
-             'FWD Path : /kb/module/work/tmp/fwd/Sample1_invalid.fastq. ' +
-             'REV Path : /kb/module/work/tmp/rev/Sample_rev.fq.').format(
+             'FWD Path : /kb/module/work/tmp/[^/]+/fwd/Sample1_invalid.fastq. ' +
+             'REV Path : /kb/module/work/tmp/[^/]+/rev/Sample_rev.fq.').format(
                 ret1['shock_id'],
                 ret2['shock_id']))
         self.delete_shock_node(ret1['shock_id'])
@@ -1715,13 +2283,13 @@ class ReadsUtilsTest(unittest.TestCase):
 
     def test_upload_fail_interleaved_for_single(self):
         ret = self.upload_file_to_shock('data/Sample5_interleaved.fastq')
-        self.fail_upload_reads(
+        self.fail_upload_reads_regex(
             {'sequencing_tech': 'tech',
              'wsname': self.ws_info[1],
              'fwd_id': ret['shock_id'],
              'name': 'bar'
              },
-            'Invalid FASTQ file - Path: /kb/module/work/tmp/fwd/Sample5_interleaved.fastq. ' +
+            'Invalid FASTQ file - Path: /kb/module/work/tmp/[^/]+/fwd/Sample5_interleaved.fastq. ' +
             'Input Shock ID : ' + ret['shock_id'] +
             '. File Name : Sample5_interleaved.fastq.')
         self.delete_shock_node(ret['shock_id'])
@@ -2206,6 +2774,107 @@ class ReadsUtilsTest(unittest.TestCase):
             }, interleave='true'
         )
 
+    def test_download_write_index(self):
+        wsref = self.getWsName() + '/frbasic'
+        ret = self.impl.download_reads(
+            self.ctx, {'read_libraries': [wsref],
+                       'write_index': 1})[0]['files'][wsref]['files']
+        for d in ['fwd', 'rev']:
+            index = fastq_index.FASTQIndex.load(ret[d] + '.fqi')
+            self.assertEqual(index.record_count, 12500)
+            self.assertEqual(index.total_bases, 1250000)
+            self.assertEqual(index.size, os.path.getsize(ret[d]))
+            self.assertEqual(len(index.offsets), 4)
+            ranges = fastq_index.record_ranges(ret[d], 4)
+            self.assertEqual(len(ranges), 4)
+            with open(ret[d], 'rb') as f:
+                for start, _ in ranges:
+                    f.seek(start)
+                    self.assertEqual(f.read(1), b'@')
+
+    def test_download_stats(self):
+        wsref = self.getWsName() + '/kbassy_roo_t'
+        with patch.object(self.impl, 'download_stats', True):
+            ret = self.impl.download_reads(
+                self.ctx, {'read_libraries': [wsref]})[0]['files'][wsref]
+        expected = fastq_stats.file_stats('data/small.forward.fq').result()
+        self.assertEqual(ret['read_count'], expected['read_count'])
+        self.assertEqual({k: ret[k] for k in expected}, expected)
+        self.assertEqual(ret['insert_size_mean'], 42)
+
+        # reads that are interleaved or deinterleaved have their statistics calculated as
+        # they're written, rather than reading the files again
+        file_stats = fastq_stats.file_stats
+        for name, interleaved in [('frbasic_kbassy', 'true'), ('intbasic_kbassy', 'false')]:
+            wsref = self.getWsName() + '/' + name
+            with patch.object(self.impl, 'download_stats', True), patch.object(
+                    fastq_stats, 'file_stats', side_effect=AssertionError('read again')):
+                ret = self.impl.download_reads(
+                    self.ctx, {'read_libraries': [wsref],
+                               'interleaved': interleaved})[0]['files'][wsref]
+            expected = fastq_stats.FASTQStats()
+            for path in [ret['files']['fwd'], ret['files']['rev']]:
+                if path:
+                    expected.merge(file_stats(path))
+            expected = expected.result()
+            self.assertEqual({k: ret[k] for k in expected}, expected)
+
+    def test_stats_merge(self):
+        # statistics for parts of a file merge into those for the whole file
+        path = 'data/Sample5_interleaved_blank_lines.fastq'
+        parts = []
+        with open(path, 'rb') as f:
+            for block in fastq_io.record_blocks(f, 500):
+                parts.append(fastq_stats.FASTQStats())
+                parts[-1].add(block)
+        self.assertGreater(len(parts), 1)
+        merged = fastq_stats.FASTQStats()
+        for part in parts:
+            merged.merge(part)
+        expected = fastq_stats.file_stats(path).result()
+        self.assertEqual(merged.result(), expected)
+        self.assertEqual(expected['read_count'], 4)
+        self.assertEqual(fastq_stats.file_stats('data/small.forward.fq', 3).result(),
+                         fastq_stats.file_stats('data/small.forward.fq').result())
+        # empty files can't be memory mapped, so are read in a single pass
+        empty = os.path.join(self.scratch, 'empty_stats.fastq')
+        open(empty, 'w').close()
+        self.assertEqual(fastq_stats.file_stats(empty, 3).result()['read_count'], 0)
+
+    def test_duplicate_counter(self):
+        # spilling to disk doesn't change the count
+        spill = os.path.join(self.scratch, 'duplicate_spill')
+        os.makedirs(spill)
+        stats = fastq_stats.file_stats('data/small.forward.fq', 2, 1024, spill)
+        self.assertGreater(len(os.listdir(spill)), 1)
+        self.assertEqual(stats.result()['number_of_duplicates'], 254)
+        self.assertEqual(len(os.listdir(spill)), 1)
+        stats.close()
+        self.assertEqual(os.listdir(spill), [])
+
+        # repeated fingerprints are kept, including those repeated across spilled runs
+        counter = duplicate_counter.DuplicateCounter(32, spill, keep_repeated=True)
+        for prints in [[1, 2, 3], [4, 5, 1], [6, 7, 5], [1, 8, 9]]:
+            counter.add(numpy.array(prints, dtype=numpy.uint64))
+        self.assertEqual(counter.count(), 9)
+        self.assertEqual(counter.repeated().tolist(), [1, 5])
+        counter.close()
+        self.assertIsNone(duplicate_counter.DuplicateCounter().repeated())
+
+        counter = duplicate_counter.DuplicateCounter(approximate=True)
+        counter.add(duplicate_counter.fingerprints(
+            numpy.arange(200000, dtype=numpy.uint32).view(numpy.uint8).reshape(-1, 4)))
+        self.assertAlmostEqual(counter.count(), 200000, delta=200000 * 0.03)
+
+    def test_index_blank_lines(self):
+        path = 'data/Sample5_interleaved_blank_lines.fastq'
+        index = fastq_index.build_index(path, 2)
+        self.assertEqual(index.offsets, [1, 1119])
+        self.assertEqual(index.record_count, 4)
+        self.assertEqual(index.total_bases, 1004)
+        self.assertEqual(index.ranges(2), [(0, 1119), (1119, 2236)])
+        self.assertEqual(index.ranges(5), [(0, 1119), (1119, 2236)])
+
     # test some compressed, some uncompressed
     def test_deinterleave(self):
         self.download_success(
@@ -2749,6 +3418,82 @@ class ReadsUtilsTest(unittest.TestCase):
                     self.staged['int_miss_line']['fwd_node_id']),
             interleave='false')
 
+    def test_deinterleave_parallel(self):
+        # runs the memory mapped and BGZF multi-process paths on a small file and checks them
+        # against the single stream path, along with the statistics calculated on the way
+        source = 'data/Sample4_interleaved_NCBI_SRA.fastq'
+        compressed = os.path.join(self.scratch, 'deinterleave_parallel.fastq.gz')
+        with patch.object(bgzf, 'BLOCK_DATA_SIZE', 1000), open(source, 'rb') as f, \
+                bgzf.BGZFWriter(compressed) as w:
+            w.write(f.read())
+        md5s = set()
+        for path, workers in [(source, 1), (source, 3), (compressed, 3), (compressed, 7)]:
+            fwd = os.path.join(self.scratch, f'deinterleave_parallel_{workers}.fwd.fastq')
+            rev = os.path.join(self.scratch, f'deinterleave_parallel_{workers}.rev.fastq')
+            with patch.object(fastq_io, 'BLOCK_SIZE', 1000), patch.object(
+                    bgzf, 'CHUNK_SIZE', 3000), patch.object(
+                    fastq_io, 'deinterleave', wraps=fastq_io.deinterleave) as deinterleave:
+                count, parts = fastq_io.deinterleave_file(
+                    path, fwd, rev, workers, fastq_stats.FASTQStats)
+            # the ranges are deinterleaved in the worker processes
+            self.assertEqual(deinterleave.call_count, 1 if workers == 1 else 0)
+            self.assertEqual(count, 400)
+            stats = fastq_stats.FASTQStats()
+            for part in parts:
+                stats.merge(part)
+            self.assertEqual(stats.result(), fastq_stats.file_stats(source).result())
+            md5s.add((self.md5(fwd), self.md5(rev)))
+        self.assertEqual(len(md5s), 1)
+        # BGZF data that needs cleaning up is deinterleaved in a single stream
+        blank = os.path.join(self.scratch, 'deinterleave_parallel_blank.fastq.gz')
+        with open('data/Sample5_interleaved_blank_lines.fastq', 'rb') as f, \
+                bgzf.BGZFWriter(blank) as w:
+            w.write(f.read())
+        with patch.object(fastq_io, 'deinterleave', wraps=fastq_io.deinterleave) as deinterleave:
+            self.assertEqual(fastq_io.deinterleave_file(blank, fwd, rev, 2)[0], 16)
+        self.assertEqual(deinterleave.call_count, 1)
+
+    def test_deinterleave_download(self):
+        # downloads from Shock are left compressed. BGZF files, as written by uploads, are
+        # split between processes, and other gzip files deinterleaved in a single stream
+        source = 'data/Sample4_interleaved_NCBI_SRA.fastq'
+        fwd = os.path.join(self.scratch, 'deinterleave_download_expected.fwd.fastq')
+        rev = os.path.join(self.scratch, 'deinterleave_download_expected.rev.fastq')
+        fastq_io.deinterleave_file(source, fwd, rev)
+        download = os.path.join(self.scratch, 'deinterleave_download.fastq.gz')
+        with patch.object(bgzf, 'BLOCK_DATA_SIZE', 1000), open(source, 'rb') as f, \
+                bgzf.BGZFWriter(download) as w:
+            w.write(f.read())
+        plain = os.path.join(self.scratch, 'deinterleave_download_plain.fastq.gz')
+        with open(source, 'rb') as f, gzip.open(plain, 'wb') as g:
+            g.write(f.read())
+        for path, workers in [(download, 3), (plain, 1)]:
+            handle = {'id': 'node', 'file_name': 'Sample4_interleaved_NCBI_SRA.fastq.gz'}
+            with patch.object(ReadsUtils, 'PARALLEL_DEINTERLEAVE_MIN_SIZE', 0), patch.object(
+                    os, 'cpu_count', return_value=3), patch.object(
+                    self.impl, '_download_reads_from_shock',
+                    return_value=(path, handle['file_name'])) as shock_to_file, patch.object(
+                    fastq_io, 'deinterleave_file',
+                    wraps=fastq_io.deinterleave_file) as deinterleave:
+                ret = self.impl.process_interleaved('ref', 'name', handle, False)
+            self.assertFalse(shock_to_file.call_args[0][4])  # not decompressed by DataFileUtil
+            self.assertEqual(deinterleave.call_args[0][3], workers)
+            self.assertEqual((self.md5(ret['fwd']), self.md5(ret['rev'])),
+                             (self.md5(fwd), self.md5(rev)))
+
+    def test_bad_deinterleave_parallel(self):
+        with patch.object(ReadsUtils, 'PARALLEL_DEINTERLEAVE_MIN_SIZE', 0):
+            with self.assertRaises(ValueError) as context:
+                self.impl.deinterleave(
+                    'ref', 'name', 'Sample6_interleaved_odd_num_reads.fastq', 'node',
+                    'data/Sample6_interleaved_odd_num_reads.fastq',
+                    os.path.join(self.scratch, 'bad_deinterleave_parallel.fwd.fastq'),
+                    os.path.join(self.scratch, 'bad_deinterleave_parallel.rev.fastq'))
+        self.assertEqual(str(context.exception),
+                         'Deinterleave failed - line count is not divisible by 8. Workspace '
+                         'reads object name (ref), Shock node node, Shock filename '
+                         'Sample6_interleaved_odd_num_reads.fastq.')
+
     def test_bad_interleave_missing_line(self):
         self.download_error(
             [self.getWsName() + '/fr_missing_line'],
@@ -2791,6 +3536,64 @@ class ReadsUtilsTest(unittest.TestCase):
             interleave='true',
             do_startswith=True)
 
+    def test_interleave_small_blocks(self):
+        # forces records, lines, and blank line runs to straddle block boundaries
+        target = os.path.join(self.scratch, 'interleave_small_blocks.fastq')
+        with patch.object(fastq_io, 'BLOCK_SIZE', 7):
+            lines = self.impl.interleave(
+                None, None, None, None, None, None,
+                'data/Sample5_noninterleaved.1.blank_lines.fastq',
+                'data/Sample5_noninterleaved.2.fastq', target, None, None, None)
+        self.assertEqual(lines, 16)
+        self.assertEqual(self.md5(target), self.MD5_FR_TO_I_BLANK)
+
+    def test_interleave_compressed(self):
+        # compression is detected from the file contents, not the file name
+        fwd = os.path.join(self.scratch, 'interleave_compressed.fwd.fastq')
+        rev = os.path.join(self.scratch, 'interleave_compressed.rev.fq.bz2')
+        with open('data/Sample5_noninterleaved.1.blank_lines.fastq', 'rb') as s, \
+                gzip.open(fwd, 'wb') as t:
+            shutil.copyfileobj(s, t)
+        with open('data/Sample5_noninterleaved.2.fastq', 'rb') as s, bz2.open(rev, 'wb') as t:
+            shutil.copyfileobj(s, t)
+        target = os.path.join(self.scratch, 'interleave_compressed.inter.fastq')
+        self.impl.interleave(None, None, None, None, None, None, fwd, rev, target,
+                             None, None, None)
+        self.assertEqual(self.md5(target), self.MD5_FR_TO_I_BLANK)
+
+    def test_interleave_cleans_up_lines(self):
+        # interleaving cleans up lines the same way as validateFASTQ so upload_reads can skip
+        # the validation clean up pass
+        fwd = os.path.join(self.scratch, 'interleave_clean.fwd.fastq')
+        rev = os.path.join(self.scratch, 'interleave_clean.rev.fastq')
+        target = os.path.join(self.scratch, 'interleave_clean.inter.fastq')
+        with open(fwd, 'wb') as f:
+            f.write(b'@r1 \r\nACGT\r\n+\r\n\tIIII\r\n\r\n  \n@r2\nAC GT\n+\nIIII')
+        with open(rev, 'wb') as f:
+            f.write(b'@r1/2\nTTTT\n+\nIIII\n@r2/2\nGGGG\n+\nIIII\n')
+        for block_size in [None, 3]:
+            with patch.object(fastq_io, 'BLOCK_SIZE', block_size or fastq_io.BLOCK_SIZE):
+                lines = self.impl.interleave(None, None, None, None, None, None, fwd, rev,
+                                             target, None, None, None)
+            self.assertEqual(lines, 16)
+            with open(target, 'rb') as f:
+                self.assertEqual(f.read(), b'@r1\nACGT\n+\nIIII\n@r1/2\nTTTT\n+\nIIII\n' +
+                                 b'@r2\nAC GT\n+\nIIII\n@r2/2\nGGGG\n+\nIIII\n')
+
+    def test_interleave_small_blocks_missing_line(self):
+        target = os.path.join(self.scratch, 'interleave_small_blocks_missing_line.fastq')
+        with patch.object(fastq_io, 'BLOCK_SIZE', 7):
+            with self.assertRaises(ValueError) as context:
+                self.impl.interleave(
+                    None, None, 'Sample5_noninterleaved.1.missing_line.fastq', 'fwdnode',
+                    'Sample5_noninterleaved.2.fastq', 'revnode',
+                    'data/Sample5_noninterleaved.1.missing_line.fastq',
+                    'data/Sample5_noninterleaved.2.fastq', target, None, None, None)
+        self.assertEqual(str(context.exception),
+                         'Reading FASTQ record failed - non-blank lines are not a multiple of '
+                         'four. Shock node fwdnode, Shock filename '
+                         'Sample5_noninterleaved.1.missing_line.fastq')
+
     def download_error(self, readnames, error,
                        interleave=None, exception=ValueError, do_startswith=False):
 
@@ -2941,7 +3744,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d['single_genome'], 1)
         self.assertEqual('source' not in d, True)
         self.assertEqual('strain' not in d, True)
-        self.check_lib(d['lib'], 2966, 'Sample1.fastq.gz',
+        self.check_lib(d['lib'], 2988, 'Sample1.fastq.gz',
                     'f118ee769a5e1b40ec44629994dfc3cd')
         node = d['lib']['file']['id']
         self.delete_shock_node(node)
@@ -2978,7 +3781,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d['read_orientation_outward'], 0)
         self.assertEqual(d['insert_size_mean'], None)
         self.assertEqual(d['insert_size_std_dev'], None)
-        self.check_lib(d['lib1'], 2696029, file_name,
+        self.check_lib(d['lib1'], 2728208, file_name,
                         '1c58d7d59c656db39cedcb431376514b')
         node = d['lib1']['file']['id']
         self.delete_shock_node(node)
@@ -3006,7 +3809,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d['single_genome'], 1)
         self.assertEqual('source' not in d, True)
         self.assertEqual('strain' not in d, True)
-        self.check_lib(d['lib'], 2966, 'Sample1.fastq.gz',
+        self.check_lib(d['lib'], 2988, 'Sample1.fastq.gz',
                        'f118ee769a5e1b40ec44629994dfc3cd')
         node = d['lib']['file']['id']
         self.delete_shock_node(node)
@@ -3044,7 +3847,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d['read_orientation_outward'], 0)
         self.assertEqual(d['insert_size_mean'], None)
         self.assertEqual(d['insert_size_std_dev'], None)
-        self.check_lib(d['lib1'], 2696029, file_name,
+        self.check_lib(d['lib1'], 2728208, file_name,
                        '1c58d7d59c656db39cedcb431376514b')
         node = d['lib1']['file']['id']
         self.delete_shock_node(node)
@@ -3070,7 +3873,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d['single_genome'], 1)
         self.assertEqual('source' not in d, True)
         self.assertEqual('strain' not in d, True)
-        self.check_lib(d['lib'], 2966, 'Sample1.fastq.gz',
+        self.check_lib(d['lib'], 2988, 'Sample1.fastq.gz',
                        'f118ee769a5e1b40ec44629994dfc3cd')
         node = d['lib']['file']['id']
         self.delete_shock_node(node)
@@ -3096,7 +3899,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d['single_genome'], 1)
         self.assertEqual('source' not in d, True)
         self.assertEqual('strain' not in d, True)
-        self.check_lib(d['lib'], 2966, 'Sample1.fastq.gz',
+        self.check_lib(d['lib'], 2988, 'Sample1.fastq.gz',
                        'f118ee769a5e1b40ec44629994dfc3cd')
         node = d['lib']['file']['id']
         self.delete_shock_node(node)
@@ -3133,7 +3936,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d['read_orientation_outward'], 0)
         self.assertEqual(d['insert_size_mean'], None)
         self.assertEqual(d['insert_size_std_dev'], None)
-        self.check_lib(d['lib1'], 2696029, file_name,
+        self.check_lib(d['lib1'], 2728208, file_name,
                        '1c58d7d59c656db39cedcb431376514b')
         node = d['lib1']['file']['id']
         self.delete_shock_node(node)
@@ -3164,7 +3967,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d['single_genome'], 1)
         self.assertEqual('source' not in d, True)
         self.assertEqual('strain' not in d, True)
-        self.check_lib(d['lib'], 2966, 'Sample1.fastq.gz',
+        self.check_lib(d['lib'], 2988, 'Sample1.fastq.gz',
                        'f118ee769a5e1b40ec44629994dfc3cd')
         node = d['lib']['file']['id']
         self.delete_shock_node(node)
@@ -3196,7 +3999,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d['single_genome'], 1)
         self.assertEqual('source' not in d, True)
         self.assertEqual('strain' not in d, True)
-        self.check_lib(d['lib'], 2966, 'Sample1.fastq.gz',
+        self.check_lib(d['lib'], 2988, 'Sample1.fastq.gz',
                        'f118ee769a5e1b40ec44629994dfc3cd')
         node = d['lib']['file']['id']
         self.delete_shock_node(node)
@@ -3228,11 +4031,44 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d['single_genome'], 1)
         self.assertEqual('source' not in d, True)
         self.assertEqual('strain' not in d, True)
-        self.check_lib(d['lib'], 2966, 'Sample1.fastq.gz',
+        self.check_lib(d['lib'], 2988, 'Sample1.fastq.gz',
                        'f118ee769a5e1b40ec44629994dfc3cd')
         node = d['lib']['file']['id']
         self.delete_shock_node(node)
 
+    def test_upload_reads_from_web_ftp_streaming(self):
+        # the gzipped file is decompressed as it streams in, rather than downloaded by DFU
+        fq_filename = "Sample1.fastq.gz"
+        shutil.copy(os.path.join("data", fq_filename),
+                    os.path.join(self.cfg['scratch'], fq_filename))
+        self.upload_file_to_local_ftp_server(fq_filename)
+
+        params = {
+            'download_type': 'FTP',
+            'fwd_file_url': 'ftp://{}/{}'.format(self.ftp_domain, fq_filename),
+            'sequencing_tech': 'Unknown',
+            'name': 'test_reads_file_name.reads',
+            'wsname': self.getWsName()
+        }
+        with patch.object(self.impl, 'web_streaming', True), patch.object(
+                DataFileUtil, 'download_web_file') as download:
+            ref = self.impl.upload_reads(self.ctx, params)
+        download.assert_not_called()
+        obj = self.dfu.get_objects(
+            {'object_refs': [self.ws_info[1] + '/test_reads_file_name.reads']})['data'][0]
+        self.assertEqual(ref[0]['obj_ref'], self.make_ref(obj['info']))
+        d = obj['data']
+        self.assertEqual(d['read_count'], 50)
+        self.check_lib(d['lib'], 2988, 'Sample1.fastq.gz',
+                       'f118ee769a5e1b40ec44629994dfc3cd')
+        self.delete_shock_node(d['lib']['file']['id'])
+
+        # a missing file fails before anything is uploaded
+        params['fwd_file_url'] = 'ftp://{}/{}'.format(self.ftp_domain, 'missing.fastq')
+        with patch.object(self.impl, 'web_streaming', True):
+            with self.assertRaisesRegex(ftplib.error_perm, '550'):
+                self.impl.upload_reads(self.ctx, params)
+
     def test_upload_reads_from_web_google_drive(self):
         # in kbase org -> Testing/PublicTestData/ReadsUtils
         url = 'https://drive.google.com/file/d/1X4pEdEhiHtQM0-8m6Nkqi82Kqkeo2_fX/'
@@ -3265,7 +4101,7 @@ class ReadsUtilsTest(unittest.TestCase):
         self.assertEqual(d['single_genome'], 1)
         self.assertEqual('source' not in d, True)
         self.assertEqual('strain' not in d, True)
-        self.check_lib(d['lib'], 2966, 'Sample1.fastq.gz',
+        self.check_lib(d['lib'], 2988, 'Sample1.fastq.gz',
                        'f118ee769a5e1b40ec44629994dfc3cd')
         node = d['lib']['file']['id']
         self.delete_shock_node(node)